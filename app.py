@@ -1,12 +1,24 @@
-from flask import Flask, request, jsonify
+import json
+import time
 import threading
+import multiprocessing
+from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
 from crawler_debug import crawl
 from vectorize import vectorize
 from extraction import *
-from llm_connection import get_openai_completion
-from scoring import strict_prompt, moonboy_prompt, call_gpt_agent, call_gemini_agent, call_mistral_agent
+from llm_connection import get_openai_completion, submit_coroutine
+from scoring import strict_prompt, moonboy_prompt, acall_gpt_agent, acall_gemini_agent, acall_mistral_agent
 from marketcap_utils import get_doge_data
 import database_connection as db
+import job_queue
+import batch
+from embedding_cache import warm_query_cache, get_cache_stats
+from chunk_selection import ChunkIndex, scoring_context_token_budget
+import rate_limiter
+import similarity_index
+from browser_pool import browser_pool
+from retry import Deadline, DeadlineExceeded, JobCancelled
 from logging.config import dictConfig
 from swagger_ui import api_doc
 
@@ -26,152 +38,330 @@ dictConfig({
     }
 })
 
+with open('config.json', 'r') as file:
+    config = json.load(file)
+
+agent_timeout = config.get('AGENT_TIMEOUT', 180)  # seconds, scoring agents still running after this are dropped
+task_time_budget = config.get('TASK_TIME_BUDGET', 1800)  # seconds, a job saves partial results after this
+checkpoint_sweep_interval = config.get('CHECKPOINT_SWEEP_INTERVAL', 3600)  # seconds between deletions of expired checkpoints
+
 app = Flask(__name__)
 api_doc(app, config_path='./ScoringSystem-1.0.0-swagger.yaml', url_prefix='/docs', title='API doc')
 isError = False
-num_jobs = 0
+
+# Static retrieval prompts are embedded in the background (only once, the cache is persisted)
+if multiprocessing.parent_process() is None:  # not in the local embedding processes (they re-import the main module)
+    threading.Thread(target=warm_query_cache, args=(retrieval_prompts + [strict_prompt, moonboy_prompt], app.logger), daemon=True).start()
 
 # If true, ai analysis will be returned on the request. If false, just the scraped info of website (and moonboy prompt)
 ai_analysis = True
 is_meme_season = True  # TODO set manually until calculation is automated
 
 
-def process_with_prompt_type(url: str, uses_meme: bool, text_chunks, embeddings, taskid: str):
+# Scoring result fields of the project document. A run replaces those of the (partial) run before it,
+# the other fields (token info, social links) are only set if missing.
+agent_fields = [f'{prefix}{agent}_{kind}' for prefix in ('', 'meme_') for agent in ('gpt', 'mistral', 'gemini')
+                for kind in ('score', 'raw')]
+result_fields = agent_fields + ['iteration', 'analyzed', 'isMemecoin', 'llm_summary', 'meme_llm_summary',
+                                'partial', 'meme_partial', 'missing_agents', 'meme_missing_agents']
+
+
+def sweep_checkpoints():
+    """ Checkpoints of partial and abandoned runs are deleted once they are too old to be reused """
+    while True:
+        try:
+            deleted = db.delete_expired_checkpoints()
+            if deleted > 0:
+                app.logger.info(f'Expired checkpoint files deleted: {deleted}')
+        except Exception as e:
+            app.logger.error(f'Checkpoint sweep failed: {e}')
+        time.sleep(checkpoint_sweep_interval)
+
+
+if multiprocessing.parent_process() is None:
+    threading.Thread(target=sweep_checkpoints, daemon=True, name='checkpoint-sweep').start()
+
+
+def load_stage(taskid: str, stage: str, input_hash: str = None):
+    """ Checkpoint of a stage or None. Checkpoint errors are not fatal, the stage is recomputed. """
+    try:
+        return db.load_checkpoint(taskid, stage, input_hash)
+    except Exception as e:
+        app.logger.error(f'[{taskid}] Loading {stage} checkpoint failed: {e}')
+        return None
+
+
+def save_stage(taskid: str, stage: str, data, input_hash: str = None, array=None, deadline: Deadline = None):
+    """ Checkpoint a stage output. Returns its content hash or None if saving failed. Cancelled runs save nothing. """
+    if deadline is not None and deadline.cancelled():
+        return None
+    try:
+        return db.save_checkpoint(taskid, stage, data, input_hash, array)
+    except Exception as e:
+        app.logger.error(f'[{taskid}] Saving {stage} checkpoint failed: {e}')
+        return None
+
+
+def save_extraction_stage(taskid: str, name: str, extracted, input_hash: str, deadline: Deadline):
+    """
+    Checkpoint a collected extraction. It is saved by the collecting thread, before the run stores its results
+    and clears its checkpoints. Failed extractions are not checkpointed, a re-run retries them.
+    """
+    if extracted == err_msg or (isinstance(extracted, dict) and extracted.get('tokenName') == err_msg):
+        return
+    save_stage(taskid, f'extract_{name}', extracted, input_hash, deadline=deadline)
+
+
+def process_with_prompt_type(url: str, uses_meme: bool, text_chunks, embeddings, taskid: str, deadline: Deadline,
+                             input_hash: str = None):
     save_prefix = 'meme_' if uses_meme else ''
     prompt = moonboy_prompt if uses_meme else strict_prompt
     prompt_type = 'meme' if uses_meme else 'strict'
 
     app.logger.info(f'[{taskid}] Generating analysis for project with prompt type: {prompt_type} ')
-    project_context = get_project_context(text_chunks, embeddings, prompt=f'Project: {url}\n{prompt}', top_k=40)
+    project_context = get_project_context(text_chunks, embeddings, prompt=prompt, token_budget=scoring_context_token_budget,
+                                          logger=app.logger)
     app.logger.info(f'[{taskid}] Scoring relevant text chunks selected. Char count: {len(project_context)}')
-    app.logger.info(f'[{taskid}] Calling OpenAI agent.')
-    res1 = call_gpt_agent(url, project_context, not uses_meme, app.logger)
-    app.logger.info(f'[{taskid}] OpenAI score: {res1["score"]}')
-    app.logger.info(f'[{taskid}] OpenAI description:\n{res1["description"]}')
-    app.logger.info(f'[{taskid}] Calling Mistral agent.')
-    res2 = call_mistral_agent(url, project_context, not uses_meme, app.logger)
-    app.logger.info(f'[{taskid}] Mistral score: {res2["score"]}')
-    app.logger.info(f'[{taskid}] Mistral description:\n{res2["description"]}')
-    app.logger.info(f'[{taskid}] Calling Gemini agent.')
+
+    # Agents are independent, they run concurrently on the shared event loop of the async clients with a shared deadline
+    agents = {'gpt': acall_gpt_agent, 'mistral': acall_mistral_agent}
     if not uses_meme:
-        res3 = call_gemini_agent(url, project_context, not uses_meme, app.logger)
-        app.logger.info(f'[{taskid}] Gemini score: {res3["score"]}')
-        app.logger.info(f'[{taskid}] Gemini description:\n{res3["description"]}')
-
-    # Summary
-    if uses_meme:
-        summary = get_openai_completion(f'Summarize the project in one sentence!\nOpinion:\n{res1}', app.logger)
-        app.logger.info(f'[{taskid}] Summary generated: {summary}')
-        return {
-            f'{save_prefix}gpt_score': res1['score'],
-            f'{save_prefix}gpt_raw': res1['description'],
-            f'{save_prefix}mistral_score': res2['score'],
-            f'{save_prefix}mistral_raw': res2['description'],
-            f'{save_prefix}llm_summary': summary,
-        }
+        agents['gemini'] = acall_gemini_agent
+    agent_names = {'gpt': 'OpenAI', 'mistral': 'Mistral', 'gemini': 'Gemini'}
+
+    # Agent scores of a previous (failed) run are reused
+    results = {}
+    for name in agents:
+        checkpoint = load_stage(taskid, f'{prompt_type}_{name}', input_hash)
+        if checkpoint is not None:
+            results[name] = checkpoint[0]
+            app.logger.info(f'[{taskid}] {agent_names[name]} score restored from checkpoint: {results[name]["score"]}')
+    agents_to_call = {name: agent for name, agent in agents.items() if name not in results}
+
+    futures = {name: submit_coroutine(agent(url, project_context, not uses_meme, app.logger, deadline=deadline))
+               for name, agent in agents_to_call.items()}
+    app.logger.info(f'[{taskid}] Calling agents: {", ".join(agent_names[name] for name in futures)}')
+    agents_deadline = time.time() + min(agent_timeout, deadline.remaining())
+
+    missing_agents = []  # timed out or crashed agents
+    for name, future in futures.items():
+        try:
+            results[name] = future.result(timeout=max(0, agents_deadline - time.time()))
+            if results[name]['description'] != 'Scoring failed':
+                save_stage(taskid, f'{prompt_type}_{name}', results[name], input_hash, deadline=deadline)
+            app.logger.info(f'[{taskid}] {agent_names[name]} score: {results[name]["score"]}')
+            app.logger.info(f'[{taskid}] {agent_names[name]} description:\n{results[name]["description"]}')
+        except FutureTimeoutError:
+            app.logger.warning(f'[{taskid}] {agent_names[name]} agent timed out.')
+            results[name] = {'score': 0, 'description': 'Scoring timed out'}
+            missing_agents.append(name)
+        except Exception as e:
+            app.logger.error(f'[{taskid}] {agent_names[name]} agent failed: {e}')
+            results[name] = {'score': 0, 'description': 'Scoring failed'}
+            missing_agents.append(name)
+    for future in futures.values():
+        future.cancel()  # a timed out agent is cancelled with its in-flight request
+
+    # Summary (join stage). Meme summary is based on the OpenAI opinion only if available.
+    summary_agents = ['gpt'] if uses_meme and 'gpt' not in missing_agents else list(agents)
+    opinions = [results[name] for name in summary_agents if name not in missing_agents]
+    if len(opinions) == 0 or deadline.expired():
+        summary = None
+    elif len(opinions) == 1:
+        summary = get_openai_completion(f'Summarize the project in one sentence!\nOpinion:\n{opinions[0]}', app.logger)
+    else:
+        opinions_text = '\n\n'.join(f'Opinion {i + 1}:\n{opinion}' for i, opinion in enumerate(opinions))
+        summary = get_openai_completion(f'Summarize the project in one sentence!\n{opinions_text}', app.logger)
+    app.logger.info(f'[{taskid}] Summary generated: {summary}')
+
+    output = {}
+    for name in agents:
+        output[f'{save_prefix}{name}_score'] = results[name]['score']
+        output[f'{save_prefix}{name}_raw'] = results[name]['description']
+    output[f'{save_prefix}llm_summary'] = summary
+    output[f'{save_prefix}partial'] = len(missing_agents) > 0
+    if len(missing_agents) > 0:
+        output[f'{save_prefix}missing_agents'] = missing_agents
+    return output
+
+
+def run_crawl_stage(url: str, taskid: str, deadline: Deadline, result: dict):
+    """ Crawl (network bound part of a job). Returns the documents and their checkpoint hash. """
+    checkpoint = load_stage(taskid, 'crawl')
+    if checkpoint is not None:
+        crawled, _, crawl_hash = checkpoint
+        documents, social_links = crawled['documents'], crawled['social_links']
+        app.logger.info(f'[{taskid}] URL scrapping restored from checkpoint. Document count: {len(documents)}')
     else:
-        summary = get_openai_completion(f'Summarize the project in one sentence!\nOpinion 1:\n{res1}\n\nOpinion 2:\n{res2}\n\nOpinion 3:\n{res3}', app.logger)
-        app.logger.info(f'[{taskid}] Summary generated: {summary}')
-        return {
-            f'{save_prefix}gpt_score': res1['score'],
-            f'{save_prefix}gpt_raw': res1['description'],
-            f'{save_prefix}mistral_score': res2['score'],
-            f'{save_prefix}mistral_raw': res2['description'],
-            f'{save_prefix}gemini_score': res3['score'],
-            f'{save_prefix}gemini_raw': res3['description'],
-            f'{save_prefix}llm_summary': summary,
-        }
-
-
-def processing_task(url: str, taskid: str):
-    # Tracking active processing jobs
-    global num_jobs
-    num_jobs += 1
-
-    # Processing
-    app.logger.info(f'[{taskid}] URL scrapping started.')
-    documents, social_links = crawl(url, app.logger)  # scrape URL and related documents
-    app.logger.info(f'[{taskid}] URL scrapping ended.')
+        app.logger.info(f'[{taskid}] URL scrapping started.')
+        documents, social_links = crawl(url, app.logger)  # scrape URL and related documents
+        app.logger.info(f'[{taskid}] URL scrapping ended.')
+        crawl_hash = save_stage(taskid, 'crawl', {'documents': documents, 'social_links': social_links}, deadline=deadline)
     app.logger.info(f'[{taskid}] Social links: {social_links}')
-    text_chunks, embeddings = vectorize(documents, logger=app.logger)  # chunk documents and vectorize chunks
-    app.logger.info(f'[{taskid}] Project documentation chunked and vectorized. Chunk count: {len(text_chunks)}')
-
-    # Extracting information
-    is_memecoin = extract_memecoin_status(url, text_chunks, embeddings, app.logger)
-    app.logger.info(f'[{taskid}] Is it a memecoin? {is_memecoin}')
-    token_info = extract_token_info(url, text_chunks, embeddings, app.logger)
-    app.logger.info(f'[{taskid}] Token info extracted: {token_info}')
-
-    ### PDF related. Will be moved to a different endpoint. ###
-    # TODO details
-    # summary = get summary field from DB ?
-    # narrative = get category field from DB ?
-    # details = do the "product description extraction" with marketing maybe?
-    industry_info = extract_industry_info(url, text_chunks, embeddings, app.logger)
-    app.logger.info(f'[{taskid}] Industry info extracted: {industry_info}')
-    team_info = extract_team_info(url, text_chunks, embeddings, app.logger)
-    app.logger.info(f'[{taskid}] Team info extracted: {team_info}')
-    backers_info = extract_backers_info(url, text_chunks, embeddings, app.logger)
-    app.logger.info(f'[{taskid}] Backers info extracted: {backers_info}')
-    tokenomics_info = extract_tokenomics_info(url, text_chunks, embeddings, app.logger)
-    app.logger.info(f'[{taskid}] Tokenomics info extracted: {tokenomics_info}')
-    financials_info = extract_financials_info(url, text_chunks, embeddings, app.logger)
-    app.logger.info(f'[{taskid}] Financials info extracted: {financials_info}')
-    market_info = extract_market_strat_prompt_info(url, text_chunks, embeddings, app.logger)
-    app.logger.info(f'[{taskid}] Market info extracted: {market_info}')
-    ### PDF related. Will be moved to a different endpoint. ###
-
-    # Scoring
-    uses_meme = is_meme_season and is_memecoin  # Activates moonboy prompt if it's memecoin season
-    meme_results = {}
-    strict_results = {}
-
-    if uses_meme:
-        meme_results = process_with_prompt_type(
-            url=url,
-            uses_meme=True,
-            text_chunks=text_chunks,
-            embeddings=embeddings,
-            taskid=taskid
-        )
-
-    if ai_analysis:
-        strict_results = process_with_prompt_type(
-            url=url,
-            uses_meme=False,
-            text_chunks=text_chunks,
-            embeddings=embeddings,
-            taskid=taskid
-        )
-    # Saving results
-    result = {
-        "iteration": 0,
-        "analyzed": False,
-        "twitterLink": social_links['twitter'],
-        "telegramLink": social_links['telegram'],
-        "isMemecoin": is_memecoin,
-        "tokenName": token_info['tokenName'],
-        "tokenSymbol": token_info['tokenSymbol'],
-        "chains": token_info['chains']
+    result.update({"twitterLink": social_links['twitter'], "telegramLink": social_links['telegram']})
+    deadline.check()
+    return documents, crawl_hash
+
+
+def run_analysis_stages(url: str, taskid: str, deadline: Deadline, result: dict, documents, crawl_hash: str):
+    """
+    Vectorize, extract and score (embedding and LLM bound part of a job). The result dict is filled as the stages finish.
+    Every stage output is checkpointed, a re-run continues from the first incomplete stage.
+    """
+    checkpoint = load_stage(taskid, 'vectorize', crawl_hash)
+    if checkpoint is not None:
+        text_chunks, embeddings, vectors_hash = checkpoint
+        app.logger.info(f'[{taskid}] Chunks and embeddings restored from checkpoint. Chunk count: {len(text_chunks)}')
+    else:
+        text_chunks, embeddings = vectorize(documents, logger=app.logger, deadline=deadline)  # chunk documents and vectorize chunks
+        app.logger.info(f'[{taskid}] Project documentation chunked and vectorized. Chunk count: {len(text_chunks)}')
+        vectors_hash = save_stage(taskid, 'vectorize', text_chunks, crawl_hash, array=embeddings, deadline=deadline)
+    if not deadline.cancelled():
+        similarity_index.add_project(taskid, embeddings, app.logger)  # available for similar project queries right away
+    deadline.check()
+
+    # Retrieval for every prompt of the job in one pass, the extractors and agents read the ranked chunks
+    chunk_index = ChunkIndex(text_chunks, embeddings, normalized=True)  # vectorize returns unit length rows
+    chunk_index.prefetch(retrieval_prompts + [moonboy_prompt, strict_prompt])
+
+    # Extracting information (extractors run concurrently, only the prompt type decision waits for the memecoin status)
+    extraction_errors = {}
+    executor = ThreadPoolExecutor(max_workers=len(extractors), thread_name_prefix=f'extract-{taskid}')
+    extraction_futures = {}
+    for name in extractors:
+        checkpoint = load_stage(taskid, f'extract_{name}', vectors_hash)
+        if checkpoint is not None:
+            extraction_futures[name] = Future()
+            extraction_futures[name].set_result(checkpoint[0])
+    if len(extraction_futures) > 0:
+        app.logger.info(f'[{taskid}] Extractions restored from checkpoint: {list(extraction_futures)}')
+    started_futures = start_extractions(executor, url, text_chunks, chunk_index, app.logger, deadline=deadline,
+                                        names=[name for name in extractors if name not in extraction_futures])
+    extraction_futures.update(started_futures)
+    unsaved = set(started_futures)  # restored extractions are not saved again
+
+    def save_extraction(name: str, extracted):
+        if name in unsaved:
+            unsaved.discard(name)
+            save_extraction_stage(taskid, name, extracted, vectors_hash, deadline)
+
+    try:
+        is_memecoin = collect_extraction('memecoin', extraction_futures['memecoin'], app.logger, extraction_errors, deadline,
+                                         save_extraction)
+        app.logger.info(f'[{taskid}] Is it a memecoin? {is_memecoin}')
+        result["isMemecoin"] = is_memecoin
+
+        # Scoring
+        uses_meme = is_meme_season and is_memecoin  # Activates moonboy prompt if it's memecoin season
+        if uses_meme:
+            deadline.check()
+            meme_results = process_with_prompt_type(
+                url=url,
+                uses_meme=True,
+                text_chunks=text_chunks,
+                embeddings=chunk_index,
+                taskid=taskid,
+                deadline=deadline,
+                input_hash=vectors_hash
+            )
+            result.update(meme_results)
+
+        if ai_analysis:
+            deadline.check()
+            strict_results = process_with_prompt_type(
+                url=url,
+                uses_meme=False,
+                text_chunks=text_chunks,
+                embeddings=chunk_index,
+                taskid=taskid,
+                deadline=deadline,
+                input_hash=vectors_hash
+            )
+            result.update(
+                {
+                    "iteration": 1,
+                    "analyzed": True,
+                    **strict_results
+                }
+            )
+    finally:
+        # Collecting the remaining extractions (also when the time budget ran out, unfinished ones are dropped)
+        ### PDF related. Will be moved to a different endpoint. ###
+        # TODO details
+        # summary = get summary field from DB ?
+        # narrative = get category field from DB ?
+        # details = do the "product description extraction" with marketing maybe?
+        extracted, errors = collect_extractions(extraction_futures, app.logger, deadline, save_extraction)
+        executor.shutdown(wait=False)
+        extraction_errors.update(errors)
+        token_info = extracted['token']
+        app.logger.info(f'[{taskid}] Token info extracted: {token_info}')
+        app.logger.info(f'[{taskid}] Industry info extracted: {extracted["industry"]}')
+        app.logger.info(f'[{taskid}] Team info extracted: {extracted["team"]}')
+        app.logger.info(f'[{taskid}] Backers info extracted: {extracted["backers"]}')
+        app.logger.info(f'[{taskid}] Tokenomics info extracted: {extracted["tokenomics"]}')
+        app.logger.info(f'[{taskid}] Financials info extracted: {extracted["financials"]}')
+        app.logger.info(f'[{taskid}] Market info extracted: {extracted["market"]}')
+        if len(extraction_errors) > 0:
+            app.logger.warning(f'[{taskid}] Failed extractions: {extraction_errors}')
+        ### PDF related. Will be moved to a different endpoint. ###
+        result.update({"tokenName": token_info['tokenName'], "tokenSymbol": token_info['tokenSymbol'], "chains": token_info['chains']})
+
+
+def crawl_task(url: str, taskid: str, fresh: bool = False, cancel: threading.Event = None):
+    """ First part of a processing job. Returns the job state for analysis_task. """
+    if fresh:
+        db.clear_checkpoints(taskid)  # forced re-run, nothing is reused
+    state = {
+        'url': url,
+        'taskid': taskid,
+        'deadline': Deadline(task_time_budget, cancel),
+        'result': {
+            "iteration": 0,
+            "analyzed": False,
+        },
     }
+    try:
+        state['documents'], state['crawl_hash'] = run_crawl_stage(url, taskid, state['deadline'], state['result'])
+    except (DeadlineExceeded, JobCancelled) as e:
+        state['stopped'] = e
+    return state
+
+
+def analysis_task(state: dict):
+    """ Second part of a processing job, the results are saved even if the time budget ran out """
+    taskid = state['taskid']
+    result = state['result']
+    deadline = state['deadline']
+    try:
+        if 'stopped' in state:
+            raise state['stopped']
+        run_analysis_stages(state['url'], taskid, deadline, result, state['documents'], state['crawl_hash'])
+    except DeadlineExceeded as e:
+        # Finished stages are saved, the job is marked as done so clients stop waiting for it
+        app.logger.warning(f'[{taskid}] {e}. Saving partial results.')
+        result.update({"analyzed": True, "partial": True})
+    except JobCancelled:
+        pass  # handled below, a run can also be cancelled after its last stage check
+    if deadline.cancelled():
+        # A newer run of the project owns the results and the checkpoints
+        app.logger.warning(f'[{taskid}] Run cancelled, results are not saved.')
+        return
+
+    # Missing agents of an earlier partial run are removed once its prompt type completed.
+    # The iteration of a run stopped before scoring does not replace the one of an earlier run.
+    completed = [f'{prefix}missing_agents' for prefix in ('', 'meme_') if result.get(f'{prefix}partial') is False]
+    overwrite = [field for field in result_fields if field != 'iteration' or result['iteration'] > 0]
+    db.store(taskid, result, overwrite=overwrite, unset=completed)
+    app.logger.info(f'[{taskid}] Results saved in DB.')
 
-    if uses_meme:
-        result.update(meme_results)
-
-    if ai_analysis:
-        result.update(
-            {
-                "iteration": 1,
-                "analyzed": True,
-                **strict_results
-            }
-        )
+    # Checkpoints are kept only for incomplete runs, so the next run can finish them
+    if not any(value is True for key, value in result.items() if key.endswith('partial')):
+        db.clear_checkpoints(taskid)
 
-    db.store(taskid, result)
-    app.logger.info(f'[{taskid}] Results saved in DB.')
 
-    # Tracking active processing jobs
-    num_jobs -= 1
+def processing_task(url: str, taskid: str, fresh: bool = False, cancel: threading.Event = None):
+    analysis_task(crawl_task(url, taskid, fresh, cancel))
 
 
 @app.route('/score', methods=['POST'])
@@ -187,12 +377,67 @@ def score():
     if taskid is None:
         return jsonify('Project not found'), 404
 
-    # Start the async job
+    # Queue the async job (back-pressure if the worker pool is saturated)
     app.logger.info(f'[{taskid}] Starting to process: {url}')
-    thread = threading.Thread(target=processing_task, args=(url, taskid,))
-    thread.start()
+    # Requests for a project already in progress are attached to the running job, unless force is set
+    force = bool(request_data.get('force', False))
+    try:
+        if job_queue.job_backend == 'mongo':
+            queued = job_queue.submit_durable(taskid, url, app.logger, force=force)  # processed by worker.py
+        else:
+            queued = job_queue.submit(taskid, processing_task, (url, taskid, force,), app.logger, force=force)
+    except job_queue.QueueFullError as e:
+        app.logger.warning(f'[{taskid}] {e}')
+        return jsonify({'error': 'Too many scoring jobs, try again later'}), 429, {'Retry-After': str(e.retry_after)}
+
+    return jsonify({'taskid': taskid, 'attached': not queued}), 200
+
+
+@app.route('/score/batch', methods=['POST'])
+def score_batch():
+    """ Starting a batch of project processing jobs, executed as a crawl -> analysis pipeline """
+    request_data = request.get_json()
+    app.logger.info(f'Batch request arguments: {request_data}')
 
-    return jsonify({'taskid': taskid}), 200
+    projects = request_data.get('projects') if isinstance(request_data, dict) else None
+    if not isinstance(projects, list) or len(projects) == 0:
+        return jsonify('Missing argument'), 400
+    if any(not isinstance(p, dict) or not ('websiteUrl' in p or 'projectID' in p) for p in projects):
+        return jsonify('Missing argument'), 400
+    if len(projects) > batch.max_batch_size:
+        return jsonify({'error': f'Too many projects, the limit is {batch.max_batch_size}'}), 400
+
+    resolved = []
+    taskids = set()
+    for project in projects:
+        taskid, url = db.resolve_project(project, app.logger)
+        if taskid in taskids:
+            continue  # duplicated project in the batch
+        if taskid is not None:
+            taskids.add(taskid)
+        resolved.append((taskid, url))
+
+    try:
+        batch_id = batch.submit_batch(resolved, crawl_task, analysis_task, app.logger)
+    except job_queue.QueueFullError as e:
+        app.logger.warning(f'Batch rejected. {e}')
+        return jsonify({'error': 'Too many scoring jobs, try again later'}), 429, {'Retry-After': str(e.retry_after)}
+    return jsonify({'batchid': batch_id, 'taskids': [taskid for taskid, _ in resolved]}), 200
+
+
+@app.route('/score/batch/<batchid>', methods=['GET'])
+def score_batch_status(batchid):
+    """ Progress of a batch """
+    batch_info = db.get_batch(batchid)
+    if batch_info is None:
+        return jsonify({'error': 'Batch not found'}), 404
+
+    statuses = [item['status'] for item in batch_info['items']]
+    progress = {status: statuses.count(status) for status in set(statuses)}
+    is_finished = all(status in ('done', 'failed', 'cancelled', 'not_found') for status in statuses)
+    items = [{k: v for k, v in item.items() if k != 'updatedAt'} for item in batch_info['items']]
+
+    return jsonify({'batchid': batchid, 'isFinished': is_finished, 'total': len(statuses), 'progress': progress, 'items': items}), 200
 
 
 @app.route('/scorings/<taskid>', methods=['GET'])
@@ -215,6 +460,34 @@ def scorings(taskid):
     return jsonify({'isFinished': is_analyzed, 'scoringInfo': scoring_info}), 200
 
 
+@app.route('/projects/<taskid>/similar', methods=['GET'])
+def similar_projects(taskid):
+    """ Nearest projects by website content (level=project) or by shared near-identical text chunks (level=chunks) """
+    if db.check_taskid(taskid) is None:
+        return jsonify({'error': 'Task not found'}), 404
+    level = request.args.get('level', 'project')
+    try:
+        k = min(max(int(request.args.get('k', 10)), 1), 100)
+    except ValueError:
+        return jsonify('Invalid argument'), 400
+    if level not in ('project', 'chunks') or (level == 'chunks' and not similarity_index.index_chunks):
+        return jsonify('Invalid argument'), 400
+
+    if level == 'chunks':
+        found = similarity_index.find_shared_chunks(taskid, k)
+    else:
+        found = similarity_index.find_similar(taskid, k)
+    if found is None:
+        return jsonify({'error': 'Project is not indexed yet'}), 404
+
+    links = db.get_website_links([item[0] for item in found])
+    if level == 'chunks':
+        similar = [{'taskid': t, 'websiteLink': links.get(t), 'sharedChunks': count, 'sharedRatio': ratio} for t, count, ratio in found]
+    else:
+        similar = [{'taskid': t, 'websiteLink': links.get(t), 'similarity': round(similarity, 4)} for t, similarity in found]
+    return jsonify({'taskid': taskid, 'level': level, 'similar': similar}), 200
+
+
 @app.route('/memecoin-season', methods=['GET'])
 def memecoin_season():
     """ Estimates if it is memecoin season or not """
@@ -239,8 +512,16 @@ def memecoin_season():
 def status():
     """ Endpoint status """
     global isError
-    global num_jobs
-    return jsonify({'status': not isError, 'concurrent_jobs': num_jobs}), 200
+    queue_stats = job_queue.stats()
+    return jsonify({
+        'status': not isError,
+        'concurrent_jobs': queue_stats['running_jobs'],
+        **queue_stats,
+        'rate_limits': rate_limiter.saturation(),
+        'embedding_cache': get_cache_stats(),
+        'similarity_index': similarity_index.stats(),
+        'browser_pool': browser_pool.stats(),
+    }), 200
 
 
 if __name__ == '__main__':
@@ -0,0 +1,102 @@
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import database_connection as db
+import job_queue
+
+# Batch scoring pipeline. Crawling of the next projects overlaps with the embedding and LLM stages of the previous ones.
+with open('config.json', 'r') as file:
+    config = json.load(file)
+
+max_batch_size = min(config.get('MAX_BATCH_SIZE', job_queue.max_queue_size), job_queue.max_queue_size)  # a batch fits in the job queue
+batch_crawl_concurrency = config.get('BATCH_CRAWL_CONCURRENCY', 2)  # projects crawled at the same time (all batches)
+batch_analysis_concurrency = config.get('BATCH_ANALYSIS_CONCURRENCY', 2)  # projects vectorized and scored at the same time
+
+crawl_executor = ThreadPoolExecutor(max_workers=batch_crawl_concurrency, thread_name_prefix='batch-crawl')
+analysis_executor = ThreadPoolExecutor(max_workers=batch_analysis_concurrency, thread_name_prefix='batch-analysis')
+
+# Crawled projects waiting for analysis are kept in memory, this bounds how far crawling can run ahead
+pipeline_slots = threading.BoundedSemaphore(batch_crawl_concurrency + 2 * batch_analysis_concurrency)
+
+
+def _analysis_step(batch_id: str, job: dict, analysis_task, state, logger):
+    taskid = job['taskid']
+    status, error = 'failed', None
+    try:
+        db.update_batch_item(batch_id, taskid, 'analyzing')
+        analysis_task(state)
+        status = 'cancelled' if job['cancel'].is_set() else 'done'
+    except Exception as e:
+        logger.error(f'[{taskid}] Batch {batch_id} analysis failed: {e}')
+        error = str(e)
+    finally:
+        pipeline_slots.release()
+        db.update_batch_item(batch_id, taskid, status, error)
+        job_queue.finish_job(job, status, error)
+
+
+def _crawl_step(batch_id: str, job: dict, url: str, crawl_task, analysis_task, logger):
+    taskid = job['taskid']
+    pipeline_slots.acquire()
+    if not job_queue.start_job(job):
+        # Superseded by a forced request while waiting
+        pipeline_slots.release()
+        logger.info(f'[{taskid}] Batch {batch_id} job cancelled before it started.')
+        db.update_batch_item(batch_id, taskid, 'cancelled')
+        job_queue.finish_job(job, 'cancelled')
+        return
+    try:
+        db.update_batch_item(batch_id, taskid, 'crawling')
+        state = crawl_task(url, taskid, cancel=job['cancel'])
+        db.update_batch_item(batch_id, taskid, 'crawled')
+        analysis_executor.submit(_analysis_step, batch_id, job, analysis_task, state, logger)
+    except Exception as e:
+        pipeline_slots.release()
+        logger.error(f'[{taskid}] Batch {batch_id} crawl failed: {e}')
+        db.update_batch_item(batch_id, taskid, 'failed', str(e))
+        job_queue.finish_job(job, 'failed', str(e))
+
+
+def _attached(batch_id: str, taskid: str, logger):
+    logger.info(f'[{taskid}] Job already in progress, batch {batch_id} item attached to it.')
+    # Unless the job already finished and reported its status to the item
+    db.update_batch_item(batch_id, taskid, 'attached', current='queued')
+
+
+def _submit_durable_batch(projects: list, logger):
+    """ Batch of jobs in the Mongo job queue, processed by worker.py (which updates the batch items) """
+    job_queue.check_durable_capacity(len([taskid for taskid, _ in projects if taskid is not None]))
+    batch_id = db.create_batch(projects)
+    for taskid, url in projects:
+        if taskid is not None and not db.enqueue_job(taskid, url, batch_id=batch_id):
+            _attached(batch_id, taskid, logger)
+    return batch_id
+
+
+def submit_batch(projects: list, crawl_task, analysis_task, logger):
+    """
+    Start a batch of processing jobs. projects: list of (taskid, url), taskid is None for unknown projects.
+    crawl_task(url, taskid, cancel=...) returns the state passed to analysis_task(state). Returns the batch id.
+    Raises QueueFullError if the jobs do not fit in the job queue. Projects already in progress are not run again,
+    their batch item is attached to the job in progress and gets its final status.
+    """
+    if job_queue.job_backend == 'mongo':
+        batch_id = _submit_durable_batch(projects, logger)
+        logger.info(f'Batch {batch_id} stored in the durable queue. Project count: {len(projects)}')
+        return batch_id
+
+    batch_id = db.create_batch(projects)
+    try:
+        jobs = job_queue.admit_batch(batch_id, [taskid for taskid, _ in projects if taskid is not None], logger)
+    except job_queue.QueueFullError:
+        db.delete_batch(batch_id)
+        raise
+    logger.info(f'Batch {batch_id} created. Project count: {len(projects)}')
+    for taskid, url in projects:
+        if taskid is None:
+            continue
+        if jobs[taskid] is None:
+            _attached(batch_id, taskid, logger)
+        else:
+            crawl_executor.submit(_crawl_step, batch_id, jobs[taskid], url, crawl_task, analysis_task, logger)
+    return batch_id
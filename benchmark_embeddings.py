@@ -0,0 +1,73 @@
+import os
+import sys
+import glob
+import json
+import time
+import numpy as np
+from llm_connection import get_multiple_openai_embedding
+from local_embedding import get_local_embeddings, local_embedding_model
+from chunk_selection import normalize_rows, top_k_indices
+from extraction import retrieval_prompts
+from vectorize import split_documents
+
+# Compares the local embedding backend with OpenAI on recorded crawls: throughput and top-k overlap of the retrieval prompts.
+# Run: python benchmark_embeddings.py <fixture dir> [top_k]
+# Fixtures: one JSON file per project with the list of crawled documents (the data of its 'crawl' checkpoint).
+request_size = 256
+
+
+def embed(get_embeddings, texts: list):
+    """ Normalized embeddings and the seconds it took """
+    start = time.perf_counter()
+    rows = []
+    for i in range(0, len(texts), request_size):
+        response = get_embeddings(texts[i:i + request_size], None)
+        if response is None:
+            raise RuntimeError('Embedding failed')
+        rows.append(np.asarray(response, dtype=np.float32))
+    return normalize_rows(np.vstack(rows)), time.perf_counter() - start
+
+
+def rank(chunks, queries, top_k: int):
+    """ Ranked chunks of every retrieval prompt """
+    return top_k_indices(queries @ chunks.T, top_k)
+
+
+def main(fixture_dir: str, top_k: int = 10):
+    get_local_embeddings(['warm up'])  # model loading is not measured
+    totals = {'chunks': 0, 'openai': 0.0, 'local': 0.0}
+    overlaps = []
+    for path in sorted(glob.glob(os.path.join(fixture_dir, '*.json'))):
+        with open(path, 'r') as file:
+            documents = json.load(file)
+        chunks = split_documents(documents)
+        if len(chunks) == 0:
+            continue
+
+        openai_chunks, openai_seconds = embed(get_multiple_openai_embedding, chunks)
+        local_chunks, local_seconds = embed(get_local_embeddings, chunks)
+        openai_queries, _ = embed(get_multiple_openai_embedding, retrieval_prompts)
+        local_queries, _ = embed(get_local_embeddings, retrieval_prompts)
+
+        openai_ranked = rank(openai_chunks, openai_queries, top_k)
+        local_ranked = rank(local_chunks, local_queries, top_k)
+        k = openai_ranked.shape[1]
+        project_overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(openai_ranked, local_ranked)])
+        overlaps.append(project_overlap)
+
+        totals['chunks'] += len(chunks)
+        totals['openai'] += openai_seconds
+        totals['local'] += local_seconds
+        print(f'{os.path.basename(path)}: chunks {len(chunks)}; openai {len(chunks) / openai_seconds:.1f} chunks/s; '
+              f'local {len(chunks) / local_seconds:.1f} chunks/s; top-{top_k} overlap {project_overlap:.2f}')
+
+    if len(overlaps) == 0:
+        print('No fixtures found.')
+        return
+    print(f'Total ({len(overlaps)} projects, {totals["chunks"]} chunks, local model {local_embedding_model}): '
+          f'openai {totals["chunks"] / totals["openai"]:.1f} chunks/s; local {totals["chunks"] / totals["local"]:.1f} chunks/s; '
+          f'mean top-{top_k} overlap {np.mean(overlaps):.2f}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 10)
@@ -0,0 +1,58 @@
+import os
+import sys
+import glob
+import time
+from bs4 import BeautifulSoup
+from html_extractor import extract, extractors, skipped_tags
+import crawler_api
+import crawler_debug
+
+# Compares the HTML extractors on saved pages: extraction time and parity of the page texts of both crawlers
+# with the former BeautifulSoup output (html.parser soup without the skipped tags).
+# Run: python benchmark_html_extraction.py <pages dir>
+# Pages: .html files of crawled project websites (UTF-8).
+
+
+def reference_page(html: str):
+    soup = BeautifulSoup(html, 'html.parser')
+    hrefs = [a.get('href') for a in soup.find_all('a')]
+    for element in soup.find_all(skipped_tags):
+        element.decompose()
+    return {'texts': [p.text for p in soup.find_all(string=True)], 'hrefs': [h for h in hrefs if h is not None]}
+
+
+def normalized(text: str):
+    return ' '.join(text.split())
+
+
+def main(pages_dir: str):
+    pages = []
+    for path in sorted(glob.glob(os.path.join(pages_dir, '**', '*.html'), recursive=True)):
+        with open(path, 'r', encoding='utf-8', errors='replace') as file:
+            pages.append(file.read())
+    if len(pages) == 0:
+        print('No pages found.')
+        return
+    size = sum(len(p) for p in pages) / 1e6
+    print(f'{len(pages)} pages, {size:.1f}M characters')
+
+    references = [reference_page(p) for p in pages]
+    for engine in extractors:
+        start = time.perf_counter()
+        extracted = [extract(p, engine) for p in pages]
+        seconds = time.perf_counter() - start
+
+        counts = {'links': 0, 'api': 0, 'api_normalized': 0, 'debug': 0, 'debug_normalized': 0}
+        for page, reference in zip(extracted, references):
+            counts['links'] += page['hrefs'] == reference['hrefs']
+            for name, page_to_text in (('api', crawler_api.page_to_text), ('debug', crawler_debug.page_to_text)):
+                text, expected = page_to_text(page), page_to_text(reference)
+                counts[name] += text == expected
+                counts[name + '_normalized'] += normalized(text) == normalized(expected)
+        print(f'{engine}: {seconds:.2f} s ({len(pages) / seconds:.0f} pages/s); same links {counts["links"]}/{len(pages)}; '
+              f'same text (crawler_api) {counts["api"]}, whitespace normalized {counts["api_normalized"]}; '
+              f'same text (crawler_debug) {counts["debug"]}, whitespace normalized {counts["debug_normalized"]}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1])
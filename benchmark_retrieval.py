@@ -0,0 +1,60 @@
+import sys
+import time
+import numpy as np
+import chunk_selection
+from chunk_selection import ChunkIndex, normalize_rows, context_candidates
+
+# Compares the former retrieval (cosine similarity of the list of embeddings and a full argsort for every prompt)
+# with the ChunkIndex of a job (matrix normalized once, all prompts ranked with one multiplication and argpartition).
+# Run: python benchmark_retrieval.py [chunk counts, default 5000 20000 50000]
+# Random vectors stand in for the embeddings, the query embeddings are not requested from the embedding service.
+dim = 1536
+prompt_count = 10  # retrieval prompts of the extractors and the scoring prompts of a job
+
+
+def former_similarities(query, embeddings):
+    """ sklearn cosine_similarity of the former get_project_context (numpy equivalent without scikit-learn) """
+    try:
+        from sklearn.metrics.pairwise import cosine_similarity
+    except ImportError:
+        matrix = normalize_rows(np.asarray(embeddings, dtype=np.float64))
+        return matrix @ (np.asarray(query, dtype=np.float64) / np.linalg.norm(query))
+    return cosine_similarity([query], embeddings)[0]
+
+
+def former_search(queries: dict, embeddings, top_k: int):
+    return {prompt: np.argsort(former_similarities(query, embeddings))[::-1][:top_k] for prompt, query in queries.items()}
+
+
+def index_search(queries: dict, embeddings, top_k: int):
+    index = ChunkIndex([''] * len(embeddings), embeddings)
+    index.prefetch(list(queries), top_k)
+    return {prompt: index.search(prompt, top_k) for prompt in queries}
+
+
+def timed(search, queries: dict, embeddings, top_k: int):
+    start = time.perf_counter()
+    ranked = search(queries, embeddings, top_k)
+    return ranked, time.perf_counter() - start
+
+
+def main(chunk_counts: list):
+    rng = np.random.default_rng(0)
+    queries = {f'prompt {i}': rng.standard_normal(dim).astype(np.float32) for i in range(prompt_count)}
+    chunk_selection.get_query_embedding = queries.get
+    top_k = context_candidates
+    print(f'{prompt_count} prompts, {dim}-d embeddings, top {top_k} chunks per prompt')
+    for count in chunk_counts:
+        matrix = rng.standard_normal((count, dim)).astype(np.float32)
+        embeddings = matrix.tolist()  # embeddings of the vectorize stage before the float32 matrix
+        expected, former_seconds = timed(former_search, queries, embeddings, top_k)
+        ranked_list, list_seconds = timed(index_search, queries, embeddings, top_k)
+        ranked_array, array_seconds = timed(index_search, queries, matrix, top_k)
+        same = all(np.array_equal(expected[p], ranked_list[p]) and np.array_equal(expected[p], ranked_array[p]) for p in queries)
+        print(f'{count} chunks: former {former_seconds:.2f} s; ChunkIndex {list_seconds:.2f} s (list input), '
+              f'{array_seconds:.2f} s (float32 array input); speedup {former_seconds / list_seconds:.1f}x, '
+              f'{former_seconds / array_seconds:.1f}x; same top-{top_k} {same}')
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [5000, 20000, 50000])
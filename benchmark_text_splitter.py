@@ -0,0 +1,89 @@
+import os
+import sys
+import glob
+import time
+import random
+import subprocess
+from text_splitter import RecursiveTextSplitter
+
+# Compares RecursiveTextSplitter with langchain's RecursiveCharacterTextSplitter (the former splitter of vectorize):
+# import time of each module in a fresh interpreter, chunking throughput and parity of the chunks.
+# Run: python benchmark_text_splitter.py [documents dir]
+# Documents: .txt files of crawled project websites (UTF-8). Without a directory, generated pages are split.
+# The langchain columns need langchain installed (the chunks are pinned against langchain 0.1.7 in tests/test_text_splitter.py).
+chunk_size = 1500  # char_per_chunk of vectorize (not imported, it connects to the database)
+chunk_overlap = int(0.2 * chunk_size)
+page_count = 200
+page_length = 50000
+words = ['token', 'staking', 'rewards', 'liquidity', 'the', 'of', 'DAO', 'governance', 'audit', 'roadmap', 'bridge',
+         'NFT', 'holders', 'vesting', 'team', 'burn', 'is', 'mainnet', 'launch', 'to', 'moon']
+separators = [' '] * 12 + ['  ', '\n', '\n\n', '\n\n\n', '\t']
+imports = {
+    'text_splitter': 'from text_splitter import RecursiveTextSplitter',
+    'langchain': 'from langchain.text_splitter import RecursiveCharacterTextSplitter',
+}
+
+
+def generated_pages():
+    rng = random.Random(0)
+    pages = []
+    for _ in range(page_count):
+        parts = []
+        total = 0
+        while total < page_length:
+            part = rng.choice(words) + rng.choice(separators)
+            parts.append(part)
+            total += len(part)
+        pages.append(''.join(parts))
+    return pages
+
+
+def import_seconds(statement: str):
+    """ Import time in a fresh interpreter (None if the module is not installed) """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', statement], capture_output=True)
+    seconds = time.perf_counter() - start
+    return seconds if result.returncode == 0 else None
+
+
+def timed(splitter, documents):
+    start = time.perf_counter()
+    chunks = list(splitter.split_documents(documents))
+    return chunks, time.perf_counter() - start
+
+
+def main(documents_dir: str = None):
+    if documents_dir is None:
+        documents = generated_pages()
+    else:
+        documents = []
+        for path in sorted(glob.glob(os.path.join(documents_dir, '**', '*.txt'), recursive=True)):
+            with open(path, 'r', encoding='utf-8', errors='replace') as file:
+                documents.append(file.read())
+    if len(documents) == 0:
+        print('No documents found.')
+        return
+    size = sum(len(d) for d in documents) / 1e6
+    print(f'{len(documents)} documents, {size:.1f}M characters, chunk size {chunk_size}, overlap {chunk_overlap}')
+
+    baseline = import_seconds('pass')
+    for name, statement in imports.items():
+        seconds = import_seconds(statement)
+        print(f'import {name}: ' + ('not installed' if seconds is None else f'{max(0.0, seconds - baseline):.2f} s'))
+
+    chunks, seconds = timed(RecursiveTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap), documents)
+    print(f'text_splitter: {seconds:.2f} s ({size / seconds:.1f}M characters/s), {len(chunks)} chunks')
+    try:
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+    except ImportError:
+        return
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    start = time.perf_counter()
+    expected = [document.page_content for document in splitter.create_documents(documents)]
+    langchain_seconds = time.perf_counter() - start
+    print(f'langchain: {langchain_seconds:.2f} s ({size / langchain_seconds:.1f}M characters/s), {len(expected)} chunks; '
+          f'speedup {langchain_seconds / seconds:.1f}x; same chunks {chunks == expected}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
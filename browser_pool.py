@@ -0,0 +1,135 @@
+import json
+import queue
+import threading
+from contextlib import contextmanager
+from selenium import webdriver
+from selenium.webdriver.chrome.service import Service as ChromeService
+from selenium_stealth import stealth
+
+# Headless Chrome instances shared by the crawls of crawler_debug. Every crawl gets its own tab,
+# crashed browsers are detected when they are leased or returned and replaced.
+with open('config.json', 'r') as file:
+    config = json.load(file)
+
+browser_pool_size = config.get('BROWSER_POOL_SIZE', 2)  # browsers (and crawls at the same time)
+page_load_timeout = config.get('PAGE_LOAD_TIMEOUT', 30)  # seconds
+browser_max_crawls = config.get('BROWSER_MAX_CRAWLS', 50)  # a browser is restarted after this many crawls (memory growth)
+
+
+def create_driver():
+    """ Start headless browser (stealthy as fuck) """
+    service = ChromeService()  # currently broken, install latest: executable_path=ChromeDriverManager().install()
+
+    options = webdriver.ChromeOptions()
+    options.add_argument("--headless")  # run in headless mode
+    options.add_argument('--disable-blink-features=AutomationControlled')
+    options.add_argument('--disable-popup-blocking')  # disable pop-up blocking
+    options.add_argument('--start-maximized')  # start the browser window in maximized mode
+    options.add_argument('--disable-extensions')  # disable extensions
+    options.add_argument('--no-sandbox')  # disable sandbox mode
+    options.add_argument('--disable-dev-shm-usage')  # disable shared memory usage
+
+    driver = webdriver.Chrome(service=service, options=options)
+    driver.set_page_load_timeout(page_load_timeout)
+    return driver
+
+
+def apply_stealth(driver):
+    """ Patches of the current tab (new documents of the tab are patched as well) """
+    driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
+
+    # TODO: rotate user agent if needed (https://www.zenrows.com/blog/selenium-stealth#scrape-with-stealth)
+
+    stealth(driver, languages=["en-US", "en"], vendor="Google Inc.", platform="Win32", webgl_vendor="Intel Inc.",
+            renderer="Intel Iris OpenGL Engine", fix_hairline=True)
+
+
+class BrowserPool:
+    def __init__(self, size: int):
+        self.size = size
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = queue.LifoQueue()  # most recently used (warm) browser first
+        self.lock = threading.Lock()
+        self.alive = 0
+        self.in_use = 0
+        self.created = 0
+        self.recycled = 0
+
+    @staticmethod
+    def _healthy(driver):
+        try:
+            driver.window_handles  # fails if the browser or its session is gone
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, entry: dict):
+        try:
+            entry['driver'].quit()
+        except Exception:
+            pass
+        with self.lock:
+            self.alive -= 1
+            self.recycled += 1
+
+    def _checkout(self):
+        """ Healthy idle browser or a new one (called with a slot held) """
+        while True:
+            try:
+                entry = self.idle.get_nowait()
+            except queue.Empty:
+                entry = {'driver': create_driver(), 'crawls': 0}
+                with self.lock:
+                    self.alive += 1
+                    self.created += 1
+                return entry
+            if self._healthy(entry['driver']):
+                return entry
+            self._discard(entry)
+
+    @staticmethod
+    def _reset(driver, base_handle):
+        """ Close the tabs of the crawl and drop its cookies. False if the browser crashed. """
+        if base_handle is None:
+            return False
+        try:
+            for handle in driver.window_handles:
+                if handle != base_handle:
+                    driver.switch_to.window(handle)
+                    driver.close()
+            driver.switch_to.window(base_handle)
+            driver.delete_all_cookies()
+            return True
+        except Exception:
+            return False
+
+    @contextmanager
+    def browser(self):
+        """ Lease a browser for a crawl, the crawl works in a new tab. Blocks while all browsers are in use. """
+        with self.slots:
+            entry = self._checkout()
+            driver = entry['driver']
+            base_handle = None
+            with self.lock:
+                self.in_use += 1
+            try:
+                base_handle = driver.current_window_handle
+                driver.switch_to.new_window('tab')
+                apply_stealth(driver)
+                yield driver
+            finally:
+                with self.lock:
+                    self.in_use -= 1
+                entry['crawls'] += 1
+                if entry['crawls'] < browser_max_crawls and self._reset(driver, base_handle):
+                    self.idle.put(entry)
+                else:
+                    self._discard(entry)
+
+    def stats(self):
+        with self.lock:
+            return {'size': self.size, 'browsers': self.alive, 'in_use': self.in_use,
+                    'created': self.created, 'recycled': self.recycled}
+
+
+browser_pool = BrowserPool(browser_pool_size)
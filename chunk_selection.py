@@ -1,18 +1,170 @@
-from vectorize import vectorize
-from sklearn.metrics.pairwise import cosine_similarity
+import json
+import warnings
+import threading
 import numpy as np
+import tiktoken
+from embedding_cache import get_query_embedding
+from rate_limiter import estimate_tokens
 
+# Context assembly: the most relevant chunks are added until the token budget is filled,
+# chunks nearly identical to already selected ones are penalized (maximal marginal relevance)
+with open('config.json', 'r') as file:
+    config = json.load(file)
 
-def get_project_context(text_chunks, embeddings, prompt, top_k=10):
+context_token_budget = config.get('CONTEXT_TOKEN_BUDGET', 5000)  # tokens of retrieved text per extraction prompt
+scoring_context_token_budget = config.get('SCORING_CONTEXT_TOKEN_BUDGET', 12000)  # tokens of retrieved text per scoring prompt
+context_candidates = config.get('CONTEXT_CANDIDATES', 60)  # most relevant chunks considered for a context
+context_mmr_lambda = config.get('CONTEXT_MMR_LAMBDA', 0.7)  # 1: relevance only, lower values prefer diverse chunks
+separator = '\n-----\n'
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def count_tokens(text: str):
+    """ Token count with the tokenizer of the OpenAI models (estimate if the encoding can not be loaded) """
+    global _encoding
+    with _encoding_lock:
+        if _encoding is None:
+            try:
+                _encoding = tiktoken.get_encoding('cl100k_base')
+            except Exception:
+                _encoding = False
+    if _encoding is False:
+        return estimate_tokens(text)
+    return len(_encoding.encode(text, disallowed_special=()))
+
+
+def normalize_rows(matrix):
+    """ Unit length rows (cosine similarity becomes a dot product) """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def top_k_indices(scores, top_k: int):
+    """ Indices of the top_k highest scores for every row, best first. argpartition avoids a full sort. """
+    k = min(top_k, scores.shape[1])
+    if k < scores.shape[1]:
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        candidates = np.tile(np.arange(scores.shape[1]), (scores.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=1)
+
+
+class ChunkIndex:
+    """
+    Retrieval over the chunks of one project. The embedding matrix is normalized once,
+    the retrieval prompts of a job are scored together with a single matrix multiplication (prefetch).
+    """
+    def __init__(self, text_chunks, embeddings, normalized: bool = False):
+        self.text_chunks = text_chunks
+        self.matrix = None
+        if len(text_chunks) > 0:
+            matrix = np.asarray(embeddings, dtype=np.float32)  # no copy for the float32 matrix of vectorize
+            self.matrix = matrix if normalized else normalize_rows(matrix)
+        self.ranked = {}  # prompt -> chunk indices (best first)
+        self.queries = {}  # prompt -> normalized query embedding, reused by the MMR selection
+        self.token_counts = {}  # chunk index -> tokens, chunks are shared by the contexts of a job
+
+    def prefetch(self, prompts: list, top_k: int = context_candidates):
+        """ Rank the chunks for every prompt at once """
+        if self.matrix is None:
+            return
+        prompts = [p for p in dict.fromkeys(prompts) if p not in self.ranked]
+        query_embeddings = [get_query_embedding(p) for p in prompts]
+        prompts = [p for p, q in zip(prompts, query_embeddings) if q is not None]
+        if len(prompts) == 0:
+            return
+        queries = normalize_rows(np.asarray([q for q in query_embeddings if q is not None], dtype=np.float32))
+        indices = top_k_indices(queries @ self.matrix.T, top_k)
+        self.queries.update(zip(prompts, queries))
+        self.ranked.update(zip(prompts, indices))
+
+    def query(self, prompt: str):
+        """ Normalized query embedding of the prompt, None if it could not be embedded """
+        if prompt not in self.queries:
+            query = get_query_embedding(prompt)  # cached, the retrieval prompts are the same for every project
+            if query is None:
+                return None
+            self.queries[prompt] = normalize_rows(np.asarray([query], dtype=np.float32))[0]
+        return self.queries[prompt]
+
+    def search(self, prompt: str, top_k: int = 10):
+        """ Indices of the top_k chunks, None if the prompt could not be embedded """
+        ranked = self.ranked.get(prompt)
+        if ranked is None or (len(ranked) < top_k and len(ranked) < len(self.text_chunks)):
+            query = self.query(prompt)
+            if query is None:
+                return None
+            ranked = top_k_indices(query[np.newaxis] @ self.matrix.T, top_k)[0]
+        return ranked[:top_k]
+
+    def chunk_tokens(self, i: int):
+        if i not in self.token_counts:
+            self.token_counts[i] = count_tokens(self.text_chunks[i])
+        return self.token_counts[i]
+
+    def select(self, prompt: str, token_budget: int, candidates: int = context_candidates, mmr_lambda: float = context_mmr_lambda):
+        """
+        Indices of the chunks filling token_budget, picked by maximal marginal relevance among the candidates.
+        None if the prompt could not be embedded.
+        """
+        ranked = self.search(prompt, candidates)
+        query = self.query(prompt) if ranked is not None else None  # the vector of prefetch or search
+        if query is None:
+            return None
+        vectors = self.matrix[ranked]
+        relevance = vectors @ query
+        similarity = vectors @ vectors.T
+        redundancy = np.zeros(len(ranked), dtype=np.float32)  # max similarity to the selected chunks
+        available = np.ones(len(ranked), dtype=bool)
+        separator_tokens = count_tokens(separator)
+        selected = []
+        used = 0
+        while available.any():
+            scores = np.where(available, mmr_lambda * relevance - (1 - mmr_lambda) * redundancy, -np.inf)
+            best = int(np.argmax(scores))
+            available[best] = False
+            tokens = self.chunk_tokens(ranked[best]) + separator_tokens
+            if used + tokens > token_budget:
+                continue  # a shorter chunk may still fit
+            selected.append(int(ranked[best]))
+            used += tokens
+            redundancy = np.maximum(redundancy, similarity[best])
+        return selected
+
+
+def get_project_context(text_chunks, embeddings, prompt, top_k: int = None, token_budget: int = context_token_budget, logger=None):
+    """
+    embeddings: chunk embedding vectors or the ChunkIndex of the job.
+    top_k is deprecated: the top_k most relevant chunks are joined whatever their size (former behaviour), use token_budget.
+    """
     if len(text_chunks) == 0:
         return 'No document was scrapped. Score accordingly!'
 
-    _, prompt_emb = vectorize([prompt], chunk_size=99999)
+    index = embeddings if isinstance(embeddings, ChunkIndex) else ChunkIndex(text_chunks, embeddings)
+    if top_k is not None:
+        warnings.warn('get_project_context top_k is deprecated, use token_budget', DeprecationWarning, stacklevel=2)
+        top_indices = index.search(prompt, top_k)
+        if top_indices is None:
+            top_indices = range(min(top_k, len(text_chunks)))  # embedding service unavailable, unranked chunks
+        return separator.join(text_chunks[i] for i in top_indices)
 
-    similarities = cosine_similarity(prompt_emb, embeddings)[0]
-    sorted_indices = np.argsort(similarities)[::-1]
+    top_indices = index.select(prompt, token_budget)
+    if top_indices is None:
+        # embedding service unavailable, unranked chunks
+        top_indices = []
+        used = 0
+        for i in range(len(text_chunks)):
+            used += index.chunk_tokens(i)
+            if used > token_budget:
+                break
+            top_indices.append(i)
 
-    top_indices = sorted_indices[:top_k]
-    top_chunks = [text_chunks[i] for i in top_indices]
+    project_context = separator.join(text_chunks[i] for i in top_indices)
+    if logger is not None:
+        logger.info(f'Context assembled. Chunks: {len(top_indices)}; prompt tokens: {count_tokens(prompt + project_context)}')
 
-    return '\n-----\n'.join(top_chunks)
+    return project_context
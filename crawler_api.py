@@ -1,9 +1,14 @@
 import time
 import json
+import asyncio
 import requests
-from bs4 import BeautifulSoup
+import httpx
+from urllib.parse import urlparse
 from typing import List
 from socials import get_social_urls
+from html_extractor import extract
+from near_duplicates import ContentIndex
+import page_cache
 
 # Scrapping API uri (to parallelize calls)
 with open('config.json', 'r') as file:
@@ -11,6 +16,12 @@ with open('config.json', 'r') as file:
 
 scrapping_api = config["SCRAPPING_API"]
 scrape_header = {'Content-Type': 'application/json'}
+scrape_timeout = config.get('SCRAPE_TIMEOUT', 120)
+
+# Link collection frontier: hosts are crawled in parallel, politeness is kept per host
+crawl_concurrency = config.get('CRAWL_CONCURRENCY', 4)  # scrape_soup requests in flight per crawl
+crawl_host_concurrency = config.get('CRAWL_HOST_CONCURRENCY', 8)  # pages of one host fetched at the same time (URLs per scrape_soup call)
+crawl_host_delay = config.get('CRAWL_HOST_DELAY', 0.5)  # seconds between the requests to the same host
 
 url_tabu_patterns = [
     'twitter', 'facebook', 'youtube', 'discord', 'instagram',
@@ -31,21 +42,53 @@ def tabu_check_url(url: str):
     return True
 
 
-def scrape_soups(urls: List[str], logger):
-    """ Get bs4 soups fom a list of pages """
+def scrape_pages(urls: List[str], logger):
+    """ Get the text segments and links of a list of pages (html of the scrape_soup endpoint) """
     try:
         response = requests.post(f'{scrapping_api}scrape_soup', headers=scrape_header, json={'urls': urls})
-        return [BeautifulSoup(t, "html.parser") for t in response.json()['texts']]
+        return [extract(t) for t in response.json()['texts']]
+    except Exception as e:
+        logger.error(f'Scrape API error! {e}')
+        return [extract('') for _ in urls]
+
+
+async def ascrape_pages(client: httpx.AsyncClient, urls: List[str], logger):
+    """ Get the text segments and links of a list of pages (async) """
+    try:
+        response = await client.post(f'{scrapping_api}scrape_soup', headers=scrape_header, json={'urls': urls})
+        return [extract(t) for t in response.json()['texts']]
     except Exception as e:
         logger.error(f'Scrape API error! {e}')
-        return [BeautifulSoup('', "html.parser")] * len(urls)
+        return [extract('') for _ in urls]
+
+
+async def scrape_host(client: httpx.AsyncClient, urls: List[str], limit: asyncio.Semaphore, pages: dict, logger):
+    """ Pages of one host in batches of crawl_host_concurrency, batch starts are crawl_host_delay apart """
+    last_start = None
+    for i in range(0, len(urls), crawl_host_concurrency):
+        batch = urls[i:i + crawl_host_concurrency]
+        if last_start is not None:
+            await asyncio.sleep(max(0.0, last_start + crawl_host_delay - time.monotonic()))
+        async with limit:
+            last_start = time.monotonic()
+            pages.update(zip(batch, await ascrape_pages(client, batch, logger)))
 
 
-def soup_to_text(soup):
-    """ Extract text from bs4 soup """
-    paragraphs = soup.find_all(text=True)
+async def scrape_frontier(urls: List[str], logger):
+    """ Extracted pages by URL. Crawl time is about the slowest batch of the busiest host, not the sum of the pages. """
+    hosts = {}
+    for url in urls:
+        hosts.setdefault(urlparse(url).netloc, []).append(url)
+    limit = asyncio.Semaphore(crawl_concurrency)
+    pages = {}
+    async with httpx.AsyncClient(timeout=scrape_timeout) as client:
+        await asyncio.gather(*(scrape_host(client, host_urls, limit, pages, logger) for host_urls in hosts.values()))
+    return pages
 
-    texts = [p.text for p in paragraphs if len(p.text) > 1]  # Filter short texts
+
+def page_to_text(page: dict):
+    """ Text of an extracted page """
+    texts = [t for t in page['texts'] if len(t) > 1]  # Filter short texts
 
     # Concat text segments
     if len(texts) > 1:
@@ -65,18 +108,12 @@ def format_url(url: str):
     return url.rstrip('/')
 
 
-def get_links(url: str, logger):
-    """ Get all page and document links from a given URL """
+def extract_links(url: str, page: dict):
+    """ Page and document links of a page """
     links = []
     documents = []
 
-    soup = scrape_soups([url], logger)[0]
-    for link in soup.find_all('a'):
-        href = link.get('href')
-
-        if href is None:
-            continue
-
+    for href in page['hrefs']:
         if 'http' not in href:
             href = url + href
 
@@ -85,7 +122,14 @@ def get_links(url: str, logger):
         else:
             links.append(format_url(href))
 
-    return links, documents, soup
+    return links, documents
+
+
+def get_links(url: str, logger):
+    """ Get all page and document links from a given URL """
+    page = scrape_pages([url], logger)[0]
+    links, documents = extract_links(url, page)
+    return links, documents, page
 
 
 def scrape_text(urls: List[str], logger):
@@ -100,19 +144,19 @@ def scrape_text(urls: List[str], logger):
 
 def crawl(url: str, logger):
     # Collect page and document links related to the input URL
-    visited = set(url)
+    visited = {url}
     document_url_list = []
     level_1 = []
     level_2 = []
-    soups = {}
+    pages = {}
 
     # Extract main page links
-    page_links, document_urls, soup = get_links(url, logger)
+    page_links, document_urls, page = get_links(url, logger)
     social_links = get_social_urls(page_links)  # Eg.: twitter and telegram links
     document_url_list.extend(document_urls)
     level_1.extend([link for link in page_links if (link not in visited) and tabu_check_url(link)])
-    if soup is not None:
-        soups[url] = soup
+    if page is not None:
+        pages[url] = page
 
     # Extract further links from connected pages
     def keep_url(url_: str):
@@ -121,17 +165,18 @@ def crawl(url: str, logger):
         is_type = ("docs" in url_) or ("blog" in url_)
         return is_visited and is_tabu and is_type
 
-    for current_url in level_1:
-        if ("docs" not in current_url) and ("blog" not in current_url):
-            continue  # Scrape only the project technical documentation and blog in 2 level depth
-        if current_url not in visited:
-            visited.add(current_url)
-            page_links, document_urls, soup = get_links(current_url, logger)
-            document_url_list.extend(document_urls)
-            level_2.extend([link for link in page_links if keep_url(link)])
-            if soup is not None:
-                soups[current_url] = soup
-        time.sleep(1)  # Getting the first level soups(=texts) is the most important! Don't overscrape!
+    # Scrape only the project technical documentation and blog in 2 level depth (fetched concurrently)
+    frontier = [u for u in dict.fromkeys(level_1) if (("docs" in u) or ("blog" in u)) and u not in visited]
+    visited.update(frontier)
+    frontier_pages = asyncio.run(scrape_frontier(frontier, logger))
+    for current_url in frontier:
+        page = frontier_pages.get(current_url)
+        if page is None:
+            continue
+        page_links, document_urls = extract_links(current_url, page)
+        document_url_list.extend(document_urls)
+        level_2.extend([link for link in page_links if keep_url(link)])
+        pages[current_url] = page
 
     # Select URL-s to send for scrape API
     document_url_list = set(document_url_list)  # deduplication
@@ -141,29 +186,39 @@ def crawl(url: str, logger):
     logger.info(f'Level 1: {len(level_1)} - {level_1}')
     logger.info(f'Level 2: {len(level_2)} - {level_2}')
 
-    url_set = set(url).union(document_url_list).union(level_1).union(level_2)  # deduplication
+    url_set = {url}.union(document_url_list).union(level_1).union(level_2)  # deduplication
     logger.info(f'All collected URL: {len(url_set)}')
 
-    urls_to_scrape = [u for u in url_set if u not in soups.keys()]
+    urls_to_scrape = [u for u in url_set if u not in pages.keys()]
     logger.info(f'URLs to send scrape API: {len(urls_to_scrape)}')
 
+    # Re-crawls: unchanged pages (304 or same body hash) are not scraped again
+    cached_texts, validators = asyncio.run(page_cache.aprobe_all(urls_to_scrape))
+    page_cache.log_usage({'hits': len(cached_texts), 'misses': len(urls_to_scrape) - len(cached_texts)}, logger)
+    urls_to_scrape = [u for u in urls_to_scrape if u not in cached_texts]
+
     # Start scrape job. Save results in dictionary.
     scraped_texts = scrape_text(urls=urls_to_scrape, logger=logger)
     scraped_texts_dict = dict(zip(urls_to_scrape, scraped_texts))
+    for u, text in scraped_texts_dict.items():
+        if u in validators:
+            page_cache.store(u, text, validators[u])
+    scraped_texts_dict.update(cached_texts)
 
     # Create dictionary for urls and the parsed text of the url
     texts_dict = {u: '' for u in url_set}
-    control_text_list = []  # helper for deduplication
+    seen = ContentIndex()  # deduplication (normalized text digests, near-duplicates if enabled)
     for u in url_set:
-        if u in soups.keys():
-            # logger.info(f'{u} is from /scrape_soup endpoint! Stored bs4 soup from link collection.')
-            content = soup_to_text(soup)
+        if u in pages.keys():
+            # logger.info(f'{u} is from /scrape_soup endpoint! Stored page from link collection.')
+            content = page_to_text(pages.pop(u))
         else:
             # logger.info(f'{u} is from /scrape endpoint!')
             content = scraped_texts_dict[u]
-        if (len(content) > 0) and (content not in control_text_list):
-            control_text_list.append(content)
+        kind = 'documents' if u in document_url_list else 'pages'
+        if (len(content) > 0) and seen.add(content, kind):
             texts_dict[u] = f"The following text is from {u}:\n{content}"
+    seen.log_dropped(logger)
 
     texts = [t for t in texts_dict.values() if len(t) > 0]  # drop uninformative
     logger.info(f'Parsed URLs with information: {len(texts)}')
@@ -1,19 +1,23 @@
 import json
 import time
+import asyncio
 import requests
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service as ChromeService
-from selenium_stealth import stealth
-from bs4 import BeautifulSoup
+from selenium.webdriver.support.ui import WebDriverWait
 import fitz  # PyMuPDF
 import random
 from socials import get_social_urls
+from browser_pool import browser_pool, page_load_timeout, apply_stealth
+from html_extractor import extract
+from near_duplicates import ContentIndex
+import page_cache
 
 # Scrapping API uri (to parallelize calls)
 with open('config.json', 'r') as file:
     config = json.load(file)
 
 scrapping_api = config["SCRAPPING_API"]
+crawl_tabs = config.get('BROWSER_CRAWL_TABS', 4)  # pages of a crawl rendered at the same time (tabs of its browser)
+tab_poll_interval = 0.2  # seconds between the readyState checks of the tabs
 
 url_tabu_patterns = [
     'twitter', 'facebook', 'youtube', 'discord', 'instagram',
@@ -34,25 +38,83 @@ def tabu_check_url(url: str):
     return True
 
 
-def get_soup(driver, url: str, no_driver=False):
-    """ Scraping with or without Selenium driver """
+def get_page(driver, url: str, no_driver=False):
+    """ Scraping with or without Selenium driver: text segments and links of the page """
     if no_driver:
         # Used as a fallback if selenium fails
-        response = requests.get(url)
+        response = requests.get(url, timeout=page_load_timeout)
         source = response.text
     else:
-        driver.get(url)
-        while driver.execute_script("return document.readyState") != "complete":
-            pass
+        driver.get(url)  # returns on the load event, raises after the page load timeout
+        WebDriverWait(driver, page_load_timeout, poll_frequency=0.2).until(
+            lambda d: d.execute_script("return document.readyState") == "complete")
         source = driver.page_source
-    return BeautifulSoup(source, "html.parser")
+    return extract(source)
 
 
-def soup_to_text(soup):
-    """ Extract text from bs4 soup """
-    paragraphs = soup.find_all(text=True)
+def render_pages(driver, urls: list, logger):
+    """
+    Render pages in parallel tabs of the crawl's browser, up to crawl_tabs at the same time. Navigations are started
+    from a script (it does not wait for the load), the tabs are polled until their document is complete.
+    Yields (url, extracted page or None if the page failed or timed out) as the pages finish.
+    """
+    pending = list(urls)
+    tabs = {}  # window handle -> (url, start time)
+    base_handle = driver.current_window_handle
+
+    def close(handle):
+        try:
+            driver.switch_to.window(handle)
+            driver.close()
+        except Exception:
+            pass  # the tabs left open are closed when the browser is returned to the pool
+
+    try:
+        while len(pending) > 0 or len(tabs) > 0:
+            while len(pending) > 0 and len(tabs) < crawl_tabs:
+                url = pending.pop(0)
+                try:
+                    driver.switch_to.new_window('tab')
+                    apply_stealth(driver)
+                    driver.execute_script('window.location.href = arguments[0]', url)
+                    tabs[driver.current_window_handle] = (url, time.monotonic())
+                except Exception as e:
+                    logger.info(f'{url} tab exception: {e}')
+                    yield url, None
+
+            for handle, (url, started) in list(tabs.items()):
+                page = None
+                try:
+                    driver.switch_to.window(handle)
+                    loaded = driver.execute_script(
+                        "return document.readyState == 'complete' && location.href != 'about:blank'")
+                    if loaded:
+                        page = extract(driver.page_source)
+                    elif time.monotonic() - started < page_load_timeout:
+                        continue
+                    else:
+                        logger.info(f'{url} page load timeout')
+                except Exception as e:
+                    # Probably a crashed tab or bot detection
+                    logger.info(f'{url} render exception: {e}')
+                tabs.pop(handle)
+                close(handle)
+                yield url, page
+
+            if len(tabs) > 0:
+                time.sleep(tab_poll_interval)
+    finally:
+        for handle in tabs:
+            close(handle)
+        try:
+            driver.switch_to.window(base_handle)
+        except Exception:
+            pass
 
-    texts = [p.text for p in paragraphs if len(p.text) > 1 and " " in p.text]  # Filter short texts
+
+def page_to_text(page: dict):
+    """ Text of an extracted page """
+    texts = [t for t in page['texts'] if len(t) > 1 and " " in t]  # Filter short texts
 
     # Concat text segments
     if len(texts) > 1:
@@ -73,53 +135,62 @@ def format_url(url: str):
     return url.replace(" ", "").rstrip('/')
 
 
+def extract_links(url: str, page: dict):
+    """ Page and document links of a page """
+    links = []
+    documents = []
+    for href in page['hrefs']:
+        if 'http' not in href:
+            href = url + href
+        if href.endswith('.pdf'):
+            documents.append(href)
+        else:
+            links.append(href)
+    return links, documents
+
+
 def get_links(driver, url: str, logger):
     """ Get all page and document links from a given URL """
     links = []
     documents = []
-    soup = None
+    page = None
     try:
-        soup = get_soup(driver, url)
-        # logger.info(soup)
-        for link in soup.find_all('a'):
-            href = link.get('href')
-            if href is None:
-                continue
-            if 'http' not in href:
-                href = url + href
-            if href.endswith('.pdf'):
-                documents.append(href)
-            else:
-                links.append(href)
+        page = get_page(driver, url)
+        links, documents = extract_links(url, page)
     except Exception as e:
         print(f"Error fetching links from {url}: {e}")
-    return links, documents, soup
+    return links, documents, page
 
 
-def get_page_text(driver, url: str, logger):
-    """ Get all text fom a page """
-    try:
-        soup = get_soup(driver, url)
-        logger.info(f'{url} soup text length: {len(soup.text)}')
-    except Exception as e:
-        # Probably a timeout or bot detection
-        logger.info(f'{url} get text exception: {e}')
+def get_page_text(url: str, page, validators, logger):
+    """ Get all text fom a rendered page (page is None if rendering failed) """
+    if page is None:
+        # Used as a fallback if selenium fails
         try:
-            soup = get_soup(driver, url, no_driver=True)
-            logger.info(f'{url} soup text length: {len(soup.text)}')
-        except Exception as ee:
-            logger.info(f'{url} get text fallback exception: {ee}')
+            page = get_page(None, url, no_driver=True)
+        except Exception as e:
+            logger.info(f'{url} get text fallback exception: {e}')
             return ''
+    logger.info(f'{url} page text length: {sum(len(t) for t in page["texts"])}')
 
-    text = soup_to_text(soup)
+    text = page_to_text(page)
     logger.info(f'{url} extracted text length: {len(text)}')
+    if validators is not None:
+        page_cache.store(url, text, validators)
 
     return text
 
 
-def get_pdf_text(url: str, logger):
+def get_pdf_text(url: str, logger, cache_stats: dict):
+    response = None
     try:
-        response = requests.get(url)
+        entry = page_cache.lookup(url)
+        response = requests.get(url, headers=page_cache.conditional_headers(entry), timeout=page_load_timeout)
+        cached_text, validators = page_cache.revalidate(url, entry, response.status_code, response.headers, response.content)
+        if cached_text is not None:
+            cache_stats['hits'] += 1
+            return cached_text
+        cache_stats['misses'] += 1
         pdf = fitz.open("pdf", response.content)
 
         # Extract text from each page
@@ -133,47 +204,30 @@ def get_pdf_text(url: str, logger):
                 pass
 
         pdf.close()  # Close the document object when done
+        if validators is not None:
+            page_cache.store(url, text, validators)
     except Exception as e:
         logger.info(f'{url} Document parsing error: {response} - {e}')
         return ""
     return text
 
 
-def crawl(url: str, logger):
-    # Start headless browser (stealthy as fuck)
-    service = ChromeService()  # currently broken, install latest: executable_path=ChromeDriverManager().install()
-
-    options = webdriver.ChromeOptions()
-    options.add_argument("--headless")  # run in headless mode
-    options.add_argument('--disable-blink-features=AutomationControlled')
-    options.add_argument('--disable-popup-blocking')  # disable pop-up blocking
-    options.add_argument('--start-maximized')  # start the browser window in maximized mode
-    options.add_argument('--disable-extensions')  # disable extensions
-    options.add_argument('--no-sandbox')  # disable sandbox mode
-    options.add_argument('--disable-dev-shm-usage')  # disable shared memory usage
-
-    driver = webdriver.Chrome(service=service, options=options)
-    driver.execute_script("Object.defineProperty(navigator, 'webdriver', {get: () => undefined})")
-
-    # TODO: rotate user agent if needed (https://www.zenrows.com/blog/selenium-stealth#scrape-with-stealth)
-
-    stealth(driver, languages=["en-US", "en"], vendor="Google Inc.", platform="Win32", webgl_vendor="Intel Inc.",
-            renderer="Intel Iris OpenGL Engine", fix_hairline=True)
-
+def crawl_pages(driver, url: str, logger, cache_stats: dict, seen: ContentIndex):
+    """ Page texts, linked documents and social links of a website """
     # Collect page and document links related to the input URL
-    visited = set(url)
+    visited = {url}
     document_url_list = []
     level_1 = []
     level_2 = []
-    soups = {}
+    pages = {}
 
     # Extract main page links
-    page_links, document_urls, soup = get_links(driver, url, logger)
+    page_links, document_urls, page = get_links(driver, url, logger)
     social_links = get_social_urls(page_links)
     document_url_list.extend(document_urls)
     level_1.extend([format_url(link) for link in page_links if (link not in visited) and tabu_check_url(link)])
-    if soup is not None:
-        soups[url] = soup
+    if page is not None:
+        pages[url] = page
 
     # Extract further links from connected pages
     def keep_url(url_: str):
@@ -181,16 +235,17 @@ def crawl(url: str, logger):
         is_tabu = tabu_check_url(url_)
         is_type = ("docs" in url_) or ("blog" in url_)
         return is_visited and is_tabu and is_type
-    for current_url in level_1:
-        if ("docs" not in current_url) and ("blog" not in current_url):
-            continue  # Scrape only the project technical documentation and blog in 2 level depth
-        if current_url not in visited:
-            visited.add(current_url)
-            page_links, document_urls, soup = get_links(driver, current_url, logger)
-            document_url_list.extend(document_urls)
-            level_2.extend([format_url(link) for link in page_links if keep_url(link)])
-            if soup is not None:
-                soups[current_url] = soup
+
+    # Scrape only the project technical documentation and blog in 2 level depth (rendered in parallel tabs)
+    frontier = [u for u in dict.fromkeys(level_1) if (("docs" in u) or ("blog" in u)) and u not in visited]
+    visited.update(frontier)
+    for current_url, page in render_pages(driver, frontier, logger):
+        if page is None:
+            continue
+        page_links, document_urls = extract_links(current_url, page)
+        document_url_list.extend(document_urls)
+        level_2.extend([format_url(link) for link in page_links if keep_url(link)])
+        pages[current_url] = page
 
     # Parse pages
     level_1 = set(level_1)  # deduplication
@@ -198,32 +253,48 @@ def crawl(url: str, logger):
     logger.info(f'Level 1: {len(level_1)} - {level_1}')
     logger.info(f'Level 2: {len(level_2)} - {level_2}')
     url_set = set([url]).union(level_1).union(level_2)  # deduplication
+    texts = {}
+    for i in url_set:
+        if i in pages.keys():
+            logger.info(f'{i} from stored page!')
+            texts[i] = page_to_text(pages.pop(i))
+
+    # Unchanged pages of a re-crawl (304 to the conditional request) are not rendered again, the others are rendered
+    # in parallel tabs. The raw body hash is not trusted, scripts may load content that is not in the body.
+    urls_to_render = [u for u in url_set if u not in texts]
+    cached_texts, validators = asyncio.run(page_cache.aprobe_all(urls_to_render, rendered=True))
+    cache_stats['hits'] += len(cached_texts)
+    cache_stats['misses'] += len(urls_to_render) - len(cached_texts)
+    texts.update(cached_texts)
+    for i, page in render_pages(driver, [u for u in urls_to_render if u not in cached_texts], logger):
+        texts[i] = get_page_text(i, page, validators.get(i), logger)
+
     page_texts = []
-    control_text_list = []  # helper for deduplication
     for i in random.sample(list(url_set), len(url_set)):
-        if i in soups.keys():
-            logger.info(f'{i} from stored bs4 soup!')
-            text = soup_to_text(soup)
-        else:
-            text = get_page_text(driver, i, logger)
-        if (len(text) > 0) and (text not in control_text_list):
-            control_text_list.append(text)
+        text = texts.pop(i)
+        if (len(text) > 0) and seen.add(text, 'pages'):
             page_texts.append(f"The following text is from {i}:\n{text}")
-        time.sleep(1)
+
+    return page_texts, document_url_list, social_links
+
+
+def crawl(url: str, logger):
+    # Headless browser from the shared pool (the crawl works in its own tab), released before the pdf downloads
+    cache_stats = {'hits': 0, 'misses': 0}
+    seen = ContentIndex()  # deduplication of pages and documents (normalized text digests, near-duplicates if enabled)
+    with browser_pool.browser() as driver:
+        page_texts, document_url_list, social_links = crawl_pages(driver, url, logger, cache_stats, seen)
 
     # Parse pdf-s (e.g. whitepapers)
     document_url_list = set(document_url_list)  # deduplication
     document_texts = []
-    control_text_list = []  # helper for deduplication
     for u in document_url_list:
-        text = get_pdf_text(u, logger)
-        if (len(text) > 0) and (text not in control_text_list):
-            control_text_list.append(text)
+        text = get_pdf_text(u, logger, cache_stats)
+        if (len(text) > 0) and seen.add(text, 'documents'):
             document_texts.append(f"The following text is from {u}:\n{text}")
 
-    # Clean up headless browser
-    driver.quit()
-
     logger.info(f'Page count: {len(page_texts)}; Doc count: {len(document_texts)}')
+    seen.log_dropped(logger)
+    page_cache.log_usage(cache_stats, logger)
 
     return page_texts + document_texts, social_links
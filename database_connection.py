@@ -1,6 +1,12 @@
+import io
 import json
-from pymongo import MongoClient
+import hashlib
+import gridfs
+import numpy as np
+from pymongo import MongoClient, ReturnDocument, UpdateOne, ASCENDING
+from pymongo.errors import DuplicateKeyError
 from bson.objectid import ObjectId
+from bson.binary import Binary
 import datetime
 
 # DB connection
@@ -11,6 +17,21 @@ client = MongoClient(mongo_uri)
 db = client['nextgem']  # Database name
 project_collection = db['projects']
 settings_collection = db['settings']
+job_collection = db['jobs']
+batch_collection = db['batches']
+checkpoint_fs = gridfs.GridFS(db, collection='checkpoints')  # stage outputs can exceed the 16MB document limit
+chunk_embedding_collection = db['chunk_embeddings']
+project_embedding_collection = db['project_embeddings']
+checkpoint_max_age = datetime.timedelta(hours=config.get('CHECKPOINT_MAX_AGE_HOURS', 24))  # older checkpoints are not reused
+
+# Only one active (queued or running) job per project
+job_collection.create_index([('taskid', ASCENDING)], unique=True, partialFilterExpression={'active': True})
+job_collection.create_index([('status', ASCENDING), ('createdAt', ASCENDING)])
+# Chunk embeddings not used for a while are dropped
+chunk_embedding_collection.create_index([('lastUsed', ASCENDING)],
+                                        expireAfterSeconds=config.get('CHUNK_EMBEDDING_TTL_DAYS', 90) * 24 * 3600)
+# Similarity indexes of the API and worker processes catch up with the projects embedded by others
+project_embedding_collection.create_index([('model', ASCENDING), ('updatedAt', ASCENDING)])
 
 
 def resolve_project(request_data: dict, logger):
@@ -37,17 +58,21 @@ def resolve_project(request_data: dict, logger):
         raise Exception('Unexpected input for resolve_project function!')
 
 
-def store(taskid: str, data: dict):
+def store(taskid: str, data: dict, overwrite=(), unset=()):
+    """ overwrite: fields replaced even if they exist (results of a run), unset: fields removed """
     data['updatedAt'] = datetime.datetime.now()
     all_fields = project_collection.find_one({'_id': ObjectId(taskid)})
     
     #If all_fields already has field, do not overwrite.
     
-    keys_to_remove = set(all_fields.keys()) - {'_id', 'updatedAt'}
+    keys_to_remove = set(all_fields.keys()) - {'_id', 'updatedAt'} - set(overwrite)
     for key in keys_to_remove:
         data.pop(key, None)
 
-    project_collection.update_one({'_id': ObjectId(taskid)}, {'$set': data})
+    update = {'$set': data}
+    if len(unset) > 0:
+        update['$unset'] = {key: '' for key in unset}
+    project_collection.update_one({'_id': ObjectId(taskid)}, update)
 
 
 def check_taskid(taskid: str):
@@ -77,3 +102,299 @@ def update_memecoin_season(is_memecoin_season: bool):
         'updatedAt': datetime.datetime.now()
     }
     settings_collection.update_one({'_id': 'isMemeSeason'}, {'$set': data})
+
+
+### Durable job queue ###
+
+
+def enqueue_job(taskid: str, url: str, force: bool = False, batch_id: str = None):
+    """
+    Create a queued job. Returns False if an active job of the project exists (unless force supersedes it).
+    Jobs of a batch update the status of their batch item. A batch item of a project already in progress is attached
+    to the active job instead, it gets the final status of that job.
+    """
+    now = datetime.datetime.now()
+    attached = []
+    while force:
+        previous = job_collection.find_one_and_update({'taskid': taskid, 'active': True},
+                                                      {'$set': {'status': 'superseded', 'updatedAt': now},
+                                                       '$unset': {'active': ''}})
+        if previous is None:
+            break
+        if previous.get('batchId') is not None:
+            update_batch_item(previous['batchId'], taskid, 'cancelled')
+        attached.extend(previous.get('attachedBatches', []))  # attached items follow the new run
+    while True:
+        try:
+            job_collection.insert_one({
+                'taskid': taskid,
+                'url': url,
+                'status': 'queued',
+                'active': True,
+                'force': force,
+                'batchId': batch_id,
+                'attachedBatches': attached,
+                'attempts': 0,
+                'createdAt': now,
+                'updatedAt': now,
+            })
+            return True
+        except DuplicateKeyError:
+            if batch_id is None:
+                return False
+        result = job_collection.update_one({'taskid': taskid, 'active': True}, {'$addToSet': {'attachedBatches': batch_id}})
+        if result.matched_count == 1:
+            return False
+        # The active job finished in the meantime, the project is queued again
+
+
+def claim_job(worker_id: str, lease_seconds: int):
+    """ Take the oldest queued job and lease it to the worker """
+    now = datetime.datetime.now()
+    return job_collection.find_one_and_update(
+        {'status': 'queued'},
+        {
+            '$set': {
+                'status': 'running',
+                'workerId': worker_id,
+                'startedAt': now,
+                'updatedAt': now,
+                'leaseExpiresAt': now + datetime.timedelta(seconds=lease_seconds),
+            },
+            '$inc': {'attempts': 1},
+        },
+        sort=[('createdAt', ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def heartbeat_job(job_id, worker_id: str, lease_seconds: int):
+    """ Extend the lease of a running job. Returns False if the worker lost the lease. """
+    now = datetime.datetime.now()
+    result = job_collection.update_one(
+        {'_id': job_id, 'workerId': worker_id, 'status': 'running'},
+        {'$set': {'leaseExpiresAt': now + datetime.timedelta(seconds=lease_seconds), 'updatedAt': now}},
+    )
+    return result.modified_count == 1
+
+
+def finish_job(job_id, worker_id: str, error: str = None):
+    """
+    The finished job with the batches attached to it until now,
+    None if the worker lost the lease of the job (it was re-queued or superseded)
+    """
+    now = datetime.datetime.now()
+    data = {'status': 'failed' if error is not None else 'done', 'finishedAt': now, 'updatedAt': now}
+    if error is not None:
+        data['error'] = error
+    return job_collection.find_one_and_update({'_id': job_id, 'workerId': worker_id, 'status': 'running'},
+                                              {'$set': data, '$unset': {'active': ''}},
+                                              return_document=ReturnDocument.AFTER)
+
+
+def job_batches(job: dict):
+    """ Ids of the batches whose item is run by the job or attached to it """
+    return ([job['batchId']] if job.get('batchId') is not None else []) + job.get('attachedBatches', [])
+
+
+def requeue_expired_jobs(max_attempts: int):
+    """ Jobs of crashed or stuck workers go back to the queue (or fail after too many attempts) """
+    now = datetime.datetime.now()
+    expired = {'status': 'running', 'leaseExpiresAt': {'$lt': now}}
+    error = 'Lease expired too many times'
+    failed = 0
+    while True:
+        job = job_collection.find_one_and_update({**expired, 'attempts': {'$gte': max_attempts}},
+                                                 {'$set': {'status': 'failed', 'error': error, 'updatedAt': now},
+                                                  '$unset': {'active': ''}},
+                                                 return_document=ReturnDocument.AFTER)
+        if job is None:
+            break
+        failed += 1
+        for batch_id in job_batches(job):
+            update_batch_item(batch_id, job['taskid'], 'failed', error)
+    requeued = job_collection.update_many(expired,
+                                          {'$set': {'status': 'queued', 'updatedAt': now},
+                                           '$unset': {'workerId': '', 'leaseExpiresAt': ''}})
+    return requeued.modified_count, failed
+
+
+def get_job_stats():
+    """ Queue depth of the durable job queue """
+    now = datetime.datetime.now()
+    oldest = job_collection.find_one({'active': True}, sort=[('createdAt', ASCENDING)])
+    return {
+        'queued_jobs': job_collection.count_documents({'status': 'queued'}),
+        'running_jobs': job_collection.count_documents({'status': 'running'}),
+        'oldest_job_age': round((now - oldest['createdAt']).total_seconds(), 1) if oldest is not None else 0,
+    }
+
+
+### Stage checkpoints ###
+
+
+def save_checkpoint(taskid: str, stage: str, data, input_hash: str = None, array=None):
+    """
+    Persist the output of a processing stage. Optional float array (embeddings) is stored as float32 .npy.
+    Returns the content hash of the checkpoint, later stages store it as their input hash.
+    """
+    payload = json.dumps(data).encode('utf-8')
+    array_bytes = b''
+    if array is not None:
+        buffer = io.BytesIO()
+        np.save(buffer, np.asarray(array, dtype=np.float32))
+        array_bytes = buffer.getvalue()
+    content_hash = hashlib.sha256(payload + array_bytes).hexdigest()
+
+    delete_checkpoint(taskid, stage)
+    metadata = {'taskid': taskid, 'stage': stage, 'hash': content_hash, 'inputHash': input_hash,
+                'createdAt': datetime.datetime.now()}
+    if array is not None:
+        checkpoint_fs.put(array_bytes, filename=f'{taskid}/{stage}.npy', metadata={**metadata, 'part': 'array'})
+    # The data part is written last, its presence marks a complete checkpoint
+    checkpoint_fs.put(payload, filename=f'{taskid}/{stage}.json', metadata={**metadata, 'part': 'data'})
+    return content_hash
+
+
+def load_checkpoint(taskid: str, stage: str, input_hash: str = None):
+    """ Returns (data, array, content hash) or None if missing, corrupt, too old or computed from a different input """
+    data_file = checkpoint_fs.find_one({'metadata.taskid': taskid, 'metadata.stage': stage, 'metadata.part': 'data'})
+    if data_file is None or data_file.metadata.get('inputHash') != input_hash:
+        return None
+    created_at = data_file.metadata.get('createdAt')
+    if created_at is None or datetime.datetime.now() - created_at > checkpoint_max_age:
+        return None  # e.g. the crawl of a run that failed long ago, the website may have changed since
+    payload = data_file.read()
+    array_bytes = b''
+    array = None
+    array_file = checkpoint_fs.find_one({'metadata.taskid': taskid, 'metadata.stage': stage, 'metadata.part': 'array'})
+    if array_file is not None:
+        array_bytes = array_file.read()
+        array = np.load(io.BytesIO(array_bytes))
+    content_hash = hashlib.sha256(payload + array_bytes).hexdigest()
+    if content_hash != data_file.metadata['hash']:
+        return None
+    return json.loads(payload), array, content_hash
+
+
+def delete_checkpoint(taskid: str, stage: str):
+    for checkpoint_file in checkpoint_fs.find({'metadata.taskid': taskid, 'metadata.stage': stage}):
+        checkpoint_fs.delete(checkpoint_file._id)
+
+
+def clear_checkpoints(taskid: str):
+    for checkpoint_file in checkpoint_fs.find({'metadata.taskid': taskid}):
+        checkpoint_fs.delete(checkpoint_file._id)
+
+
+def delete_expired_checkpoints():
+    """ Delete the checkpoints too old to be reused (partial and abandoned runs). Returns the deleted file count. """
+    cutoff = datetime.datetime.now() - checkpoint_max_age
+    expired = {'$or': [{'metadata.createdAt': {'$lt': cutoff}},
+                       {'metadata.createdAt': {'$exists': False}, 'uploadDate': {'$lt': cutoff}}]}
+    count = 0
+    for checkpoint_file in checkpoint_fs.find(expired):
+        checkpoint_fs.delete(checkpoint_file._id)
+        count += 1
+    return count
+
+
+### Batches ###
+
+
+def create_batch(projects: list):
+    """ projects: list of (taskid, url). Projects without taskid were not found. """
+    now = datetime.datetime.now()
+    items = [{'taskid': taskid, 'url': url, 'status': 'queued' if taskid is not None else 'not_found', 'updatedAt': now}
+             for taskid, url in projects]
+    result = batch_collection.insert_one({'items': items, 'createdAt': now, 'updatedAt': now})
+    return str(result.inserted_id)
+
+
+def update_batch_item(batch_id: str, taskid: str, status: str, error: str = None, current: str = None):
+    """ current: only update the item if it still has this status """
+    now = datetime.datetime.now()
+    data = {'items.$.status': status, 'items.$.updatedAt': now, 'updatedAt': now}
+    if error is not None:
+        data['items.$.error'] = error
+    item = {'taskid': taskid} if current is None else {'taskid': taskid, 'status': current}
+    batch_collection.update_one({'_id': ObjectId(batch_id), 'items': {'$elemMatch': item}}, {'$set': data})
+
+
+def delete_batch(batch_id: str):
+    batch_collection.delete_one({'_id': ObjectId(batch_id)})
+
+
+def get_batch(batch_id: str):
+    try:
+        result = batch_collection.find_one({'_id': ObjectId(batch_id)})
+    except Exception:
+        return None
+    if result is None:
+        return None
+    result['_id'] = str(result['_id'])
+    return result
+
+
+### Chunk embedding cache ###
+
+
+def find_chunk_embeddings(keys: list, query_size: int = 1000):
+    """ Cached embeddings (float32 arrays) by content key. Hits are touched to keep them alive. """
+    now = datetime.datetime.now()
+    found = {}
+    for i in range(0, len(keys), query_size):
+        current_keys = keys[i:i + query_size]
+        for doc in chunk_embedding_collection.find({'_id': {'$in': current_keys}}):
+            found[doc['_id']] = np.frombuffer(doc['embedding'], dtype=np.float32)
+        chunk_embedding_collection.update_many({'_id': {'$in': current_keys}}, {'$set': {'lastUsed': now}})
+    return found
+
+
+def store_chunk_embeddings(embeddings: dict, model: str):
+    """ embeddings: content key -> embedding """
+    if len(embeddings) == 0:
+        return
+    now = datetime.datetime.now()
+    operations = [UpdateOne({'_id': key},
+                            {'$set': {'embedding': Binary(np.asarray(embedding, dtype=np.float32).tobytes()),
+                                      'model': model, 'lastUsed': now}},
+                            upsert=True)
+                  for key, embedding in embeddings.items()]
+    chunk_embedding_collection.bulk_write(operations, ordered=False)
+
+
+### Project embeddings (similar projects) ###
+
+
+def store_project_embedding(taskid: str, model: str, embedding, chunk_embeddings=None):
+    """ Project level embedding with optional chunk embeddings (float16). Returns the update time. """
+    now = datetime.datetime.now()
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)  # Mongo keeps milliseconds
+    data = {'model': model, 'embedding': Binary(np.asarray(embedding, dtype=np.float32).tobytes()), 'updatedAt': now}
+    update = {'$set': data}
+    if chunk_embeddings is not None:
+        data['chunkEmbeddings'] = Binary(np.asarray(chunk_embeddings, dtype=np.float16).tobytes())
+    else:
+        update['$unset'] = {'chunkEmbeddings': ''}
+    project_embedding_collection.update_one({'_id': taskid}, update, upsert=True)
+    return now
+
+
+def find_project_embeddings(model: str, updated_since=None):
+    """ Yields (taskid, embedding, chunk embeddings or None, update time) in update order """
+    query = {'model': model}
+    if updated_since is not None:
+        query['updatedAt'] = {'$gte': updated_since}
+    for doc in project_embedding_collection.find(query).sort('updatedAt', ASCENDING):
+        embedding = np.frombuffer(doc['embedding'], dtype=np.float32)
+        chunk_embeddings = None
+        if 'chunkEmbeddings' in doc:
+            chunk_embeddings = np.frombuffer(doc['chunkEmbeddings'], dtype=np.float16).astype(np.float32).reshape(-1, len(embedding))
+        yield doc['_id'], embedding, chunk_embeddings, doc['updatedAt']
+
+
+def get_website_links(taskids: list):
+    """ taskid -> websiteLink """
+    ids = [ObjectId(taskid) for taskid in taskids if ObjectId.is_valid(taskid)]
+    return {str(doc['_id']): doc.get('websiteLink') for doc in project_collection.find({'_id': {'$in': ids}}, {'websiteLink': 1})}
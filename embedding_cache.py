@@ -0,0 +1,158 @@
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import database_connection as db
+from llm_connection import get_multiple_openai_embedding, openai_embedding_model
+from local_embedding import get_local_embeddings, local_embedding_model
+from retry import call_with_retries
+
+# Persistent cache of retrieval query embeddings (the same prompts are embedded for every project)
+# and content-addressed cache of chunk embeddings (re-scorings and boilerplate shared by template sites)
+with open('config.json', 'r') as file:
+    config = json.load(file)
+
+query_cache_path = config.get('QUERY_EMBEDDING_CACHE_PATH', 'query_embeddings.sqlite')
+query_cache_size = config.get('QUERY_EMBEDDING_CACHE_SIZE', 1000)  # LRU bound of the not pinned entries
+embedding_backend = config.get('EMBEDDING_BACKEND', 'openai')  # 'openai' or 'local' (CPU model, see local_embedding.py)
+embedding_model = local_embedding_model if embedding_backend == 'local' else openai_embedding_model
+
+_lock = threading.Lock()
+_pinned = {}  # key -> embedding, static prompts are never evicted
+_lru = OrderedDict()  # key -> embedding
+_connection = sqlite3.connect(query_cache_path, check_same_thread=False, timeout=10)
+_connection.execute('CREATE TABLE IF NOT EXISTS query_embeddings '
+                    '(key TEXT PRIMARY KEY, model TEXT, embedding BLOB, pinned INTEGER, last_used REAL)')
+_connection.commit()
+
+
+def cache_key(text: str, model: str = embedding_model):
+    return hashlib.sha256(f'{model}\n{text}'.encode('utf-8')).hexdigest()
+
+
+def embed_texts(text_list: list, logger=None):
+    """ Embeddings (float32 matrix) with the configured backend, None on error. Chunks and queries use the same model. """
+    if embedding_backend == 'local':
+        return get_local_embeddings(text_list, logger)
+    return get_multiple_openai_embedding(text_list, logger)
+
+
+def _load(key: str):
+    """ Lookup in memory, then on disk (called with _lock held) """
+    if key in _pinned:
+        return _pinned[key]
+    if key in _lru:
+        _lru.move_to_end(key)
+        return _lru[key]
+    row = _connection.execute('SELECT embedding, pinned FROM query_embeddings WHERE key = ?', (key,)).fetchone()
+    if row is None:
+        return None
+    embedding = np.frombuffer(row[0], dtype=np.float32)
+    _remember(key, embedding, bool(row[1]))
+    _connection.execute('UPDATE query_embeddings SET last_used = ? WHERE key = ?', (time.time(), key))
+    _connection.commit()
+    return embedding
+
+
+def _remember(key: str, embedding, pinned: bool):
+    """ Store in memory and evict the least recently used entry if needed (called with _lock held) """
+    if pinned:
+        _pinned[key] = embedding
+        _lru.pop(key, None)
+        return
+    _lru[key] = embedding
+    _lru.move_to_end(key)
+    while len(_lru) > query_cache_size:
+        _lru.popitem(last=False)
+
+
+def _store(key: str, embedding, pinned: bool):
+    """ Persist an embedding and trim the disk cache to the LRU bound (called with _lock held) """
+    _remember(key, embedding, pinned)
+    _connection.execute('INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?, ?, ?)',
+                        (key, embedding_model, embedding.tobytes(), int(pinned), time.time()))
+    _connection.execute('DELETE FROM query_embeddings WHERE pinned = 0 AND key NOT IN '
+                        '(SELECT key FROM query_embeddings WHERE pinned = 0 ORDER BY last_used DESC LIMIT ?)',
+                        (query_cache_size,))
+    _connection.commit()
+
+
+def get_query_embedding(text: str, logger=None, pinned: bool = False, max_retries: int = 3):
+    """ Embedding of a retrieval query as float32 array, None if the embedding call failed """
+    key = cache_key(text)
+    with _lock:
+        embedding = _load(key)
+    if embedding is not None:
+        return embedding
+
+    response = call_with_retries(lambda: embed_texts([text], logger), logger, max_retries)
+    if response is None:
+        if logger is not None:
+            logger.error('Query embedding failed.')
+        return None
+
+    embedding = np.asarray(response[0], dtype=np.float32)
+    with _lock:
+        _store(key, embedding, pinned)
+    return embedding
+
+
+def warm_query_cache(texts: list, logger):
+    """ Embed the static retrieval prompts (once, they are persisted) """
+    missing = 0
+    for text in texts:
+        key = cache_key(text)
+        with _lock:
+            embedding = _load(key)
+            if embedding is not None and key not in _pinned:
+                _store(key, embedding, pinned=True)
+        if embedding is None:
+            missing += 1
+            get_query_embedding(text, logger, pinned=True)
+    logger.info(f'Query embedding cache warmed. Prompts: {len(texts)}; newly embedded: {missing}')
+
+
+### Chunk embeddings ###
+
+_chunk_stats_lock = threading.Lock()
+chunk_cache_stats = {'chunks': 0, 'hits': 0, 'saved_calls': 0}
+
+
+def load_chunk_embeddings(keys: list, logger=None):
+    """ Cached chunk embeddings by key (float32 arrays). Empty if the cache is unavailable. """
+    try:
+        return db.find_chunk_embeddings(list(set(keys)))
+    except Exception as e:
+        if logger is not None:
+            logger.error(f'Chunk embedding cache lookup failed: {e}')
+        return {}
+
+
+def save_chunk_embeddings(embeddings: dict, logger=None):
+    try:
+        db.store_chunk_embeddings(embeddings, embedding_model)
+    except Exception as e:
+        if logger is not None:
+            logger.error(f'Chunk embedding cache update failed: {e}')
+
+
+def record_chunk_cache_usage(chunks: int, hits: int, saved_calls: int, logger=None):
+    with _chunk_stats_lock:
+        chunk_cache_stats['chunks'] += chunks
+        chunk_cache_stats['hits'] += hits
+        chunk_cache_stats['saved_calls'] += saved_calls
+    if logger is not None and chunks > 0:
+        logger.info(f'Chunk embedding cache hits: {hits}/{chunks} ({100 * hits / chunks:.1f}%); saved embedding calls: {saved_calls}')
+
+
+def get_cache_stats():
+    """ Embedding cache metrics since process start """
+    with _chunk_stats_lock:
+        chunks = chunk_cache_stats['chunks']
+        return {
+            'chunk_hit_rate': round(chunk_cache_stats['hits'] / chunks, 3) if chunks > 0 else None,
+            **chunk_cache_stats,
+        }
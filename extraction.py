@@ -1,9 +1,10 @@
 import re
-import time
 import json
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from chunk_selection import get_project_context
 from llm_connection import get_openai_completion
 from token_contract import query_base_token_info
+from retry import call_with_retries
 
 
 def set_none(data: dict):
@@ -22,24 +23,15 @@ memecoin_prompt = 'You are a helpful assistant. brief and precise. You are extra
                   'Text chunks from website:\n'
 
 
-def extract_memecoin_status(url: str, text_chunks, embeddings, logger, max_retries=3):
+def extract_memecoin_status(url: str, text_chunks, embeddings, logger, max_retries=3, deadline=None):
     augmented_memecoin_prompt = memecoin_prompt.replace('###URL###', url)
-    project_context = get_project_context(text_chunks, embeddings, prompt=augmented_memecoin_prompt, top_k=10)
+    project_context = get_project_context(text_chunks, embeddings, prompt=memecoin_prompt, logger=logger)
     #logger.info(f'meme extraction context: {project_context}')
 
     error_out = False
-    retries = 0
-    while retries < max_retries:
-        response = get_openai_completion(augmented_memecoin_prompt + project_context, logger)
-        if response is None:
-            time.sleep(1)
-        else:
-            try:
-                return json.loads(response)['is_memecoin']
-            except Exception as e:
-                logger.info(f'Failed json conversion: {response} - {e}')
-                return error_out
-    return error_out
+    is_memecoin = call_with_retries(lambda: get_openai_completion(augmented_memecoin_prompt + project_context, logger),
+                                    logger, max_retries, deadline, parse=lambda response: json.loads(response)['is_memecoin'])
+    return error_out if is_memecoin is None else is_memecoin
 
 
 token_prompt = 'You are a helpful assistant. brief and precise. You are extracting information from scrapped crypto project websites.\n' \
@@ -60,9 +52,8 @@ token_prompt = 'You are a helpful assistant. brief and precise. You are extracti
                'Text chunks from website:\n'
 
 
-def extract_token_info(url: str, text_chunks, embeddings, logger, max_retries=3):
-    augmented_token_prompt = token_prompt.replace('###URL###', url)
-    project_context = get_project_context(text_chunks, embeddings, prompt=augmented_token_prompt, top_k=10)
+def extract_token_info(url: str, text_chunks, embeddings, logger, max_retries=3, deadline=None):
+    project_context = get_project_context(text_chunks, embeddings, prompt=token_prompt, logger=logger)
 
     # Help LLM by recommending token symbol candidates with regex
     def find_token_symbol_candidates(s):
@@ -76,18 +67,9 @@ def extract_token_info(url: str, text_chunks, embeddings, logger, max_retries=3)
 
     def call_llm(base_prompt, context, logger, max_retries):
         error_out = {"tokenName": err_msg, "tokenSymbol": err_msg, "chains": err_msg, "token_contract_address": err_msg}
-        retries = 0
-        while retries < max_retries:
-            response = get_openai_completion(base_prompt + context, logger)
-            if response is None:
-                time.sleep(1)
-            else:
-                try:
-                    return json.loads(response)
-                except Exception as e:
-                    logger.info(f'Failed json conversion: {response} - {e}')
-                    return error_out
-        return error_out
+        response = call_with_retries(lambda: get_openai_completion(base_prompt + context, logger),
+                                     logger, max_retries, deadline, parse=json.loads)
+        return error_out if response is None else response
 
     token_info = call_llm(token_prompt, project_context, logger, max_retries)
 
@@ -148,19 +130,14 @@ industry_prompt = 'You are a helpful assistant. Brief and precise. You are extra
                  'Text chunks from website:\n'
 
 
-def extract_industry_info(url: str, text_chunks, embeddings, logger, max_retries=3):
+def extract_industry_info(url: str, text_chunks, embeddings, logger, max_retries=3, deadline=None):
     augmented_industry_prompt = industry_prompt.replace('###URL###', url)
-    project_context = get_project_context(text_chunks, embeddings, prompt=augmented_industry_prompt, top_k=15)
+    project_context = get_project_context(text_chunks, embeddings, prompt=industry_prompt, logger=logger)
     # logger.info(f'backers extraction context: {project_context}')
 
-    retries = 0
-    while retries < max_retries:
-        response = get_openai_completion(augmented_industry_prompt + project_context, logger)
-        if response is None:
-            time.sleep(1)
-        else:
-            return set_none(json.loads(response))
-    return err_msg
+    data = call_with_retries(lambda: get_openai_completion(augmented_industry_prompt + project_context, logger),
+                             logger, max_retries, deadline, parse=json.loads)
+    return err_msg if data is None else set_none(data)
 
 
 team_prompt = 'You are a helpful assistant. Brief and precise. You are extracting information from scrapped crypto project websites.\n' \
@@ -175,22 +152,19 @@ team_prompt = 'You are a helpful assistant. Brief and precise. You are extractin
                  'Text chunks from website:\n'
 
 
-def extract_team_info(url: str, text_chunks, embeddings, logger, max_retries=3):
+def extract_team_info(url: str, text_chunks, embeddings, logger, max_retries=3, deadline=None):
     augmented_team_prompt = team_prompt.replace('###URL###', url)
-    project_context = get_project_context(text_chunks, embeddings, prompt=augmented_team_prompt, top_k=10)
+    project_context = get_project_context(text_chunks, embeddings, prompt=team_prompt, logger=logger)
     # logger.info(f'backers extraction context: {project_context}')
 
-    retries = 0
-    while retries < max_retries:
-        response = get_openai_completion(augmented_team_prompt + project_context, logger)
-        if response is None:
-            time.sleep(1)
-        else:
-            data = set_none(json.loads(response))
-            if data["members"] is not None:
-                data["members"] = [set_none(member) for member in data["members"]]
-            return data
-    return err_msg
+    data = call_with_retries(lambda: get_openai_completion(augmented_team_prompt + project_context, logger),
+                             logger, max_retries, deadline, parse=json.loads)
+    if data is None:
+        return err_msg
+    data = set_none(data)
+    if data["members"] is not None:
+        data["members"] = [set_none(member) for member in data["members"]]
+    return data
 
 
 backers_prompt = 'You are a helpful assistant. Brief and precise. You are extracting information from scrapped crypto project websites.\n' \
@@ -204,23 +178,20 @@ backers_prompt = 'You are a helpful assistant. Brief and precise. You are extrac
                  'Text chunks from website:\n'
 
 
-def extract_backers_info(url: str, text_chunks, embeddings, logger, max_retries=3):
+def extract_backers_info(url: str, text_chunks, embeddings, logger, max_retries=3, deadline=None):
     augmented_backers_prompt = backers_prompt.replace('###URL###', url)
-    project_context = get_project_context(text_chunks, embeddings, prompt=augmented_backers_prompt, top_k=10)
+    project_context = get_project_context(text_chunks, embeddings, prompt=backers_prompt, logger=logger)
     # logger.info(f'backers extraction context: {project_context}')
 
-    retries = 0
-    while retries < max_retries:
-        response = get_openai_completion(augmented_backers_prompt + project_context, logger)
-        if response is None:
-            time.sleep(1)
-        else:
-            data = set_none(json.loads(response))
-            if (data['partnerships'] is not None) and (data['investors'] is not None):
-                data['partnerships'] = [i for i in data['partnerships'] if i not in data['investors']]
-                data['partnerships'] = data['partnerships'] if len(data['partnerships']) > 0 else None
-            return data
-    return err_msg
+    data = call_with_retries(lambda: get_openai_completion(augmented_backers_prompt + project_context, logger),
+                             logger, max_retries, deadline, parse=json.loads)
+    if data is None:
+        return err_msg
+    data = set_none(data)
+    if (data['partnerships'] is not None) and (data['investors'] is not None):
+        data['partnerships'] = [i for i in data['partnerships'] if i not in data['investors']]
+        data['partnerships'] = data['partnerships'] if len(data['partnerships']) > 0 else None
+    return data
 
 
 tokenomics_prompt = 'You are a helpful assistant. Brief and precise. You are extracting information from scrapped crypto project websites.\n' \
@@ -236,19 +207,14 @@ tokenomics_prompt = 'You are a helpful assistant. Brief and precise. You are ext
                     'Text chunks from website:\n'
 
 
-def extract_tokenomics_info(url: str, text_chunks, embeddings, logger, max_retries=3):
+def extract_tokenomics_info(url: str, text_chunks, embeddings, logger, max_retries=3, deadline=None):
     augmented_tokenomics_prompt = tokenomics_prompt.replace('###URL###', url)
-    project_context = get_project_context(text_chunks, embeddings, prompt=augmented_tokenomics_prompt, top_k=20)
+    project_context = get_project_context(text_chunks, embeddings, prompt=tokenomics_prompt, logger=logger)
     # logger.info(f'tokenomics extraction context: {project_context}')
 
-    retries = 0
-    while retries < max_retries:
-        response = get_openai_completion(augmented_tokenomics_prompt + project_context, logger)
-        if response is None:
-            time.sleep(1)
-        else:
-            return set_none(json.loads(response))
-    return err_msg
+    data = call_with_retries(lambda: get_openai_completion(augmented_tokenomics_prompt + project_context, logger),
+                             logger, max_retries, deadline, parse=json.loads)
+    return err_msg if data is None else set_none(data)
 
 
 financials_prompt = 'You are a helpful assistant. Brief and precise. You are extracting information from scrapped crypto project websites.\n' \
@@ -260,19 +226,14 @@ financials_prompt = 'You are a helpful assistant. Brief and precise. You are ext
                     'Text chunks from website:\n'
 
 
-def extract_financials_info(url: str, text_chunks, embeddings, logger, max_retries=3):
+def extract_financials_info(url: str, text_chunks, embeddings, logger, max_retries=3, deadline=None):
     augmented_financials_prompt = financials_prompt.replace('###URL###', url)
-    project_context = get_project_context(text_chunks, embeddings, prompt=augmented_financials_prompt, top_k=10)
+    project_context = get_project_context(text_chunks, embeddings, prompt=financials_prompt, logger=logger)
     # logger.info(f'tokenomics extraction context: {project_context}')
 
-    retries = 0
-    while retries < max_retries:
-        response = get_openai_completion(augmented_financials_prompt + project_context, logger)
-        if response is None:
-            time.sleep(1)
-        else:
-            return set_none(json.loads(response))
-    return err_msg
+    data = call_with_retries(lambda: get_openai_completion(augmented_financials_prompt + project_context, logger),
+                             logger, max_retries, deadline, parse=json.loads)
+    return err_msg if data is None else set_none(data)
 
 
 market_strat_prompt = 'You are a helpful assistant. Brief and precise. You are extracting information from scrapped crypto project websites.\n' \
@@ -287,16 +248,69 @@ market_strat_prompt = 'You are a helpful assistant. Brief and precise. You are e
                       'Text chunks from website:\n'
 
 
-def extract_market_strat_prompt_info(url: str, text_chunks, embeddings, logger, max_retries=3):
+def extract_market_strat_prompt_info(url: str, text_chunks, embeddings, logger, max_retries=3, deadline=None):
     augmented_market_strat_prompt = market_strat_prompt.replace('###URL###', url)
-    project_context = get_project_context(text_chunks, embeddings, prompt=augmented_market_strat_prompt, top_k=10)
+    project_context = get_project_context(text_chunks, embeddings, prompt=market_strat_prompt, logger=logger)
     # logger.info(f'market strategy extraction context: {project_context}')
 
-    retries = 0
-    while retries < max_retries:
-        response = get_openai_completion(augmented_market_strat_prompt + project_context, logger)
-        if response is None:
-            time.sleep(1)
-        else:
-            return set_none(json.loads(response))
-    return err_msg
+    data = call_with_retries(lambda: get_openai_completion(augmented_market_strat_prompt + project_context, logger),
+                             logger, max_retries, deadline, parse=json.loads)
+    return err_msg if data is None else set_none(data)
+
+
+### Concurrent extraction stage ###
+
+# Retrieval queries are the prompt templates (without the project URL), so their embeddings are reused across projects
+retrieval_prompts = [memecoin_prompt, token_prompt, industry_prompt, team_prompt, backers_prompt,
+                     tokenomics_prompt, financials_prompt, market_strat_prompt]
+
+extractors = {
+    'memecoin': extract_memecoin_status,
+    'token': extract_token_info,
+    'industry': extract_industry_info,
+    'team': extract_team_info,
+    'backers': extract_backers_info,
+    'tokenomics': extract_tokenomics_info,
+    'financials': extract_financials_info,
+    'market': extract_market_strat_prompt_info,
+}
+
+# Result used if an extractor raised an exception
+extractor_fallbacks = {
+    'memecoin': False,
+    'token': {"tokenName": err_msg, "tokenSymbol": err_msg, "chains": err_msg},
+}
+
+
+def start_extractions(executor, url: str, text_chunks, embeddings, logger, deadline=None, names=None):
+    """ Submit the extractors (all by default) to the executor. Extractors are independent, they only share the chunks. """
+    names = list(extractors) if names is None else names
+    return {name: executor.submit(extractors[name], url, text_chunks, embeddings, logger, deadline=deadline)
+            for name in names}
+
+
+def collect_extraction(name: str, future, logger, errors: dict, deadline=None, on_result=None):
+    """
+    Wait for an extractor result. Failures are recorded in errors and replaced by a fallback value.
+    on_result(name, result) is called in the collecting thread for a finished extraction (not for fallbacks).
+    """
+    try:
+        result = future.result(timeout=None if deadline is None else deadline.remaining())
+    except FutureTimeoutError:
+        logger.warning(f'{name} extraction did not finish within the time budget')
+        errors[name] = 'Time budget exceeded'
+        return extractor_fallbacks.get(name, err_msg)
+    except Exception as e:
+        logger.error(f'{name} extraction failed: {e}')
+        errors[name] = str(e)
+        return extractor_fallbacks.get(name, err_msg)
+    if on_result is not None:
+        on_result(name, result)
+    return result
+
+
+def collect_extractions(futures: dict, logger, deadline=None, on_result=None):
+    """ Wait for all extractors. Returns the results and the errors by extractor name. """
+    errors = {}
+    results = {name: collect_extraction(name, future, logger, errors, deadline, on_result) for name, future in futures.items()}
+    return results, errors
@@ -0,0 +1,91 @@
+import json
+from bs4 import BeautifulSoup
+
+# Text segments and link targets of HTML pages from a single parse. The parsed tree is dropped right away,
+# crawls only keep these lists of strings until the page texts are built.
+with open('config.json', 'r') as file:
+    config = json.load(file)
+
+html_extractor = config.get('HTML_EXTRACTOR', 'selectolax')  # selectolax, lxml or bs4 (html.parser, legacy output)
+skipped_tags = ['script', 'style', 'nav', 'noscript', 'template']  # no visible text or the same on every page (links are kept)
+preformatted_tags = {'pre', 'textarea'}
+ascii_whitespace = ' \n\t\f\r'
+
+
+def _segment(text: str, preformatted: bool):
+    """ Whitespace only segments are collapsed outside of preformatted tags, as in html.parser soups """
+    if preformatted or text.strip(ascii_whitespace) != '':
+        return text
+    return '\n' if '\n' in text else ' '
+
+
+def _preformatted(node):
+    parent = node.parent
+    while parent is not None:
+        if parent.tag in preformatted_tags:
+            return True
+        parent = parent.parent
+    return False
+
+
+def _extract_selectolax(html: str):
+    from selectolax.lexbor import LexborHTMLParser
+    tree = LexborHTMLParser(html)
+    hrefs = [a.attributes.get('href') for a in tree.css('a')]
+    tree.strip_tags(skipped_tags)
+    texts = []
+    for node in tree.root.traverse(include_text=True):
+        if node.is_text_node:
+            text = node.text_content
+            texts.append(_segment(text, text.strip(ascii_whitespace) == '' and _preformatted(node)))
+    return {'texts': texts, 'hrefs': [h for h in hrefs if h is not None]}
+
+
+def _extract_lxml(html: str):
+    import lxml.html
+    from lxml import etree
+    try:
+        root = lxml.html.document_fromstring(html)
+    except ValueError:
+        root = lxml.html.document_fromstring(html.encode('utf-8'))  # str with an XML encoding declaration
+    except etree.ParserError:
+        return {'texts': [], 'hrefs': []}  # empty document
+
+    texts = []
+    hrefs = []
+    skip_depth = 0
+    pre_depth = 0
+    for event, element in etree.iterwalk(root, events=('start', 'end', 'comment', 'pi')):
+        tag = element.tag if isinstance(element.tag, str) else None  # comments and processing instructions
+        if event == 'start':
+            if tag == 'a' and element.get('href') is not None:
+                hrefs.append(element.get('href'))
+            if tag in preformatted_tags:
+                pre_depth += 1
+            if tag in skipped_tags:
+                skip_depth += 1
+            elif skip_depth == 0 and tag is not None and element.text:
+                texts.append(_segment(element.text, pre_depth > 0))
+        else:  # end of an element, comment or processing instruction
+            if tag in preformatted_tags:
+                pre_depth -= 1
+            if tag in skipped_tags:
+                skip_depth -= 1
+            if skip_depth == 0 and element.tail and element is not root:
+                texts.append(_segment(element.tail, pre_depth > 0))
+    return {'texts': texts, 'hrefs': hrefs}
+
+
+def _extract_bs4(html: str):
+    """ Output of the former soup parsing (script and style strings included, as empty segments) """
+    soup = BeautifulSoup(html, 'html.parser')
+    hrefs = [a.get('href') for a in soup.find_all('a')]
+    return {'texts': [p.text for p in soup.find_all(string=True)], 'hrefs': [h for h in hrefs if h is not None]}
+
+
+extractors = {'selectolax': _extract_selectolax, 'lxml': _extract_lxml, 'bs4': _extract_bs4}
+
+
+def extract(html: str, engine: str = html_extractor):
+    """ {'texts': text segments in document order, 'hrefs': link targets} of a page """
+    return extractors[engine](html or '')
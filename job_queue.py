@@ -0,0 +1,207 @@
+import json
+import math
+import time
+import queue
+import itertools
+import threading
+import database_connection as db
+
+# Worker pool settings
+with open('config.json', 'r') as file:
+    config = json.load(file)
+
+job_backend = config.get('JOB_BACKEND', 'thread')  # 'thread': in-process worker pool, 'mongo': durable queue served by worker.py
+max_workers = config.get('MAX_WORKERS', 4)  # jobs processed at the same time
+max_queue_size = config.get('MAX_QUEUE_SIZE', 50)  # high-water mark of waiting jobs, beyond this requests are rejected
+default_retry_after = 30  # seconds, used until the first job finishes
+
+
+class QueueFullError(Exception):
+    """ Raised when the waiting jobs reached the high-water mark """
+    def __init__(self, retry_after: int):
+        super().__init__(f'Job queue is full. Retry after {retry_after} seconds.')
+        self.retry_after = retry_after
+
+
+_jobs = queue.Queue()
+_lock = threading.Lock()
+_job_ids = itertools.count()
+_waiting = {}  # job id -> job
+_running = {}  # job id -> job
+_inflight = {}  # taskid -> latest waiting or running job (single-flight)
+_workers = []
+_finished_count = 0
+_avg_duration = None  # exponential moving average of job durations (seconds)
+
+
+def start_job(job: dict):
+    """ Move a waiting job to running. False if it was cancelled while waiting (it is not run). """
+    with _lock:
+        _waiting.pop(job['id'], None)
+        if job['cancel'].is_set():
+            return False
+        job['startedAt'] = time.time()
+        _running[job['id']] = job
+        return True
+
+
+def finish_job(job: dict, status: str = 'done', error: str = None):
+    """ Release a started or skipped job. status and error are reported to the batch items attached to it. """
+    global _finished_count, _avg_duration
+    with _lock:
+        _waiting.pop(job['id'], None)
+        _running.pop(job['id'], None)
+        if _inflight.get(job['taskid']) is job:
+            _inflight.pop(job['taskid'])
+        if 'startedAt' in job:
+            duration = time.time() - job['startedAt']
+            _finished_count += 1
+            _avg_duration = duration if _avg_duration is None else 0.8 * _avg_duration + 0.2 * duration
+        batches, job['batches'] = job['batches'], []
+    for batch_id in batches:
+        try:
+            db.update_batch_item(batch_id, job['taskid'], status, error)
+        except Exception as e:
+            job['logger'].error(f'[{job["taskid"]}] Batch {batch_id} update failed: {e}')
+
+
+def _worker():
+    while True:
+        job = _jobs.get()
+        status, error = 'cancelled', None
+        try:
+            if not start_job(job):
+                job['logger'].info(f'[{job["taskid"]}] Superseded job skipped.')
+                continue
+            job['target'](*job['args'], cancel=job['cancel'])
+            status = 'cancelled' if job['cancel'].is_set() else 'done'
+        except Exception as e:
+            job['logger'].error(f'[{job["taskid"]}] Processing job failed: {e}')
+            status, error = 'failed', str(e)
+        finally:
+            finish_job(job, status, error)
+            _jobs.task_done()
+
+
+def _start_workers():
+    """ Lazily start the worker threads (called with _lock held) """
+    while len(_workers) < max_workers:
+        worker = threading.Thread(target=_worker, daemon=True, name=f'scoring-worker-{len(_workers)}')
+        worker.start()
+        _workers.append(worker)
+
+
+def _estimate_retry_after(count: int = 1):
+    """ Rough estimate of the seconds needed until count queue slots free up (called with _lock held) """
+    if _avg_duration is None:
+        return default_retry_after
+    return max(1, math.ceil(_avg_duration * (len(_waiting) + count - max_queue_size) / max_workers))
+
+
+def _admit(taskid: str, target, args: tuple, logger, force: bool = False):
+    """
+    Register a waiting job (called with _lock held). Returns None if a job of the taskid is in progress
+    (the request is attached to it). A forced job cancels the one in progress.
+    """
+    previous = _inflight.get(taskid)
+    if previous is not None and not force:
+        logger.info(f'[{taskid}] Job already in progress, attaching request to it.')
+        return None
+    if len(_waiting) >= max_queue_size:
+        raise QueueFullError(_estimate_retry_after())
+    job = {
+        'id': next(_job_ids),
+        'taskid': taskid,
+        'target': target,
+        'args': args,
+        'logger': logger,
+        'enqueuedAt': time.time(),
+        'cancel': threading.Event(),
+        'batches': [],  # ids of the batches with an item attached to this job
+    }
+    if previous is not None:
+        previous['cancel'].set()  # the superseded run stops at its next stage check without saving anything
+        job['batches'], previous['batches'] = previous['batches'], []  # attached items follow the new run
+        logger.warning(f'[{taskid}] Forced request, the job in progress is cancelled.')
+    _waiting[job['id']] = job
+    _inflight[taskid] = job
+    return job
+
+
+def submit(taskid: str, target, args: tuple, logger, force: bool = False):
+    """
+    Put a processing job in the queue. Raises QueueFullError when past the high-water mark.
+    Returns False if a job of the taskid is already waiting or running (the request is attached to it),
+    unless force is set which cancels that job and starts a fresh run.
+    target is called with args and cancel (threading.Event, set when the job is superseded).
+    """
+    with _lock:
+        job = _admit(taskid, target, args, logger, force)
+        if job is None:
+            return False
+        _start_workers()
+    _jobs.put(job)
+    logger.info(f'[{taskid}] Job queued. Waiting jobs: {len(_waiting)}')
+    return True
+
+
+def admit_batch(batch_id: str, taskids: list, logger):
+    """
+    Register the waiting jobs of a batch, all of them or none (QueueFullError past the high-water mark).
+    Returns {taskid: job}, job is None if the project is already in progress: the batch item is attached to that job
+    and gets its final status when it finishes. The jobs are run by the batch pipeline (start_job, finish_job).
+    """
+    with _lock:
+        count = len([taskid for taskid in taskids if taskid not in _inflight])
+        if len(_waiting) + count > max_queue_size:
+            raise QueueFullError(_estimate_retry_after(count))
+        jobs = {taskid: _admit(taskid, None, (), logger) for taskid in taskids}
+        for taskid, job in jobs.items():
+            if job is None:
+                _inflight[taskid]['batches'].append(batch_id)
+        return jobs
+
+
+def check_durable_capacity(count: int = 1):
+    """ Raises QueueFullError if count more jobs would pass the high-water mark of the Mongo job queue """
+    if db.get_job_stats()['queued_jobs'] + count > max_queue_size:
+        raise QueueFullError(default_retry_after)
+
+
+def submit_durable(taskid: str, url: str, logger, force: bool = False):
+    """ Put a processing job in the Mongo job queue, same semantics as submit """
+    check_durable_capacity()
+    queued = db.enqueue_job(taskid, url, force)
+    if queued:
+        logger.info(f'[{taskid}] Job stored in the durable queue.')
+    else:
+        logger.info(f'[{taskid}] Job already in progress, attaching request to it.')
+    return queued
+
+
+def stats():
+    """ Current workload of the worker pool """
+    if job_backend == 'mongo':
+        job_stats = db.get_job_stats()
+        return {
+            'backend': job_backend,
+            'max_queue_size': max_queue_size,
+            'queue_depth': job_stats['queued_jobs'] + job_stats['running_jobs'],
+            'running_jobs': job_stats['running_jobs'],
+            'waiting_jobs': job_stats['queued_jobs'],
+            'oldest_job_age': job_stats['oldest_job_age'],
+        }
+
+    now = time.time()
+    with _lock:
+        enqueued = [job['enqueuedAt'] for job in list(_waiting.values()) + list(_running.values())]
+        return {
+            'backend': job_backend,
+            'workers': max_workers,
+            'max_queue_size': max_queue_size,
+            'queue_depth': len(_waiting) + len(_running),
+            'running_jobs': len(_running),
+            'waiting_jobs': len(_waiting),
+            'oldest_job_age': round(now - min(enqueued), 1) if len(enqueued) > 0 else 0,
+            'finished_jobs': _finished_count,
+        }
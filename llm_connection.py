@@ -1,91 +1,304 @@
 import json
+import base64
+import asyncio
+import weakref
+import threading
+import contextlib
 import openai
+import httpx
+import numpy as np
 from mistralai.client import MistralClient
+from mistralai.async_client import MistralAsyncClient
 from mistralai.models.chat_completion import ChatMessage
 import requests
+from requests.adapters import HTTPAdapter
+from rate_limiter import get_limiter, throttle_on_error, estimate_tokens
 
 # API keys
 with open('config.json', 'r') as file:
     config = json.load(file)
 
-openai_client = openai.OpenAI(api_key=config['OPENAI_API_KEY'])
-mistral_client = MistralClient(api_key=config["MISTRAL_API_KEY"])
+llm_timeout = config.get('LLM_TIMEOUT', 120)  # seconds per request
+llm_pool_size = config.get('LLM_POOL_SIZE', 20)  # keep-alive connections per provider
+
+# Provider SDK retries are disabled, 429 responses are handled by the rate limiters and the callers' retry loops
+openai_client = openai.OpenAI(api_key=config['OPENAI_API_KEY'], timeout=llm_timeout, max_retries=0)
+mistral_client = MistralClient(api_key=config["MISTRAL_API_KEY"], timeout=llm_timeout)
 genai_key=config["GEMINI_API_KEY"]
 
+# Pooled keep-alive session for Gemini (the REST API is called directly)
+gemini_session = requests.Session()
+gemini_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=llm_pool_size))
+
+# Max in-flight requests per provider (shared by every job of the process)
+provider_concurrency = {
+    'openai': config.get('OPENAI_MAX_CONCURRENCY', 8),
+    'mistral': config.get('MISTRAL_MAX_CONCURRENCY', 4),
+    'gemini': config.get('GEMINI_MAX_CONCURRENCY', 4),
+}
+provider_limits = {provider: threading.BoundedSemaphore(limit) for provider, limit in provider_concurrency.items()}
+
+openai_chat_model = "gpt-4-0125-preview"
+openai_embedding_model = "text-embedding-3-small"
+mistral_chat_model = "mistral-large-latest"
+gemini_chat_model = "gemini-pro"
+gemini_url = f"https://generativelanguage.googleapis.com/v1beta/models/{gemini_chat_model}:generateContent"
+
+
+def clean_completion(text: str):
+    """ Remove markdown code block decoration around JSON answers """
+    return text.replace('```', '').replace('json', '')
+
+
+def decode_embeddings(data, encoding_format: str):
+    """ Embedding response items as a float32 matrix. base64 skips parsing thousands of JSON floats per chunk. """
+    if encoding_format == 'base64':
+        return np.vstack([np.frombuffer(base64.b64decode(item.embedding), dtype=np.float32) for item in data])
+    return np.asarray([item.embedding for item in data], dtype=np.float32)
+
 
-def get_openai_embedding(text, client=openai_client):
+def gemini_request_body(prompt, temp):
+    return {
+        "contents": [{
+            "parts": [{
+                "text": prompt
+            }]
+        }],
+        "safetySettings": [
+            {
+                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+                "threshold": "BLOCK_NONE"
+            }
+        ],
+        "generationConfig": {
+            "temperature": temp,
+            "candidate_count": 1
+        }
+    }
+
+
+def get_openai_embedding(text, client=openai_client, encoding_format="base64"):
+    limiter = get_limiter('openai', openai_embedding_model)
     try:
-        response = client.embeddings.create(model="text-embedding-3-small",
-                                            input=text,
-                                            encoding_format="float")
-        return response.data[0].embedding
-    except:
+        limiter.acquire(estimate_tokens(text))
+        with provider_limits['openai']:
+            raw_response = client.embeddings.with_raw_response.create(model=openai_embedding_model,
+                                                                      input=text,
+                                                                      encoding_format=encoding_format)
+        limiter.update_from_headers(raw_response.headers)
+        return decode_embeddings(raw_response.parse().data, encoding_format)[0]
+    except Exception as e:
+        throttle_on_error(limiter, e)
         return None
 
 
-def get_multiple_openai_embedding(text_list, logger, client=openai_client):
+def get_multiple_openai_embedding(text_list, logger, client=openai_client, encoding_format="base64"):
+    """ Embeddings as a float32 matrix (one row per text) """
+    limiter = get_limiter('openai', openai_embedding_model)
     try:
-        response = client.embeddings.create(model="text-embedding-3-small",
-                                            input=text_list,
-                                            encoding_format="float")
-        return [item.embedding for item in response.data]
+        limiter.acquire(estimate_tokens(text_list))
+        with provider_limits['openai']:
+            raw_response = client.embeddings.with_raw_response.create(model=openai_embedding_model,
+                                                                      input=text_list,
+                                                                      encoding_format=encoding_format)
+        limiter.update_from_headers(raw_response.headers)
+        return decode_embeddings(raw_response.parse().data, encoding_format)
     except Exception as e:
+        throttle_on_error(limiter, e)
         logger.error(f'OpenAI embedding failed. {e}')
         return None
 
 
 def get_openai_completion(prompt, logger, client=openai_client, temp=0.0):
+    limiter = get_limiter('openai', openai_chat_model)
     try:
-        chat_completion = client.chat.completions.create(messages=[{"role": "user", "content": prompt}],
-                                                         model="gpt-4-0125-preview",
-                                                         temperature=temp)
-        return chat_completion.choices[0].message.content.replace('```', '').replace('json', '')
+        limiter.acquire(estimate_tokens(prompt))
+        with provider_limits['openai']:
+            raw_response = client.chat.completions.with_raw_response.create(messages=[{"role": "user", "content": prompt}],
+                                                                            model=openai_chat_model,
+                                                                            temperature=temp)
+        limiter.update_from_headers(raw_response.headers)
+        return clean_completion(raw_response.parse().choices[0].message.content)
     except Exception as e:
+        throttle_on_error(limiter, e)
         logger.error(f'Openai answer generation error: {e}')
         return None
 
 
 def get_mistral_completion(prompt, logger, client=mistral_client, temp=0.0):
+    limiter = get_limiter('mistral', mistral_chat_model)
     try:
-        chat_completion = client.chat(messages=[ChatMessage(role="user", content=prompt)],
-                                      model="mistral-large-latest",
-                                      temperature=temp,
-                                      safe_mode=False)
-        return chat_completion.choices[0].message.content.replace('```', '').replace('json', '')
+        limiter.acquire(estimate_tokens(prompt))
+        with provider_limits['mistral']:
+            chat_completion = client.chat(messages=[ChatMessage(role="user", content=prompt)],
+                                          model=mistral_chat_model,
+                                          temperature=temp,
+                                          safe_mode=False)
+        return clean_completion(chat_completion.choices[0].message.content)
     except Exception as e:
+        throttle_on_error(limiter, e)
         logger.error(f'Mistral answer generation error: {e}')
         return None
 
 
-def get_gemini_completion(prompt, logger, temp=0.0):
+def get_gemini_completion(prompt, logger, temp=0.0, session=gemini_session):
+    limiter = get_limiter('gemini', gemini_chat_model)
     try:
-        url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent"
         headers = {
             'Content-Type': 'application/json',
         }
         params = {
             'key': genai_key,
         }
-        data = {
-            "contents": [{
-                "parts": [{
-                    "text": prompt
-                }]
-            }],
-            "safetySettings": [
-                {
-                    "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                    "threshold": "BLOCK_NONE"
-                }
-            ],
-            "generationConfig": {
-                "temperature": temp,
-                "candidate_count": 1
-            }
+        limiter.acquire(estimate_tokens(prompt))
+        with provider_limits['gemini']:
+            response = session.post(gemini_url, headers=headers, params=params, json=gemini_request_body(prompt, temp),
+                                    timeout=llm_timeout)
+        if response.status_code == 429:
+            limiter.throttle(response.headers)
+        chat_completion = response.json()
+        return clean_completion(chat_completion['candidates'][0]['content']['parts'][0]['text'])
+    except Exception as e:
+        logger.error(f'Gemini answer generation error: {e}')
+        return None
+
+
+### Async clients ###
+# Async clients are bound to the event loop they are used on, so they are created once per loop.
+# The agents of every job run on one process-wide loop (submit_coroutine) and share its connection pools.
+
+_async_clients = weakref.WeakKeyDictionary()
+_async_loop = None
+_async_loop_lock = threading.Lock()
+
+
+def get_async_loop():
+    """ Event loop of the async LLM calls, run by a daemon thread and shared by every job of the process """
+    global _async_loop
+    with _async_loop_lock:
+        if _async_loop is None or _async_loop.is_closed():
+            _async_loop = asyncio.new_event_loop()
+            threading.Thread(target=_async_loop.run_forever, name='llm-async-loop', daemon=True).start()
+        return _async_loop
+
+
+def submit_coroutine(coroutine):
+    """ Run a coroutine on the shared loop. Returns a concurrent.futures.Future, cancelling it cancels the coroutine. """
+    return asyncio.run_coroutine_threadsafe(coroutine, get_async_loop())
+
+
+def get_async_clients():
+    """ Pooled async clients of the running event loop """
+    loop = asyncio.get_running_loop()
+    if loop not in _async_clients:
+        limits = httpx.Limits(max_connections=llm_pool_size, max_keepalive_connections=llm_pool_size)
+        _async_clients[loop] = {
+            'openai': openai.AsyncOpenAI(api_key=config['OPENAI_API_KEY'], timeout=llm_timeout, max_retries=0,
+                                         http_client=httpx.AsyncClient(limits=limits, timeout=llm_timeout)),
+            'mistral': MistralAsyncClient(api_key=config["MISTRAL_API_KEY"], timeout=llm_timeout,
+                                          max_concurrent_requests=provider_concurrency['mistral']),
+            'gemini': httpx.AsyncClient(limits=limits, timeout=llm_timeout),
+        }
+    return _async_clients[loop]
+
+
+@contextlib.asynccontextmanager
+async def provider_slot(provider: str):
+    """ Slot of the process-wide provider limit (shared with the sync calls) without blocking the event loop """
+    limit = provider_limits[provider]
+    while not limit.acquire(blocking=False):
+        await asyncio.sleep(0.05)
+    try:
+        yield
+    finally:
+        limit.release()
+
+
+async def aget_openai_embedding(text, client=None, encoding_format="base64"):
+    client = client or get_async_clients()['openai']
+    limiter = get_limiter('openai', openai_embedding_model)
+    try:
+        await limiter.aacquire(estimate_tokens(text))
+        async with provider_slot('openai'):
+            raw_response = await client.embeddings.with_raw_response.create(model=openai_embedding_model,
+                                                                            input=text,
+                                                                            encoding_format=encoding_format)
+        limiter.update_from_headers(raw_response.headers)
+        return decode_embeddings(raw_response.parse().data, encoding_format)[0]
+    except Exception as e:
+        throttle_on_error(limiter, e)
+        return None
+
+
+async def aget_multiple_openai_embedding(text_list, logger, client=None, encoding_format="base64"):
+    """ Embeddings as a float32 matrix (one row per text) """
+    client = client or get_async_clients()['openai']
+    limiter = get_limiter('openai', openai_embedding_model)
+    try:
+        await limiter.aacquire(estimate_tokens(text_list))
+        async with provider_slot('openai'):
+            raw_response = await client.embeddings.with_raw_response.create(model=openai_embedding_model,
+                                                                            input=text_list,
+                                                                            encoding_format=encoding_format)
+        limiter.update_from_headers(raw_response.headers)
+        return decode_embeddings(raw_response.parse().data, encoding_format)
+    except Exception as e:
+        throttle_on_error(limiter, e)
+        logger.error(f'OpenAI embedding failed. {e}')
+        return None
+
+
+async def aget_openai_completion(prompt, logger, client=None, temp=0.0):
+    client = client or get_async_clients()['openai']
+    limiter = get_limiter('openai', openai_chat_model)
+    try:
+        await limiter.aacquire(estimate_tokens(prompt))
+        async with provider_slot('openai'):
+            raw_response = await client.chat.completions.with_raw_response.create(messages=[{"role": "user", "content": prompt}],
+                                                                                  model=openai_chat_model,
+                                                                                  temperature=temp)
+        limiter.update_from_headers(raw_response.headers)
+        return clean_completion(raw_response.parse().choices[0].message.content)
+    except Exception as e:
+        throttle_on_error(limiter, e)
+        logger.error(f'Openai answer generation error: {e}')
+        return None
+
+
+async def aget_mistral_completion(prompt, logger, client=None, temp=0.0):
+    client = client or get_async_clients()['mistral']
+    limiter = get_limiter('mistral', mistral_chat_model)
+    try:
+        await limiter.aacquire(estimate_tokens(prompt))
+        async with provider_slot('mistral'):
+            chat_completion = await client.chat(messages=[ChatMessage(role="user", content=prompt)],
+                                                model=mistral_chat_model,
+                                                temperature=temp,
+                                                safe_mode=False)
+        return clean_completion(chat_completion.choices[0].message.content)
+    except Exception as e:
+        throttle_on_error(limiter, e)
+        logger.error(f'Mistral answer generation error: {e}')
+        return None
+
+
+async def aget_gemini_completion(prompt, logger, temp=0.0, session=None):
+    session = session or get_async_clients()['gemini']
+    limiter = get_limiter('gemini', gemini_chat_model)
+    try:
+        headers = {
+            'Content-Type': 'application/json',
+        }
+        params = {
+            'key': genai_key,
         }
-        response = requests.post(url, headers=headers, params=params, json=data)
+        await limiter.aacquire(estimate_tokens(prompt))
+        async with provider_slot('gemini'):
+            response = await session.post(gemini_url, headers=headers, params=params, json=gemini_request_body(prompt, temp))
+        if response.status_code == 429:
+            limiter.throttle(response.headers)
         chat_completion = response.json()
-        return chat_completion['candidates'][0]['content']['parts'][0]['text'].replace('```', '').replace('json', '')
+        return clean_completion(chat_completion['candidates'][0]['content']['parts'][0]['text'])
     except Exception as e:
         logger.error(f'Gemini answer generation error: {e}')
         return None
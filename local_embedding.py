@@ -0,0 +1,54 @@
+import os
+import json
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# Local CPU embedding model (sentence-transformers, torch or ONNX runtime) served by a process pool.
+# Needs: pip install sentence-transformers (and optimum[onnxruntime] for the onnx runtime)
+with open('config.json', 'r') as file:
+    config = json.load(file)
+
+local_embedding_model = config.get('LOCAL_EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+local_embedding_runtime = config.get('LOCAL_EMBEDDING_RUNTIME', 'torch')  # 'torch' or 'onnx'
+local_embedding_processes = config.get('LOCAL_EMBEDDING_PROCESSES', 2)
+encode_batch_size = 64
+
+_model = None  # loaded once per pool process
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _encode(model_name: str, runtime: str, texts: list):
+    """ Runs in the pool processes """
+    global _model
+    if _model is None:
+        import torch
+        from sentence_transformers import SentenceTransformer
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_embedding_processes))  # no oversubscription
+        _model = SentenceTransformer(model_name, device='cpu', backend=runtime)
+    return _model.encode(texts, batch_size=encode_batch_size, convert_to_numpy=True,
+                         normalize_embeddings=True).astype(np.float32)
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: the API process has running threads, forking it is not safe
+            _pool = ProcessPoolExecutor(max_workers=local_embedding_processes, mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def get_local_embeddings(text_list, logger=None):
+    """ Embeddings as a float32 matrix (one row per text), None on error """
+    try:
+        if multiprocessing.parent_process() is not None:
+            # pool processes re-import the main module, imports that embed must not start pools of their own
+            return _encode(local_embedding_model, local_embedding_runtime, list(text_list))
+        return _get_pool().submit(_encode, local_embedding_model, local_embedding_runtime, list(text_list)).result()
+    except Exception as e:
+        if logger is not None:
+            logger.error(f'Local embedding failed: {e}')
+        return None
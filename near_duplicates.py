@@ -0,0 +1,116 @@
+import re
+import json
+import zlib
+import hashlib
+from collections import Counter
+import numpy as np
+from rate_limiter import estimate_tokens
+
+# Near-duplicate chunk filter (MinHash over word shingles with LSH banding). Site headers, cookie banners, footers
+# and doc sidebars are repeated on every crawled page, only their first occurrence is embedded.
+# The crawlers drop repeated pages and documents with the same index (normalized text digests first).
+with open('config.json', 'r') as file:
+    config = json.load(file)
+
+near_duplicate_threshold = config.get('NEAR_DUPLICATE_THRESHOLD', 0.8)  # estimated Jaccard similarity, 0 disables the filter
+page_near_duplicate_threshold = config.get('PAGE_NEAR_DUPLICATE_THRESHOLD', 0)  # crawled texts, 0: exact duplicates only
+
+shingle_size = 5  # words
+num_permutations = 64
+bands = 16  # LSH bands of num_permutations / bands rows, candidate pairs are then checked against the threshold
+rows_per_band = num_permutations // bands
+_prime = (1 << 61) - 1
+_rng = np.random.RandomState(42)  # fixed, signatures are comparable across processes
+_a = _rng.randint(1, 1 << 32, size=num_permutations, dtype=np.uint64)
+_b = _rng.randint(0, 1 << 32, size=num_permutations, dtype=np.uint64)
+
+
+def shingles(text: str):
+    """ crc32 hashes of the word shingles of a text (lowercase, whitespace insensitive) """
+    words = re.findall(r'\w+', text.lower())
+    if len(words) == 0:
+        return np.empty(0, dtype=np.uint64)
+    grams = {' '.join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))}
+    return np.fromiter((zlib.crc32(g.encode('utf-8')) for g in grams), dtype=np.uint64, count=len(grams))
+
+
+def minhash(hashes):
+    """ MinHash signature of a shingle set. a * x + b stays below 2^64 (32 bit operands), no overflow. """
+    return ((np.outer(hashes, _a) + _b) % _prime).min(axis=0)
+
+
+class MinHashIndex:
+    """ Signatures of the kept texts in LSH buckets """
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.buckets = [{} for _ in range(bands)]  # band values -> signatures
+
+    def add(self, text: str):
+        """ False if the text is a near-duplicate of an added one, otherwise it is added (texts without words are not) """
+        hashes = shingles(text)
+        if len(hashes) == 0:
+            return True
+        signature = minhash(hashes)
+        band_keys = [signature[i * rows_per_band:(i + 1) * rows_per_band].tobytes() for i in range(bands)]
+        candidates = {id(s): s for band, key in zip(self.buckets, band_keys) for s in band.get(key, [])}
+        if any(np.mean(signature == s) >= self.threshold for s in candidates.values()):
+            return False
+        for band, key in zip(self.buckets, band_keys):
+            band.setdefault(key, []).append(signature)
+        return True
+
+
+def drop_near_duplicates(text_chunks: list, logger=None, threshold: float = near_duplicate_threshold):
+    """
+    Chunks without the near-duplicates of earlier chunks (order is kept).
+    Returns the kept chunks and the removal counts {'chunks': ..., 'tokens': ...}.
+    """
+    removed = {'chunks': 0, 'tokens': 0}
+    if not threshold or len(text_chunks) < 2:
+        return text_chunks, removed
+
+    index = MinHashIndex(threshold)
+    kept = []
+    for chunk in text_chunks:
+        if not index.add(chunk):
+            removed['chunks'] += 1
+            removed['tokens'] += estimate_tokens(chunk)
+            continue
+        kept.append(chunk)
+
+    if logger is not None and removed['chunks'] > 0:
+        logger.info(f'Near-duplicate chunks removed: {removed["chunks"]}/{len(text_chunks)}; '
+                    f'estimated tokens removed: {removed["tokens"]}')
+    return kept, removed
+
+
+def text_digest(text: str):
+    """ Digest of the text with case and whitespace differences removed """
+    return hashlib.sha1(' '.join(text.lower().split()).encode('utf-8')).digest()
+
+
+class ContentIndex:
+    """ Page and document texts of a crawl: exact duplicates by digest, near-duplicates if a threshold is set """
+    def __init__(self, threshold: float = page_near_duplicate_threshold):
+        self.digests = set()
+        self.near = MinHashIndex(threshold) if threshold else None
+        self.dropped = Counter()  # kind -> dropped texts
+        self.dropped_near = Counter()  # kind -> dropped near-duplicates (part of dropped)
+
+    def add(self, text: str, kind: str = 'pages'):
+        """ True if the text is new (it is indexed), False if it duplicates an earlier page or document """
+        digest = text_digest(text)
+        if digest in self.digests:
+            self.dropped[kind] += 1
+            return False
+        if self.near is not None and not self.near.add(text):
+            self.dropped[kind] += 1
+            self.dropped_near[kind] += 1
+            return False
+        self.digests.add(digest)
+        return True
+
+    def log_dropped(self, logger):
+        if sum(self.dropped.values()) > 0:
+            counts = '; '.join(f'{kind}: {count} ({self.dropped_near[kind]} near-duplicates)' for kind, count in self.dropped.items())
+            logger.info(f'Duplicate texts dropped - {counts}')
@@ -0,0 +1,131 @@
+import json
+import time
+import sqlite3
+import hashlib
+import asyncio
+import threading
+from urllib.parse import urlsplit, urlunsplit
+import httpx
+
+# Extracted texts of crawled pages and documents with their HTTP validators (ETag, Last-Modified, body hash).
+# Re-crawls send conditional requests and reuse the text of unchanged pages instead of scraping and parsing them again.
+with open('config.json', 'r') as file:
+    config = json.load(file)
+
+page_cache_path = config.get('PAGE_CACHE_PATH', 'page_cache.sqlite')
+page_cache_max_bytes = config.get('PAGE_CACHE_MAX_MB', 512) * 1024 * 1024  # least recently used pages are evicted beyond this
+probe_concurrency = config.get('PAGE_CACHE_PROBE_CONCURRENCY', 16)  # conditional requests in flight per crawl
+probe_timeout = config.get('PAGE_CACHE_PROBE_TIMEOUT', 20)
+
+_lock = threading.Lock()
+_connection = sqlite3.connect(page_cache_path, check_same_thread=False, timeout=10)
+_connection.execute('CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, '
+                    'body_hash TEXT, text TEXT, size INTEGER, last_used REAL)')
+_connection.execute('CREATE INDEX IF NOT EXISTS pages_last_used ON pages (last_used)')
+_connection.commit()
+_total_size = _connection.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+
+
+def normalize_url(url: str):
+    """ Cache key: lowercase scheme and host, no fragment, no trailing slash """
+    parts = urlsplit(url.strip())
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/'), parts.query, ''))
+
+
+def body_hash(body: bytes):
+    return hashlib.sha256(body).hexdigest()
+
+
+def lookup(url: str):
+    """ Cached entry of a page or None """
+    with _lock:
+        row = _connection.execute('SELECT etag, last_modified, body_hash, text FROM pages WHERE url = ?',
+                                  (normalize_url(url),)).fetchone()
+    if row is None:
+        return None
+    return {'etag': row[0], 'last_modified': row[1], 'body_hash': row[2], 'text': row[3]}
+
+
+def conditional_headers(entry):
+    headers = {}
+    if entry is not None and entry['etag']:
+        headers['If-None-Match'] = entry['etag']
+    if entry is not None and entry['last_modified']:
+        headers['If-Modified-Since'] = entry['last_modified']
+    return headers
+
+
+def revalidate(url: str, entry, status_code: int, headers, body: bytes, rendered: bool = False):
+    """
+    Cached text if the page did not change (304 or same body hash), otherwise None.
+    Also returns the validators of the response, stored with the new text of changed pages. They are None for error
+    and other non-2xx responses (a 403 or bot-check body says nothing about the page, nothing is stored).
+    rendered: the text is taken from the page rendered by a browser. Scripts may load content the raw body does not
+    contain, so only a 304 (ETag, Last-Modified) proves the page unchanged and no body hash is kept.
+    """
+    if entry is not None and status_code == 304:
+        validators = {'etag': headers.get('etag') or entry['etag'],
+                      'last_modified': headers.get('last-modified') or entry['last_modified'],
+                      'body_hash': entry['body_hash']}
+        store(url, entry['text'], validators)  # refreshes the validators and the last use
+        return entry['text'], validators
+    if not 200 <= status_code < 300:
+        return None, None
+    validators = {'etag': headers.get('etag'), 'last_modified': headers.get('last-modified'),
+                  'body_hash': None if rendered else body_hash(body)}
+    if entry is not None and validators['body_hash'] is not None and validators['body_hash'] == entry['body_hash']:
+        store(url, entry['text'], validators)
+        return entry['text'], validators
+    return None, validators
+
+
+def store(url: str, text: str, validators: dict):
+    """ Save the extracted text of a page and evict the least recently used pages if the cache is full """
+    global _total_size
+    if len(text) == 0:
+        return
+    key = normalize_url(url)
+    size = len(text.encode('utf-8'))
+    with _lock:
+        previous = _connection.execute('SELECT size FROM pages WHERE url = ?', (key,)).fetchone()
+        _connection.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (key, validators['etag'], validators['last_modified'], validators['body_hash'], text, size, time.time()))
+        _total_size += size - (previous[0] if previous is not None else 0)
+        while _total_size > page_cache_max_bytes:
+            oldest = _connection.execute('SELECT url, size FROM pages ORDER BY last_used LIMIT 100').fetchall()
+            if len(oldest) == 0:
+                break
+            for url_, size_ in oldest:
+                if _total_size <= page_cache_max_bytes:
+                    break
+                _connection.execute('DELETE FROM pages WHERE url = ?', (url_,))
+                _total_size -= size_
+        _connection.commit()
+
+
+async def aprobe(client: httpx.AsyncClient, url: str, limit: asyncio.Semaphore, rendered: bool = False):
+    """ Conditional GET of a page: (cached text or None, validators or None if the request failed or was not 2xx) """
+    entry = lookup(url)
+    try:
+        async with limit:
+            response = await client.get(url, headers=conditional_headers(entry))
+    except Exception:
+        return None, None
+    return revalidate(url, entry, response.status_code, response.headers, response.content, rendered)
+
+
+async def aprobe_all(urls: list, rendered: bool = False):
+    """ Cached texts of the unchanged pages and the validators of the others, by URL (rendered: see revalidate) """
+    limit = asyncio.Semaphore(probe_concurrency)
+    async with httpx.AsyncClient(timeout=probe_timeout, follow_redirects=True) as client:
+        results = await asyncio.gather(*(aprobe(client, url, limit, rendered) for url in urls))
+    texts = {url: text for url, (text, _) in zip(urls, results) if text is not None}
+    validators = {url: v for url, (text, v) in zip(urls, results) if text is None and v is not None}
+    return texts, validators
+
+
+def log_usage(stats: dict, logger):
+    """ stats: hit and miss counts of a crawl """
+    total = stats['hits'] + stats['misses']
+    if total > 0:
+        logger.info(f'Page cache hits: {stats["hits"]}/{total}; misses: {stats["misses"]}')
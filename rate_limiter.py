@@ -0,0 +1,184 @@
+import re
+import json
+import time
+import asyncio
+import datetime
+import threading
+from email.utils import parsedate_to_datetime
+
+# Requests per minute and tokens per minute by "provider/model". Override with RATE_LIMITS in config.json.
+with open('config.json', 'r') as file:
+    config = json.load(file)
+
+default_rate_limits = {
+    'openai/gpt-4-0125-preview': {'rpm': 500, 'tpm': 300000},
+    'openai/text-embedding-3-small': {'rpm': 3000, 'tpm': 1000000},
+    'mistral/mistral-large-latest': {'rpm': 300, 'tpm': 2000000},
+    'gemini/gemini-pro': {'rpm': 60, 'tpm': 1000000},
+}
+rate_limits = {**default_rate_limits, **config.get('RATE_LIMITS', {})}
+fallback_rate_limit = {'rpm': 60, 'tpm': 100000}  # for models without configured limits
+
+estimated_char_per_token = 3
+
+
+def estimate_tokens(text):
+    """ Cheap token estimation of a prompt or a list of embedding inputs """
+    if isinstance(text, list):
+        return sum(len(t) for t in text) // estimated_char_per_token + 1
+    return len(text) // estimated_char_per_token + 1
+
+
+def parse_duration(value: str):
+    """ Seconds from rate-limit reset values like '1s', '6m0s', '59.6ms' or '20' """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        pass
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value or '')
+    return sum(float(amount) * units[unit] for amount, unit in parts) if len(parts) > 0 else None
+
+
+def parse_retry_after(headers):
+    """ Seconds to wait based on Retry-After (seconds or HTTP date) or retry-after-ms headers """
+    if headers is None:
+        return None
+    if headers.get('retry-after-ms') is not None:
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    value = headers.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+        except Exception:
+            return None
+
+
+class RateLimiter:
+    """
+    Token bucket limiter for requests per minute and tokens per minute.
+    Capacity is reserved up front (the bucket may go negative) and the caller sleeps the returned time,
+    so waiting threads and coroutines are served in arrival order without a thundering herd.
+    """
+    def __init__(self, name: str, rpm: int, tpm: int):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.available_requests = float(rpm)
+        self.available_tokens = float(tpm)
+        self.blocked_until = 0.0  # set by 429 responses and exhausted rate-limit headers
+        self.updated = time.monotonic()
+        self.throttled_count = 0
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated
+        self.available_requests = min(self.rpm, self.available_requests + elapsed * self.rpm / 60)
+        self.available_tokens = min(self.tpm, self.available_tokens + elapsed * self.tpm / 60)
+        self.updated = now
+
+    def reserve(self, tokens: int = 1):
+        """ Reserve capacity for one request. Returns the seconds the caller has to wait before sending it. """
+        tokens = min(tokens, self.tpm)  # oversized requests would never fit the bucket
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.available_requests -= 1
+            self.available_tokens -= tokens
+            wait = max(0.0,
+                       -self.available_requests * 60 / self.rpm,
+                       -self.available_tokens * 60 / self.tpm,
+                       self.blocked_until - now)
+            if wait > 0:
+                self.throttled_count += 1
+            return wait
+
+    def acquire(self, tokens: int = 1):
+        time.sleep(self.reserve(tokens))
+
+    async def aacquire(self, tokens: int = 1):
+        await asyncio.sleep(self.reserve(tokens))
+
+    def block(self, seconds: float):
+        """ Stop sending requests for the given seconds (e.g. Retry-After of a 429 response) """
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers):
+        """ Sync the buckets with the x-ratelimit-* headers of the provider """
+        if headers is None:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            for kind in ('requests', 'tokens'):
+                remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+                if remaining is None:
+                    continue
+                try:
+                    remaining = float(remaining)
+                except ValueError:
+                    continue
+                if kind == 'requests':
+                    self.available_requests = min(self.available_requests, remaining)
+                else:
+                    self.available_tokens = min(self.available_tokens, remaining)
+                if remaining <= 0:
+                    reset = parse_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+                    if reset is not None:
+                        self.blocked_until = max(self.blocked_until, now + reset)
+
+    def throttle(self, headers, default_wait: float = 1.0):
+        """ Handle a 429 response """
+        retry_after = parse_retry_after(headers)
+        self.update_from_headers(headers)
+        self.block(retry_after if retry_after is not None else default_wait)
+
+    def saturation(self):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            return {
+                'rpm': self.rpm,
+                'tpm': self.tpm,
+                'request_saturation': round(1 - self.available_requests / self.rpm, 3),
+                'token_saturation': round(1 - self.available_tokens / self.tpm, 3),
+                'blocked_for': round(max(0.0, self.blocked_until - now), 1),
+                'throttled_requests': self.throttled_count,
+            }
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider: str, model: str):
+    """ Process-wide limiter of a provider model """
+    name = f'{provider}/{model}'
+    with _limiters_lock:
+        if name not in _limiters:
+            limits = rate_limits.get(name, fallback_rate_limit)
+            _limiters[name] = RateLimiter(name, limits['rpm'], limits['tpm'])
+        return _limiters[name]
+
+
+def throttle_on_error(limiter: RateLimiter, e: Exception):
+    """ Block the limiter if the exception of a provider client is a 429 response """
+    response = getattr(e, 'response', None)
+    status = getattr(response, 'status_code', None) or getattr(e, 'http_status', None) or getattr(e, 'status_code', None)
+    if status == 429:
+        limiter.throttle(getattr(response, 'headers', None) or getattr(e, 'headers', None))
+
+
+def saturation():
+    """ Saturation of every limiter used so far """
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.saturation() for limiter in limiters}
@@ -0,0 +1,100 @@
+import json
+import time
+import random
+import asyncio
+import threading
+
+# Retry policy shared by the LLM and embedding call sites
+with open('config.json', 'r') as file:
+    config = json.load(file)
+
+retry_base_delay = config.get('RETRY_BASE_DELAY', 1)  # seconds, doubled by every failed attempt
+retry_max_delay = config.get('RETRY_MAX_DELAY', 20)  # seconds, upper bound of a single backoff
+
+
+class DeadlineExceeded(Exception):
+    """ Raised when the time budget of a task ran out """
+
+
+class JobCancelled(Exception):
+    """ Raised when a run was cancelled (superseded by a forced run or its worker lost the job lease) """
+
+
+class Deadline:
+    """ Time budget of a task shared by all of its stages. Setting the cancel event stops the task at its next check. """
+    def __init__(self, seconds: float, cancel: threading.Event = None):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+        self.cancel = cancel if cancel is not None else threading.Event()
+
+    def cancelled(self):
+        return self.cancel.is_set()
+
+    def remaining(self):
+        if self.cancelled():
+            return 0.0  # waits for the stages of a cancelled task return right away
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self):
+        if self.cancelled():
+            raise JobCancelled('Run cancelled')
+        if self.expired():
+            raise DeadlineExceeded(f'Time budget of {self.seconds} seconds exceeded')
+
+
+def backoff_delay(attempt: int):
+    """ Exponential backoff with full jitter """
+    return random.uniform(0, min(retry_max_delay, retry_base_delay * 2 ** attempt))
+
+
+def call_with_retries(call, logger, max_retries: int = 3, deadline: Deadline = None, parse=None):
+    """
+    Call an LLM or embedding request until it returns a usable value.
+    None responses and parsing errors are retried with backoff. Returns None if every attempt failed.
+    Raises DeadlineExceeded if the task ran out of time, JobCancelled if it was cancelled.
+    """
+    for attempt in range(max_retries):
+        if deadline is not None:
+            deadline.check()
+
+        response = call()
+        if response is not None:
+            if parse is None:
+                return response
+            try:
+                return parse(response)
+            except Exception as e:
+                if logger is not None:
+                    logger.info(f'Broken LLM response:\n{response}')
+                    logger.warning(f'Failed to parse LLM response: {e}')
+
+        if attempt < max_retries - 1:
+            delay = backoff_delay(attempt)
+            time.sleep(delay if deadline is None else min(delay, deadline.remaining()))
+    return None
+
+
+async def acall_with_retries(call, logger, max_retries: int = 3, deadline: Deadline = None, parse=None):
+    """ call_with_retries for coroutine calls (call returns an awaitable), the backoff does not block the event loop """
+    for attempt in range(max_retries):
+        if deadline is not None:
+            deadline.check()
+
+        response = await call()
+        if response is not None:
+            if parse is None:
+                return response
+            try:
+                return parse(response)
+            except Exception as e:
+                if logger is not None:
+                    logger.info(f'Broken LLM response:\n{response}')
+                    logger.warning(f'Failed to parse LLM response: {e}')
+
+        if attempt < max_retries - 1:
+            delay = backoff_delay(attempt)
+            await asyncio.sleep(delay if deadline is None else min(delay, deadline.remaining()))
+    return None
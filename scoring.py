@@ -1,6 +1,7 @@
-import time
 import json
-from llm_connection import get_openai_completion, get_mistral_completion, get_gemini_completion
+from llm_connection import get_openai_completion, get_mistral_completion, get_gemini_completion, \
+    aget_openai_completion, aget_mistral_completion, aget_gemini_completion
+from retry import call_with_retries, acall_with_retries
 
 strict_prompt = 'Custom AI Assistant for Crypto-Project Analysis: "The Next 100x Gem"\n\n' \
                 'Objective:\n' \
@@ -108,67 +109,64 @@ def format_text(data: dict):
     }
 
 
-def call_gpt_agent(url: str, doc_chunks, is_strict: bool, logger, max_retries=3):
+def call_gpt_agent(url: str, doc_chunks, is_strict: bool, logger, max_retries=3, deadline=None):
     if len(doc_chunks) < 100:
         doc_chunks = 'Nothing was scrapped. Score accordingly!'
 
     base_prompt = strict_prompt if is_strict else moonboy_prompt
     augmented_base_prompt = base_prompt.replace('###URL###', url)
 
-    retries = 0
-    while retries < max_retries:
-        response = get_openai_completion(augmented_base_prompt + doc_chunks, logger)
-        if response is None:
-            time.sleep(1)
-        else:
-            try:
-                return format_text(json.loads(response))
-            except Exception as e:
-                logger.info(f'Broken agent response:\n{response}')
-                logger.warning(f'Agent failed to parse response: {e}')
-        retries += 1
-    return {'score': 0, 'description': 'Scoring failed'}
-
-
-def call_mistral_agent(url: str, doc_chunks, is_strict: bool, logger, max_retries=3):
+    result = call_with_retries(lambda: get_openai_completion(augmented_base_prompt + doc_chunks, logger),
+                               logger, max_retries, deadline, parse=lambda response: format_text(json.loads(response)))
+    return {'score': 0, 'description': 'Scoring failed'} if result is None else result
+
+
+def call_mistral_agent(url: str, doc_chunks, is_strict: bool, logger, max_retries=3, deadline=None):
     if len(doc_chunks) < 100:
         doc_chunks = 'Nothing was scrapped. Score accordingly!'
 
     base_prompt = strict_prompt if is_strict else moonboy_prompt
     augmented_base_prompt = base_prompt.replace('###URL###', url)
 
-    retries = 0
-    while retries < max_retries:
-        response = get_mistral_completion(augmented_base_prompt + doc_chunks, logger)
-        if response is None:
-            time.sleep(1)
-        else:
-            try:
-                return format_text(json.loads(response))
-            except Exception as e:
-                logger.info(f'Broken agent response:\n{response}')
-                logger.warning(f'Agent failed to parse response: {e}')
-        retries += 1
-    return {'score': 0, 'description': 'Scoring failed'}
-
-
-def call_gemini_agent(url: str, doc_chunks, is_strict: bool, logger, max_retries=1):
+    result = call_with_retries(lambda: get_mistral_completion(augmented_base_prompt + doc_chunks, logger),
+                               logger, max_retries, deadline, parse=lambda response: format_text(json.loads(response)))
+    return {'score': 0, 'description': 'Scoring failed'} if result is None else result
+
+
+def call_gemini_agent(url: str, doc_chunks, is_strict: bool, logger, max_retries=1, deadline=None):
     if len(doc_chunks) < 100:
         doc_chunks = 'Nothing was scrapped. Score accordingly!'
 
     base_prompt = strict_prompt if is_strict else moonboy_prompt
     augmented_base_prompt = base_prompt.replace('###URL###', url)
 
-    retries = 0
-    while retries < max_retries:
-        response = get_gemini_completion(augmented_base_prompt + doc_chunks, logger)
-        if response is None:
-            time.sleep(1)
-        else:
-            try:
-                return format_text(json.loads(response))
-            except Exception as e:
-                logger.info(f'Broken agent response:\n{response}')
-                logger.warning(f'Agent failed to parse response: {e}')
-        retries += 1
-    return {'score': 0, 'description': 'Scoring failed'}
+    result = call_with_retries(lambda: get_gemini_completion(augmented_base_prompt + doc_chunks, logger),
+                               logger, max_retries, deadline, parse=lambda response: format_text(json.loads(response)))
+    return {'score': 0, 'description': 'Scoring failed'} if result is None else result
+
+
+### Async agents ###
+# Same prompts and retries as the agents above, on the pooled async clients (see process_with_prompt_type)
+
+async def acall_agent(completion, url: str, doc_chunks, is_strict: bool, logger, max_retries: int, deadline=None):
+    if len(doc_chunks) < 100:
+        doc_chunks = 'Nothing was scrapped. Score accordingly!'
+
+    base_prompt = strict_prompt if is_strict else moonboy_prompt
+    augmented_base_prompt = base_prompt.replace('###URL###', url)
+
+    result = await acall_with_retries(lambda: completion(augmented_base_prompt + doc_chunks, logger),
+                                      logger, max_retries, deadline, parse=lambda response: format_text(json.loads(response)))
+    return {'score': 0, 'description': 'Scoring failed'} if result is None else result
+
+
+async def acall_gpt_agent(url: str, doc_chunks, is_strict: bool, logger, max_retries=3, deadline=None):
+    return await acall_agent(aget_openai_completion, url, doc_chunks, is_strict, logger, max_retries, deadline)
+
+
+async def acall_mistral_agent(url: str, doc_chunks, is_strict: bool, logger, max_retries=3, deadline=None):
+    return await acall_agent(aget_mistral_completion, url, doc_chunks, is_strict, logger, max_retries, deadline)
+
+
+async def acall_gemini_agent(url: str, doc_chunks, is_strict: bool, logger, max_retries=1, deadline=None):
+    return await acall_agent(aget_gemini_completion, url, doc_chunks, is_strict, logger, max_retries, deadline)
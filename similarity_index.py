@@ -0,0 +1,269 @@
+import os
+import re
+import json
+import time
+import shutil
+import datetime
+import threading
+from collections import Counter
+import numpy as np
+import hnswlib
+import database_connection as db
+from embedding_cache import embedding_model
+
+# Cross-project nearest neighbour search (clones, template sites). The project embeddings are stored in Mongo,
+# every process keeps an HNSW index of them on disk and catches up with the projects embedded by the others.
+with open('config.json', 'r') as file:
+    config = json.load(file)
+
+index_path = config.get('SIMILARITY_INDEX_PATH', 'similarity_index')
+index_chunks = config.get('SIMILARITY_INDEX_CHUNKS', False)  # chunk level entries (shared text between projects)
+max_index_chunks = config.get('SIMILARITY_INDEX_MAX_CHUNKS', 1000)  # chunk entries per project
+duplicate_chunk_similarity = config.get('DUPLICATE_CHUNK_SIMILARITY', 0.95)
+sync_interval = 5  # seconds between catch-ups with Mongo
+sync_overlap = datetime.timedelta(seconds=60)  # late visible writes of other processes are not missed
+save_interval = 60  # seconds between index snapshots on disk
+snapshot_max_age = 600  # seconds, replaced snapshots are removed after this (processes may still be loading them)
+initial_capacity = 1024
+
+
+class VectorIndex:
+    """ HNSW inner product index of unit vectors, every project owns a contiguous label range """
+    def __init__(self):
+        self.index = None
+        self.taskids = []  # project number -> taskid
+        self.numbers = {}  # taskid -> project number
+        self.ranges = {}  # project number -> (first label, last label + 1)
+        self.owners = np.empty(0, dtype=np.int32)  # label -> project number (-1: free)
+        self.deleted = 0
+
+    def load(self, path: str):
+        """ False if there is no saved index, ValueError if the files do not belong together """
+        if not os.path.exists(path + '.json'):
+            return False
+        with open(path + '.json', 'r') as file:
+            meta = json.load(file)
+        self.index = hnswlib.Index(space='ip', dim=meta['dim'])
+        self.index.load_index(path + '.bin')
+        self.taskids = meta['taskids']
+        self.numbers = {taskid: i for i, taskid in enumerate(self.taskids)}
+        self.ranges = {int(number): tuple(labels) for number, labels in meta['ranges'].items()}
+        owners = np.load(path + '.npy')
+        if len(owners) != self.index.get_current_count() or len(owners) != meta['count']:
+            raise ValueError(f'{path} files of different snapshots')
+        self.owners = np.full(self.index.get_max_elements(), -1, dtype=np.int32)
+        self.owners[:len(owners)] = owners
+        self.deleted = meta['deleted']
+        return True
+
+    def save(self, path: str):
+        if self.index is None:
+            return
+        self.index.save_index(path + '.bin')
+        np.save(path + '.npy', self.owners[:self.index.get_current_count()])
+        with open(path + '.json', 'w') as file:
+            json.dump({'dim': self.index.dim, 'count': self.index.get_current_count(), 'taskids': self.taskids,
+                       'ranges': self.ranges, 'deleted': self.deleted}, file)
+
+    def count(self):
+        return 0 if self.index is None else self.index.get_current_count() - self.deleted
+
+    def add(self, taskid: str, vectors):
+        """ Insert the vectors of a project, replacing its previous ones """
+        vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self.index is None:
+            self.index = hnswlib.Index(space='ip', dim=vectors.shape[1])
+            self.index.init_index(max_elements=initial_capacity, ef_construction=200, M=16)
+            self.owners = np.full(initial_capacity, -1, dtype=np.int32)
+        if taskid not in self.numbers:
+            self.numbers[taskid] = len(self.taskids)
+            self.taskids.append(taskid)
+        number = self.numbers[taskid]
+        if number in self.ranges:
+            for label in range(*self.ranges[number]):
+                self.index.mark_deleted(label)
+            self.deleted += self.ranges[number][1] - self.ranges[number][0]
+
+        start = self.index.get_current_count()
+        end = start + len(vectors)
+        if end > self.index.get_max_elements():
+            capacity = max(end, 2 * self.index.get_max_elements())
+            self.index.resize_index(capacity)
+            self.owners = np.concatenate([self.owners, np.full(capacity - len(self.owners), -1, dtype=np.int32)])
+        self.index.add_items(vectors, np.arange(start, end))
+        self.owners[start:end] = number
+        self.ranges[number] = (start, end)
+
+    def vectors(self, taskid: str):
+        """ Stored vectors of a project, None if it is not indexed """
+        number = self.numbers.get(taskid)
+        if number is None or number not in self.ranges:
+            return None
+        return np.asarray(self.index.get_items(list(range(*self.ranges[number]))), dtype=np.float32)
+
+    def search(self, vectors, k: int):
+        """ Owner project numbers and similarities of the k nearest neighbours of every vector """
+        k = min(k, self.count())
+        self.index.set_ef(max(50, k))
+        labels, distances = self.index.knn_query(vectors, k=k)
+        return self.owners[labels], 1 - distances
+
+
+_lock = threading.Lock()
+_projects = None
+_chunks = None
+_state = {'versions': {}, 'synced_until': None, 'last_sync': 0.0, 'last_save': 0.0, 'dirty': False}
+
+
+def _path(name: str):
+    return os.path.join(index_path, f'{re.sub(r"[^A-Za-z0-9_.-]", "_", embedding_model)}_{name}')
+
+
+# Snapshots: every save writes a new directory, the current one is named in a pointer file replaced with a single
+# rename. The index files of a snapshot always belong together, whichever processes save at the same time.
+def _load_snapshot():
+    """ Called with _lock held """
+    if not os.path.exists(_path('current')):
+        return
+    with open(_path('current'), 'r') as file:
+        directory = os.path.join(index_path, file.read().strip())
+    with open(os.path.join(directory, 'state.json'), 'r') as file:
+        state = json.load(file)
+    if not _projects.load(os.path.join(directory, 'projects')):
+        raise ValueError(f'{directory} has no project index')
+    if index_chunks:
+        if not state['index_chunks']:
+            raise ValueError(f'{directory} was saved without the chunk index')
+        _chunks.load(os.path.join(directory, 'chunks'))
+    _state['versions'] = state['versions']
+    _state['synced_until'] = datetime.datetime.fromisoformat(state['synced_until']) if state['synced_until'] else None
+
+
+def _load():
+    """ Load the snapshot once (called with _lock held) """
+    global _projects, _chunks
+    if _projects is not None:
+        return
+    os.makedirs(index_path, exist_ok=True)
+    _projects = VectorIndex()
+    _chunks = VectorIndex()
+    try:
+        _load_snapshot()
+    except Exception:
+        # Corrupt, incomplete or removed snapshot: the index is rebuilt from the embeddings stored in Mongo
+        _projects = VectorIndex()
+        _chunks = VectorIndex()
+        _state.update({'versions': {}, 'synced_until': None, 'last_sync': 0.0})
+
+
+def _add(taskid: str, embedding, chunk_embeddings, updated_at):
+    """ Called with _lock held """
+    _projects.add(taskid, embedding)
+    if index_chunks and chunk_embeddings is not None and len(chunk_embeddings) > 0:
+        _chunks.add(taskid, chunk_embeddings)
+    _state['versions'][taskid] = updated_at.isoformat()
+    _state['dirty'] = True
+
+
+def _save_if_due():
+    """ Called with _lock held """
+    if not _state['dirty'] or time.monotonic() - _state['last_save'] < save_interval:
+        return
+    name = os.path.basename(_path(f'snapshot-{time.time_ns()}-{os.getpid()}'))
+    directory = os.path.join(index_path, name)
+    os.makedirs(directory)
+    _projects.save(os.path.join(directory, 'projects'))
+    if index_chunks:
+        _chunks.save(os.path.join(directory, 'chunks'))
+    with open(os.path.join(directory, 'state.json'), 'w') as file:
+        synced_until = _state['synced_until'].isoformat() if _state['synced_until'] else None
+        json.dump({'versions': _state['versions'], 'synced_until': synced_until, 'index_chunks': index_chunks}, file)
+    with open(_path(f'current.{os.getpid()}.tmp'), 'w') as file:
+        file.write(name)
+    os.replace(_path(f'current.{os.getpid()}.tmp'), _path('current'))
+    _state['dirty'] = False
+    _state['last_save'] = time.monotonic()
+    _remove_old_snapshots(name)
+
+
+def _remove_old_snapshots(current: str):
+    """ Snapshots replaced a while ago (and the leftovers of interrupted saves) """
+    prefix = os.path.basename(_path('snapshot-'))
+    now = time.time()
+    for name in os.listdir(index_path):
+        directory = os.path.join(index_path, name)
+        if name.startswith(prefix) and name != current and now - os.path.getmtime(directory) > snapshot_max_age:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def _sync():
+    """ Index the projects stored by other processes since the last sync (called with _lock held) """
+    _load()
+    if time.monotonic() - _state['last_sync'] < sync_interval:
+        return
+    since = _state['synced_until'] - sync_overlap if _state['synced_until'] is not None else None
+    for taskid, embedding, chunk_embeddings, updated_at in db.find_project_embeddings(embedding_model, since):
+        if _state['versions'].get(taskid) != updated_at.isoformat():
+            _add(taskid, embedding, chunk_embeddings, updated_at)
+        _state['synced_until'] = updated_at if _state['synced_until'] is None else max(_state['synced_until'], updated_at)
+    _state['last_sync'] = time.monotonic()
+    _save_if_due()
+
+
+def add_project(taskid: str, chunk_embeddings, logger):
+    """ Insert or replace a project: mean of its unit chunk embeddings, and an even sample of the chunks if enabled """
+    chunk_embeddings = np.asarray(chunk_embeddings, dtype=np.float32)
+    if len(chunk_embeddings) == 0:
+        return
+    try:
+        embedding = chunk_embeddings.mean(axis=0)
+        embedding /= max(np.linalg.norm(embedding), 1e-12)
+        sample = None
+        if index_chunks:
+            sample = chunk_embeddings[np.unique(np.linspace(0, len(chunk_embeddings) - 1, max_index_chunks).astype(int))]
+        updated_at = db.store_project_embedding(taskid, embedding_model, embedding, sample)
+        with _lock:
+            _load()
+            _add(taskid, embedding, sample, updated_at)
+            _save_if_due()
+        logger.info(f'[{taskid}] Project added to the similarity index.')
+    except Exception as e:
+        logger.error(f'[{taskid}] Similarity index update failed: {e}')
+
+
+def find_similar(taskid: str, k: int = 10):
+    """ [(taskid, similarity)] of the nearest projects, None if the project is not indexed """
+    with _lock:
+        _sync()
+        vector = _projects.vectors(taskid)
+        if vector is None:
+            return None
+        owners, similarities = _projects.search(vector, k + 1)
+    number = _projects.numbers[taskid]
+    return [(_projects.taskids[o], float(s)) for o, s in zip(owners[0], similarities[0]) if o != number][:k]
+
+
+def find_shared_chunks(taskid: str, k: int = 10, neighbours: int = 10):
+    """
+    [(taskid, shared chunk count, shared ratio)] of the projects with the most near-identical chunks
+    (copied texts of clones and template sites), None if the project is not indexed
+    """
+    with _lock:
+        _sync()
+        vectors = _chunks.vectors(taskid)
+        if vectors is None:
+            return None
+        owners, similarities = _chunks.search(vectors, neighbours)
+    number = _chunks.numbers[taskid]
+    shared = Counter()
+    for row_owners, row_similarities in zip(owners, similarities):
+        shared.update({o for o, s in zip(row_owners, row_similarities) if o != number and s >= duplicate_chunk_similarity})
+    return [(_chunks.taskids[o], count, round(count / len(vectors), 3)) for o, count in shared.most_common(k)]
+
+
+def stats():
+    """ Indexed counts, None before the first use of the index in this process """
+    with _lock:
+        if _projects is None:
+            return None
+        return {'projects': _projects.count(), 'chunks': _chunks.count() if index_chunks else None}
@@ -0,0 +1,25 @@
+import os
+import sys
+import json
+import pytest
+
+# The modules read config.json from the working directory when imported
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+
+@pytest.fixture(scope='session', autouse=True)
+def config_dir(tmp_path_factory):
+    """ Default config (placeholder API keys, no requests are sent) unless the working directory has one """
+    if os.path.exists('config.json'):
+        yield
+        return
+    directory = tmp_path_factory.mktemp('config')
+    (directory / 'config.json').write_text(json.dumps({'OPENAI_API_KEY': 'test', 'MISTRAL_API_KEY': 'test',
+                                                        'GEMINI_API_KEY': 'test'}))
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
@@ -0,0 +1,93 @@
+import pytest
+from bs4 import BeautifulSoup
+
+# Parity of the HTML extractors with the former BeautifulSoup parsing (html.parser soup without the skipped tags)
+
+pages = {
+    'landing': '''<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="utf-8">
+  <title>Moon Token | The next gem</title>
+  <style>body { color: red; }</style>
+  <script>window.dataLayer = [];</script>
+</head>
+<body>
+  <nav><a href="/">Home</a> <a href="/docs">Docs</a> <a href="https://twitter.com/moon">Twitter</a></nav>
+  <header><h1>Moon Token</h1><p>The <b>fastest</b> chain for <i>community</i> memes.</p></header>
+  <section id="tokenomics">
+    <h2>Tokenomics</h2>
+    <ul>
+      <li>Total supply: 1,000,000,000 MOON</li>
+      <li>Liquidity: 40%&nbsp;locked</li>
+    </ul>
+    <table><tr><th>Round</th><th>Price</th></tr><tr><td>Seed</td><td>$0.001</td></tr></table>
+  </section>
+  <!-- footer starts here -->
+  <footer>&copy; 2024 Moon Labs &amp; partners. <a href="/whitepaper.pdf">Whitepaper</a> <a>no target</a></footer>
+  <noscript>Enable JavaScript</noscript>
+</body>
+</html>''',
+    'docs': '''<html><body>
+<div class="sidebar"><a href="intro">Introduction</a><a href="staking">Staking</a></div>
+<main>
+<h1>Staking</h1>
+<p>Stake MOON to earn rewards.
+   Rewards are paid every epoch.</p>
+<pre>  moon stake --amount 100
+  moon claim</pre>
+<textarea>  keep   spacing  </textarea>
+<p>Contract: <code>0x1234abcd</code><br>Audited by <a href="https://audit.example">Example Audits</a>.</p>
+<template><p>Hidden template text</p></template>
+</main>
+</body></html>''',
+    'fragment': '<p>Unclosed paragraph <span>with a span<p>Second paragraph</div> stray end tag',
+    'empty': '',
+}
+
+
+def reference_page(html: str):
+    soup = BeautifulSoup(html, 'html.parser')
+    hrefs = [a.get('href') for a in soup.find_all('a')]
+    for element in soup.find_all(['script', 'style', 'nav', 'noscript', 'template']):
+        element.decompose()
+    return {'texts': [p.text for p in soup.find_all(string=True)], 'hrefs': [h for h in hrefs if h is not None]}
+
+
+def segments(page: dict):
+    """ Segments kept by page_to_text of the crawlers (whitespace and empty segments are dropped) """
+    return [t for t in page['texts'] if len(t) > 1]
+
+
+def normalized(page: dict):
+    return ' '.join(''.join(page['texts']).split())
+
+
+@pytest.mark.parametrize('engine', ['selectolax', 'lxml'])
+@pytest.mark.parametrize('name', ['landing', 'docs', 'empty'])
+def test_extract_matches_bs4(engine, name):
+    pytest.importorskip(engine)
+    from html_extractor import extract
+    page = extract(pages[name], engine)
+    reference = reference_page(pages[name])
+    assert page['hrefs'] == reference['hrefs']
+    assert segments(page) == segments(reference)
+
+
+@pytest.mark.parametrize('engine', ['selectolax', 'lxml'])
+def test_extract_malformed_page(engine):
+    # HTML5 tree builders repair broken markup differently from html.parser, the text is the same
+    pytest.importorskip(engine)
+    from html_extractor import extract
+    page = extract(pages['fragment'], engine)
+    reference = reference_page(pages['fragment'])
+    assert page['hrefs'] == reference['hrefs']
+    assert normalized(page) == normalized(reference)
+
+
+def test_bs4_engine_keeps_the_former_output():
+    from html_extractor import extract
+    page = extract(pages['landing'], 'bs4')
+    soup = BeautifulSoup(pages['landing'], 'html.parser')
+    assert page['texts'] == [p.text for p in soup.find_all(string=True)]
+    assert page['hrefs'] == ['/', '/docs', 'https://twitter.com/moon', '/whitepaper.pdf']
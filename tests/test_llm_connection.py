@@ -0,0 +1,127 @@
+import json
+import time
+import asyncio
+import logging
+import concurrent.futures
+import pytest
+
+pytest.importorskip('openai')
+pytest.importorskip('mistralai')
+
+logger = logging.getLogger(__name__)
+
+
+@pytest.fixture
+def llm_connection():
+    import llm_connection
+    return llm_connection
+
+
+@pytest.fixture
+def scoring():
+    import scoring
+    return scoring
+
+
+class FakeRawResponse:
+    def __init__(self, content):
+        self.headers = {}
+        self.content = content
+
+    def parse(self):
+        message = type('Message', (), {'content': self.content})
+        choice = type('Choice', (), {'message': message})
+        return type('Completion', (), {'choices': [choice]})
+
+
+class FakeAsyncOpenAI:
+    """ AsyncOpenAI stand-in recording the peak of concurrent requests """
+    def __init__(self, content, delay=0.0):
+        self.content = content
+        self.delay = delay
+        self.in_flight = 0
+        self.peak = 0
+        completions = type('Completions', (), {'with_raw_response': type('Raw', (), {'create': self.create})})
+        self.chat = type('Chat', (), {'completions': completions})
+
+    async def create(self, **kwargs):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            return FakeRawResponse(self.content)
+        finally:
+            self.in_flight -= 1
+
+
+def test_async_completion(llm_connection):
+    client = FakeAsyncOpenAI('```json{"score": 7}```')
+    result = asyncio.run(llm_connection.aget_openai_completion('prompt', logger, client=client))
+    assert result == '{"score": 7}'
+
+
+def test_async_calls_share_the_provider_limit(llm_connection):
+    limit = llm_connection.provider_concurrency['openai']
+
+    async def fan_out(client):
+        await asyncio.gather(*[llm_connection.aget_openai_completion('prompt', logger, client=client)
+                               for _ in range(limit * 2)])
+        return client.peak
+
+    assert asyncio.run(fan_out(FakeAsyncOpenAI('{}', delay=0.05))) == limit
+
+    # A slot held by a sync call is not available to the async calls
+    with llm_connection.provider_limits['openai']:
+        assert asyncio.run(fan_out(FakeAsyncOpenAI('{}', delay=0.05))) == limit - 1
+
+
+def test_clients_are_pooled_per_loop(llm_connection):
+    async def clients():
+        return llm_connection.get_async_clients()
+
+    first = llm_connection.submit_coroutine(clients()).result(timeout=5)
+    second = llm_connection.submit_coroutine(clients()).result(timeout=5)
+    assert first is second
+    assert asyncio.run(clients()) is not first
+
+
+def test_async_agent(llm_connection, scoring, monkeypatch):
+    answer = json.dumps({'score_justification': 'Moon soon', 'score': 9})
+
+    async def completion(prompt, logger):
+        return answer
+
+    monkeypatch.setattr(scoring, 'aget_openai_completion', completion)
+    result = llm_connection.submit_coroutine(scoring.acall_gpt_agent('https://moon.example', '', False, logger)).result(5)
+    assert result == {'description': 'Moon soon', 'score': 9}
+
+
+def test_failed_agent(llm_connection, scoring, monkeypatch):
+    async def completion(prompt, logger):
+        return 'not json'
+
+    monkeypatch.setattr(scoring, 'aget_mistral_completion', completion)
+    monkeypatch.setattr('retry.backoff_delay', lambda attempt: 0)
+    result = asyncio.run(scoring.acall_mistral_agent('https://moon.example', '', True, logger))
+    assert result == {'score': 0, 'description': 'Scoring failed'}
+
+
+def test_timed_out_agent_is_cancelled(llm_connection, scoring, monkeypatch):
+    cancelled = []
+
+    async def completion(prompt, logger):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    monkeypatch.setattr(scoring, 'aget_gemini_completion', completion)
+    future = llm_connection.submit_coroutine(scoring.acall_gemini_agent('https://moon.example', '', True, logger))
+    with pytest.raises(concurrent.futures.TimeoutError):
+        future.result(timeout=0.1)
+    future.cancel()
+    deadline = time.monotonic() + 5
+    while not cancelled and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert cancelled == [True]
@@ -0,0 +1,39 @@
+import pytest
+
+
+@pytest.fixture
+def page_cache():
+    import page_cache
+    page_cache._connection.execute('DELETE FROM pages')
+    page_cache._total_size = 0
+    return page_cache
+
+
+def test_unchanged_body_reuses_text(page_cache):
+    text, validators = page_cache.revalidate('https://moon.example/docs', None, 200, {'etag': '"v1"'}, b'<p>Docs</p>')
+    assert text is None
+    page_cache.store('https://moon.example/docs', 'Docs text', validators)
+    entry = page_cache.lookup('https://moon.example/docs')
+    assert page_cache.revalidate('https://moon.example/docs', entry, 200, {}, b'<p>Docs</p>')[0] == 'Docs text'
+    assert page_cache.revalidate('https://moon.example/docs', entry, 304, {}, b'')[0] == 'Docs text'
+
+
+@pytest.mark.parametrize('status_code', [403, 404, 429, 500, 503])
+def test_error_responses_are_not_cached(page_cache, status_code):
+    body = b'<p>Checking your browser</p>'
+    assert page_cache.revalidate('https://moon.example', None, status_code, {'etag': '"e"'}, body) == (None, None)
+
+    # Text scraped from the real page must not be served again because the error body did not change
+    _, validators = page_cache.revalidate('https://moon.example', None, 200, {}, body)
+    page_cache.store('https://moon.example', 'Scraped text', validators)
+    entry = page_cache.lookup('https://moon.example')
+    assert page_cache.revalidate('https://moon.example', entry, status_code, {}, body) == (None, None)
+
+
+def test_rendered_pages_need_a_304(page_cache):
+    _, validators = page_cache.revalidate('https://moon.example/app', None, 200, {}, b'<div id="root"></div>', rendered=True)
+    assert validators['body_hash'] is None
+    page_cache.store('https://moon.example/app', 'Rendered text', validators)
+    entry = page_cache.lookup('https://moon.example/app')
+    assert page_cache.revalidate('https://moon.example/app', entry, 200, {}, b'<div id="root"></div>', rendered=True)[0] is None
+    assert page_cache.revalidate('https://moon.example/app', entry, 304, {}, b'', rendered=True)[0] == 'Rendered text'
@@ -0,0 +1,89 @@
+import random
+import pytest
+from text_splitter import RecursiveTextSplitter
+
+# Expected chunks were produced by langchain 0.1.7 RecursiveCharacterTextSplitter(chunk_size, chunk_overlap) with the
+# overlap of vectorize.split_documents (20% of the chunk size)
+words = ['token', 'staking', 'rewards', 'liquidity', 'the', 'of', 'DAO', 'governance', 'audit', 'roadmap', 'Q3',
+         'bridge', 'a', 'NFT', 'holders', 'vesting', 'team', 'burn', 'is', 'mainnet', 'launch', 'to', 'moon']
+separators = [' '] * 12 + ['  ', '\n', ' \n', '\n\n', '\n\n\n', '\t']
+
+mixed = 'Moon Token\n\nThe next 100x gem.\nStaking rewards   for holders.\n\n\nRoadmap: Q3 mainnet,  Q4 bridge.  \n'
+long_word = 'Contract: 0x' + 'ab' * 30 + ' audited by   CertiK\nsupply 1000000000000000000 tokens'
+
+
+def website(seed: int, length: int):
+    """ Scraped-page-like text mixing paragraphs, lines, repeated spaces and unbreakable words """
+    rng = random.Random(seed)
+    parts = []
+    total = 0
+    while total < length:
+        if rng.random() < 0.01:
+            word = '0x' + ''.join(rng.choice('0123456789abcdef') for _ in range(rng.choice([40, 120, 2000])))
+        else:
+            word = rng.choice(words)
+        separator = rng.choice(separators)
+        parts.append(word + separator)
+        total += len(word) + len(separator)
+    return ''.join(parts)
+
+
+def split(text: str, chunk_size: int):
+    return list(RecursiveTextSplitter(chunk_size=chunk_size, chunk_overlap=int(0.2 * chunk_size)).split_text(text))
+
+
+@pytest.mark.parametrize('chunk_size, expected', [
+    (100, ['Moon Token\n\nThe next 100x gem.\nStaking rewards   for holders.\n\n\nRoadmap: Q3 mainnet,  Q4 bridge.']),
+    (37, ['Moon Token', 'The next 100x gem.', 'Staking rewards   for holders.', 'Roadmap: Q3 mainnet,  Q4 bridge.']),
+    (10, ['Moon Token', 'The next', '100x gem.', 'Staking', 'rewards', 'for', 'holders.', 'Roadmap:', 'Q3', 'mainnet,',
+          'Q4', 'bridge.']),
+])
+def test_mixed_separators(chunk_size, expected):
+    assert split(mixed, chunk_size) == expected
+
+
+@pytest.mark.parametrize('chunk_size, expected', [
+    (100, ['Contract: 0x' + 'ab' * 30 + ' audited by   CertiK', 'supply 1000000000000000000 tokens']),
+    (37, ['Contract:', '0xababababababababababababababababab', 'babababababababababababababababab', 'audited by   CertiK',
+          'supply 1000000000000000000 tokens']),
+    (10, ['Contract:', '0xabababa', 'bababababa', 'bababababa', 'bababababa', 'bababababa', 'bababababa', 'bababababa',
+          'bababab', 'audited', 'by', 'CertiK', 'supply', '100000000', '0000000000', '0000', 'tokens']),
+])
+def test_unbreakable_words(chunk_size, expected):
+    assert split(long_word, chunk_size) == expected
+
+
+# Chunks are slices of the page (separators kept, whitespace stripped), pinned as (start, end) offsets
+@pytest.mark.parametrize('seed, length, chunk_size, spans', [
+    (1, 6000, 1500, [(0, 1478), (1183, 2563), (2270, 3347), (3349, 3420), (3421, 3468), (3469, 4968), (4668, 5471),
+                     (5474, 6000)]),
+    (2, 12000, 1500, [(0, 546), (548, 679), (681, 721), (722, 2221), (1921, 2724), (2725, 2747), (2749, 2792),
+                      (2794, 3251), (3254, 3266), (3267, 4766), (4466, 5269), (5270, 5329), (5331, 5386), (5388, 6813),
+                      (6699, 7446), (7059, 7066), (7457, 8956), (8656, 9459), (9460, 9470), (9472, 10276),
+                      (10278, 10392), (10393, 10419), (10420, 11919), (11619, 12422)]),
+    (3, 2000, 100, [(0, 76), (78, 167), (170, 267), (268, 352), (355, 398), (401, 483), (485, 517), (519, 545),
+                    (546, 645), (625, 725), (705, 805), (785, 885), (865, 965), (945, 1045), (1025, 1125), (1105, 1205),
+                    (1185, 1285), (1265, 1365), (1345, 1445), (1425, 1525), (1505, 1605), (1585, 1685), (1665, 1765),
+                    (1745, 1845), (1825, 1925), (1905, 2005), (1985, 2085), (2065, 2165), (2145, 2245), (2225, 2325),
+                    (2305, 2405), (2385, 2485), (2465, 2552)]),
+])
+def test_website_pages(seed, length, chunk_size, spans):
+    page = website(seed, length)
+    assert split(page, chunk_size) == [page[start:end] for start, end in spans]
+
+
+@pytest.mark.parametrize('text', ['', '   ', '\n\n \t\n'])
+@pytest.mark.parametrize('chunk_size', [1500, 100, 37, 10])
+def test_blank_documents(text, chunk_size):
+    assert split(text, chunk_size) == []
+
+
+def test_split_documents():
+    splitter = RecursiveTextSplitter(chunk_size=37, chunk_overlap=7)
+    chunks = splitter.split_documents(['', mixed, '  \n', long_word])
+    assert list(chunks) == split(mixed, 37) + split(long_word, 37)
+
+
+def test_overlap_larger_than_chunk_size():
+    with pytest.raises(ValueError):
+        RecursiveTextSplitter(chunk_size=10, chunk_overlap=20)
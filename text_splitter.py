@@ -0,0 +1,77 @@
+from collections import deque
+from typing import Iterable, Iterator, List
+
+# Recursive character text splitter. Same chunks as langchain's RecursiveCharacterTextSplitter (default separators,
+# separators kept, whitespace stripped) without its import graph and Document objects. Chunks are yielded lazily.
+default_separators = ['\n\n', '\n', ' ', '']
+
+
+class RecursiveTextSplitter:
+    """
+    Splits on the first separator found in the text and merges the pieces up to chunk_size characters,
+    consecutive chunks overlap by up to chunk_overlap characters. Pieces still too long are split with the next separator.
+    """
+    def __init__(self, chunk_size: int, chunk_overlap: int, separators: List[str] = None):
+        if chunk_overlap > chunk_size:
+            raise ValueError(f'Chunk overlap ({chunk_overlap}) is larger than the chunk size ({chunk_size})')
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.separators = separators or default_separators
+
+    @staticmethod
+    def _split(text: str, separator: str):
+        """ Pieces of the text, the separator is kept at the start of the following piece """
+        if separator == '':
+            return list(text)
+        parts = text.split(separator)
+        splits = [parts[0]] + [separator + part for part in parts[1:]]
+        return [s for s in splits if s != '']
+
+    def _merge(self, splits: List[str]) -> Iterator[str]:
+        """ Pieces merged into chunks, the tail of a chunk is repeated at the start of the next one """
+        current = deque()
+        total = 0
+        for split in splits:
+            length = len(split)
+            if total + length > self.chunk_size and len(current) > 0:
+                chunk = ''.join(current).strip()
+                if chunk != '':
+                    yield chunk
+                while total > self.chunk_overlap or (total + length > self.chunk_size and total > 0):
+                    total -= len(current.popleft())
+            current.append(split)
+            total += length
+        chunk = ''.join(current).strip()
+        if chunk != '':
+            yield chunk
+
+    def _split_text(self, text: str, separators: List[str]) -> Iterator[str]:
+        separator = separators[-1]
+        next_separators = []
+        for i, s in enumerate(separators):
+            if s == '' or s in text:
+                separator = s
+                next_separators = separators[i + 1:] if s != '' else []
+                break
+
+        good_splits = []
+        for split in self._split(text, separator):
+            if len(split) < self.chunk_size:
+                good_splits.append(split)
+                continue
+            if len(good_splits) > 0:
+                yield from self._merge(good_splits)
+                good_splits = []
+            if len(next_separators) == 0:
+                yield split
+            else:
+                yield from self._split_text(split, next_separators)
+        if len(good_splits) > 0:
+            yield from self._merge(good_splits)
+
+    def split_text(self, text: str) -> Iterator[str]:
+        return self._split_text(text, self.separators)
+
+    def split_documents(self, documents: Iterable[str]) -> Iterator[str]:
+        for document in documents:
+            yield from self.split_text(document)
@@ -1,39 +1,124 @@
-import time
-from typing import List
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from llm_connection import get_multiple_openai_embedding
+import json
+import threading
+from typing import Iterable, List
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from retry import call_with_retries
+from text_splitter import RecursiveTextSplitter
+from near_duplicates import drop_near_duplicates
+from chunk_selection import count_tokens
+from embedding_cache import cache_key, embed_texts, load_chunk_embeddings, save_chunk_embeddings, record_chunk_cache_usage
+
+with open('config.json', 'r') as file:
+    config = json.load(file)
 
 estimated_char_per_token = 3
 char_per_chunk = 500 * estimated_char_per_token
 
-batch_size = 500
+batch_tokens = config.get('EMBEDDING_BATCH_TOKENS', 100000)  # token ceiling of one embedding request
+batch_concurrency = config.get('EMBEDDING_CONCURRENCY', 4)  # embedding requests of a job sent at the same time
+max_batch_chunks = 500
+split_retries = 2  # attempts of a multi-chunk batch before it is split in halves
+
+
+def token_batches(chunks: List[str], tokens: dict):
+    """ Consecutive batches under the token ceiling (and max_batch_chunks) """
+    batches = []
+    current, current_tokens = [], 0
+    for chunk in chunks:
+        if len(current) > 0 and (current_tokens + tokens[chunk] > batch_tokens or len(current) >= max_batch_chunks):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(chunk)
+        current_tokens += tokens[chunk]
+    if len(current) > 0:
+        batches.append(current)
+    return batches
+
+
+class BatchEmbedder:
+    """
+    Embeds the batches of one job. A failing batch is split in halves so one bad chunk only drops itself.
+    After max_retries failed calls in a row the embedding service is considered down and the rest is dropped.
+    """
+    def __init__(self, logger, max_retries: int, deadline=None):
+        self.logger = logger
+        self.max_retries = max_retries
+        self.deadline = deadline
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def _log_drop(self, chunks: List[str], reason: str):
+        if self.logger is not None:
+            self.logger.error(f'Embedding failed ({reason}). Dropping {len(chunks)} chunks.')
+
+    def embed(self, chunks: List[str]):
+        """ Embeddings by chunk key """
+        with self.lock:
+            service_down = self.failures >= self.max_retries
+        if service_down:
+            self._log_drop(chunks, 'embedding service unavailable')
+            return {}
+
+        attempts = self.max_retries if len(chunks) == 1 else min(split_retries, self.max_retries)
+        response = call_with_retries(lambda: embed_texts(chunks, self.logger), self.logger, attempts, self.deadline)
+        with self.lock:
+            self.failures = 0 if response is not None else self.failures + 1
+        if response is not None:
+            return {cache_key(c): e for c, e in zip(chunks, response)}
+        if len(chunks) == 1:
+            self._log_drop(chunks, f'{attempts} attempts')
+            return {}
 
+        half = len(chunks) // 2
+        return {**self.embed(chunks[:half]), **self.embed(chunks[half:])}
 
-def vectorize(documents: List[str], logger=None, chunk_size: int = char_per_chunk, max_retries: int = 10):
+
+def split_documents(documents: Iterable[str], chunk_size: int = char_per_chunk):
+    text_splitter = RecursiveTextSplitter(chunk_size=chunk_size, chunk_overlap=int(0.2 * chunk_size))
+    return list(text_splitter.split_documents(documents))
+
+
+def vectorize(documents: List[str], logger=None, chunk_size: int = char_per_chunk, max_retries: int = 10, deadline=None,
+              normalize: bool = True):
+    """
+    Chunk documents and embed the chunks. Returns the chunks and their embeddings as one float32 matrix
+    (rows scaled to unit length if normalize is set).
+    """
     if len(documents) == 0:
-        return [], []
-
-    # Chunk documents
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=int(0.2 * chunk_size))
-    chunks = text_splitter.create_documents(documents)
-    text_chunks = [c.page_content for c in chunks]
-
-    # Create embeddings for text chunks
-    text_chunks_out = []
-    embeddings = []
-    for i in range(0, len(text_chunks), batch_size):
-        current_chunks = text_chunks[i:i + batch_size]
-        retries = 0
-        while retries < max_retries:
-            response = get_multiple_openai_embedding(current_chunks, logger)
-            if response is None:
-                retries += 1
-                if logger is not None:
-                    logger.error(f'OpenAI embedding failed. Retry: {retries}')
-                time.sleep(1)
-            else:
-                text_chunks_out.extend(current_chunks)
-                embeddings.extend(response)
-                break
+        return [], np.empty((0, 0), dtype=np.float32)
+
+    text_chunks = split_documents(documents, chunk_size)
+    text_chunks, _ = drop_near_duplicates(text_chunks, logger)  # repeated boilerplate is not embedded
+
+    # Create embeddings for text chunks. Only chunks missing from the cache are sent (identical chunks only once).
+    keys = [cache_key(c) for c in text_chunks]
+    embeddings_by_key = load_chunk_embeddings(keys, logger)
+    hits = sum(1 for k in keys if k in embeddings_by_key)
+    missing_chunks = list(dict.fromkeys(c for c, k in zip(text_chunks, keys) if k not in embeddings_by_key))
+
+    # Batches by token count (the OpenAI endpoint limits tokens per request), sent concurrently (the rate limiter or
+    # the local process pool paces them)
+    tokens = {c: count_tokens(c) for c in dict.fromkeys(text_chunks)}
+    batches = token_batches(missing_chunks, tokens)
+    embedder = BatchEmbedder(logger, max_retries, deadline)
+    new_embeddings = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(batch_concurrency, len(batches)))) as executor:
+        for batch_embeddings in executor.map(embedder.embed, batches):
+            new_embeddings.update(batch_embeddings)
+    save_chunk_embeddings(new_embeddings, logger)
+    embeddings_by_key.update(new_embeddings)
+
+    saved_calls = len(token_batches(list(tokens), tokens)) - len(batches)
+    record_chunk_cache_usage(len(text_chunks), hits, saved_calls, logger)
+
+    text_chunks_out = [c for c, k in zip(text_chunks, keys) if k in embeddings_by_key]
+    if len(text_chunks_out) == 0:
+        return [], np.empty((0, 0), dtype=np.float32)
+    embeddings = np.vstack([embeddings_by_key[k] for k in keys if k in embeddings_by_key]).astype(np.float32, copy=False)
+    if normalize:
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        embeddings /= norms
 
     return text_chunks_out, embeddings
@@ -0,0 +1,81 @@
+import os
+import json
+import time
+import socket
+import threading
+import traceback
+import database_connection as db
+from app import app, processing_task
+
+# Standalone worker process for the durable (mongo) job queue. Run: python worker.py
+with open('config.json', 'r') as file:
+    config = json.load(file)
+
+worker_threads = config.get('WORKER_THREADS', 2)  # jobs processed at the same time by this process
+lease_seconds = config.get('JOB_LEASE_SECONDS', 120)  # a job is re-queued if its worker is silent for this long
+heartbeat_interval = lease_seconds / 4
+poll_interval = config.get('WORKER_POLL_INTERVAL', 5)  # seconds between queue checks when idle
+max_attempts = config.get('JOB_MAX_ATTEMPTS', 3)  # a job fails after its lease expired this many times
+
+
+def heartbeat(job_id, worker_id: str, stop: threading.Event, cancel: threading.Event):
+    """
+    Keep the lease of the job alive while it is processed. A lost lease (expired or superseded by a forced request)
+    cancels the run, it stops at its next stage check without writing results or checkpoints.
+    """
+    while not stop.wait(heartbeat_interval):
+        try:
+            if not db.heartbeat_job(job_id, worker_id, lease_seconds):
+                app.logger.warning(f'[{worker_id}] Lost the lease of job {job_id}, cancelling the run.')
+                cancel.set()
+                return
+        except Exception as e:
+            app.logger.error(f'[{worker_id}] Heartbeat failed: {e}')
+
+
+def run_worker(worker_id: str):
+    app.logger.info(f'[{worker_id}] Worker started.')
+    while True:
+        try:
+            requeued, failed = db.requeue_expired_jobs(max_attempts)
+            if requeued > 0 or failed > 0:
+                app.logger.warning(f'[{worker_id}] Expired leases. Re-queued jobs: {requeued}; failed jobs: {failed}')
+            job = db.claim_job(worker_id, lease_seconds)
+        except Exception as e:
+            app.logger.error(f'[{worker_id}] Job queue unavailable: {e}')
+            time.sleep(poll_interval)
+            continue
+
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        taskid = job['taskid']
+        app.logger.info(f'[{taskid}] Job claimed by {worker_id}. Attempt: {job["attempts"]}')
+        stop = threading.Event()
+        cancel = threading.Event()
+        threading.Thread(target=heartbeat, args=(job['_id'], worker_id, stop, cancel), daemon=True).start()
+        batch_id = job.get('batchId')
+        error = None
+        try:
+            if batch_id is not None:
+                db.update_batch_item(batch_id, taskid, 'running')
+            processing_task(job['url'], taskid, job.get('force', False), cancel)
+        except Exception as e:
+            app.logger.error(f'[{taskid}] Processing job failed: {e}\n{traceback.format_exc()}')
+            error = str(e)
+        finally:
+            stop.set()
+        finished = db.finish_job(job['_id'], worker_id, error)
+        if finished is not None:  # otherwise the batch items are updated by the run that took over the job
+            status = 'failed' if error is not None else 'cancelled' if cancel.is_set() else 'done'
+            for job_batch_id in db.job_batches(finished):
+                db.update_batch_item(job_batch_id, taskid, status, error)
+
+if __name__ == '__main__':
+    worker_prefix = f'{socket.gethostname()}-{os.getpid()}'
+    threads = [threading.Thread(target=run_worker, args=(f'{worker_prefix}-{i}',)) for i in range(worker_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()